@@ -0,0 +1,100 @@
+"""Бенчмарк декодирования: полный JPEG + LANCZOS против DCT-scaling (``draft``).
+
+Каждый замер идёт в отдельном процессе, чтобы пиковый RSS не смешивался
+между вариантами. Входы — синтетические «фото чертежа» 12 и 48 Мп.
+
+    python benchmarks/bench_decode.py [--max-side 2000] [--repeat 3]
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIZES = {"12MP": (4000, 3000), "48MP": (8000, 6000)}
+
+
+def _import_utils():
+    # config.py требует токены; для бенчмарка хватит заглушек
+    os.environ.setdefault("BOT_TOKEN", "bench")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    sys.path.insert(0, ROOT)
+    from src.mrdoors import utils
+    return utils
+
+
+def make_photo(size) -> bytes:
+    """Чертёж на слегка шумной «бумаге», сжатый как снимок с камеры."""
+    from PIL import Image, ImageChops, ImageDraw
+
+    w, h = size
+    paper = ImageChops.add(Image.new("L", size, 200), Image.effect_noise(size, 6), 1, -128).convert("RGB")
+    draw = ImageDraw.Draw(paper)
+    step = max(w, h) // 40
+    for i in range(0, max(w, h), step):
+        draw.line((i, 0, w - i, h), fill=(40, 40, 40), width=max(2, w // 1000))
+        draw.rectangle((i % w, (i * 7) % h, i % w + step, (i * 7) % h + step // 2), outline=(20, 20, 20), width=3)
+    buf = BytesIO()
+    paper.save(buf, format="JPEG", quality=92)
+    return buf.getvalue()
+
+
+def child(path: str, draft: bool, max_side: int, repeat: int):
+    utils = _import_utils()
+    with open(path, "rb") as f:
+        data = f.read()
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        utils.load_image(data, max_side, draft=draft)
+        timings.append(time.perf_counter() - started)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss в Linux — килобайты
+    print(json.dumps({"best_s": min(timings), "peak_mb": peak / 1024, "delta_mb": (peak - baseline) / 1024}))
+
+
+def run_variant(path: str, draft: bool, max_side: int, repeat: int) -> dict:
+    out = subprocess.run(
+        [sys.executable, __file__, "--child", path, "--draft", str(int(draft)),
+         "--max-side", str(max_side), "--repeat", str(repeat)],
+        check=True, capture_output=True, text=True,
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--max-side", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--child")
+    parser.add_argument("--draft", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, bool(args.draft), args.max_side, args.repeat)
+        return
+
+    print(f"{'input':<6} {'variant':<8} {'best, s':>8} {'peak RSS, MB':>13} {'decode RSS, MB':>15}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, size in SIZES.items():
+            path = os.path.join(tmp, f"{name}.jpg")
+            with open(path, "wb") as f:
+                f.write(make_photo(size))
+            results = {}
+            for variant, draft in (("full", False), ("draft", True)):
+                r = results[variant] = run_variant(path, draft, args.max_side, args.repeat)
+                print(f"{name:<6} {variant:<8} {r['best_s']:>8.3f} {r['peak_mb']:>13.1f} {r['delta_mb']:>15.1f}")
+            speedup = results["full"]["best_s"] / results["draft"]["best_s"]
+            saved = results["full"]["peak_mb"] - results["draft"]["peak_mb"]
+            print(f"{name:<6} -> x{speedup:.1f} faster, {saved:.0f} MB less peak RSS")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""Бенчмарк усиления контраста/резкости: движки pillow и numpy.
+
+Меряется процессорное время (``time.process_time``) на изображении
+размера после ``load_image`` (длинная сторона 2000px).
+
+    python benchmarks/bench_enhance.py [--repeat 5]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    # config.py требует токены; для бенчмарка хватит заглушек
+    os.environ.setdefault("BOT_TOKEN", "bench")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    sys.path.insert(0, ROOT)
+    from PIL import Image, ImageChops
+    from src.mrdoors.enhance import BACKENDS
+
+    sample = Image.open(os.path.join(ROOT, "tests", "assets", "schema_sample.jpg")).convert("RGB")
+    img = sample.resize((2000, 1400), Image.LANCZOS)
+    img = ImageChops.add(img, Image.merge("RGB", [Image.effect_noise(img.size, 8)] * 3), 1, -128)
+
+    timings = {}
+    for name, backend in BACKENDS.items():
+        backend(img)  # прогрев
+        best = float("inf")
+        for _ in range(args.repeat):
+            started = time.process_time()
+            backend(img)
+            best = min(best, time.process_time() - started)
+        timings[name] = best
+        print(f"{name:<7} {best * 1000:8.1f} ms CPU")
+    print(f"numpy / pillow: x{timings['pillow'] / timings['numpy']:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+"""Бенчмарк препроцессинга по стадиям на синтетических чертежах.
+
+Чертёж с цифрами, линиями и рамками генерируется детерминированно в
+нескольких разрешениях и сжимается как снимок с камеры. Для каждого
+разрешения в отдельном процессе (пиковый RSS не смешивается) меряются
+стадии ``render_tiles`` по отдельности — decode, resize, enhance, layout,
+crop, resize тайлов, encode, base64 — и весь ``preprocess_and_tile``
+целиком, а также пиковый RSS, число и размер тайлов.
+
+Результат сохраняется в JSON (по умолчанию ``benchmarks/results/<commit>.json``);
+``--compare`` сравнивает с прошлым прогоном и завершается с кодом 1, если
+время стадии или размер тайлов выросли больше допуска.
+
+    python benchmarks/bench_pipeline.py [--sizes 3MP,12MP,48MP] [--repeat 3]
+    python benchmarks/bench_pipeline.py --compare benchmarks/results/<commit>.json
+"""
+
+import argparse
+import base64
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+from bench_decode import ROOT, _import_utils
+
+SIZES = {"3MP": (2000, 1500), "12MP": (4000, 3000), "48MP": (8000, 6000)}
+STAGES = ("decode", "resize", "enhance", "layout", "crop", "scale", "encode", "base64")
+# Метрики, по которым ищутся регрессии (больше — хуже)
+TIME_METRICS = STAGES + ("total",)
+SIZE_METRICS = ("tile_bytes",)
+# Абсолютный прирост времени стадии, который ещё считается шумом, секунды
+NOISE_S = 0.02
+
+
+def make_schematic(size, numbers: int = 120, seed: int = 0) -> bytes:
+    """Чертёж замера: контуры, размерные линии и числа на шумной «бумаге», JPEG q92."""
+    from PIL import Image, ImageChops, ImageDraw, ImageFont
+
+    rnd = random.Random(seed)
+    w, h = size
+    unit = max(w, h) / 2000
+    paper = ImageChops.add(Image.new("L", size, 205), Image.effect_noise(size, 6), 1, -128).convert("RGB")
+    draw = ImageDraw.Draw(paper)
+    font = ImageFont.load_default(size=max(12, int(36 * unit)))
+    line = max(1, int(3 * unit))
+    for _ in range(12):
+        x0, y0 = rnd.randrange(w // 10, w // 2), rnd.randrange(h // 10, h // 2)
+        draw.rectangle((x0, y0, x0 + rnd.randrange(w // 8, w // 3), y0 + rnd.randrange(h // 8, h // 3)),
+                       outline=(30, 30, 30), width=line)
+    for _ in range(numbers):
+        x, y = rnd.randrange(w // 20, w - w // 10), rnd.randrange(h // 20, h - h // 20)
+        draw.line((x, y + int(44 * unit), x + int(160 * unit), y + int(44 * unit)), fill=(50, 50, 50), width=line)
+        text = str(rnd.choice([rnd.randrange(10, 3000), round(rnd.uniform(1, 99), 1)]))
+        draw.text((x, y), text, fill=(rnd.randrange(0, 40),) * 3, font=font)
+    buf = BytesIO()
+    paper.save(buf, format="JPEG", quality=92)
+    return buf.getvalue()
+
+
+def _stages(utils, data: bytes, params: dict) -> dict:
+    """Один проход конвейера ``render_tiles`` с замером каждой стадии, секунды."""
+    from PIL import Image
+    from src.mrdoors.encoding import encode_tile
+    from src.mrdoors.enhance import enhance
+    from src.mrdoors.sizing import plan_tile
+    from src.mrdoors.tiling import adaptive_layout, grid_layout, ink_box, ink_pixels, with_overlap
+
+    spent = dict.fromkeys(STAGES, 0.0)
+    tiles = []
+
+    def timed(stage, fn, *args, **kwargs):
+        started = time.perf_counter()
+        result = fn(*args, **kwargs)
+        spent[stage] += time.perf_counter() - started
+        return result
+
+    def decode():
+        img = Image.open(BytesIO(data))
+        w, h = img.size
+        k = max(w, h) / params["max_side"] if max(w, h) > params["max_side"] else 1.0
+        if k > 1.0:
+            img.draft("RGB", (int(w / k), int(h / k)))
+        return img.convert("RGB"), k, (int(w / k), int(h / k))
+
+    # Те же шаги, что в utils.load_image и utils.render_image_tiles
+    img, k, size = timed("decode", decode)
+    if k > 1.0:
+        img = timed("resize", img.resize, size, Image.LANCZOS, reducing_gap=3.0)
+    img = timed("enhance", enhance, img)
+
+    def layout():
+        if params.get("layout") == "adaptive":
+            plan = adaptive_layout(img, params["target_side"], params["max_tiles"])
+        else:
+            plan = grid_layout(img.size, params["cols"], params["rows"])
+        return with_overlap(plan, params["overlap"])
+
+    def crop(rect):
+        tile = img.crop(rect)
+        if params["min_ink"] > 0 and ink_pixels(tile) < params["min_ink"]:
+            return None, None
+        box = ink_box(tile)
+        if box is not None:
+            box = (rect[0] + box[0], rect[1] + box[1], rect[0] + box[2], rect[1] + box[3])
+        sizing = plan_tile(rect, box, params["min_scale"])
+        if sizing.rect != rect:
+            tile = img.crop(sizing.rect)
+        utils.signature(tile)
+        return tile, sizing
+
+    for rect in timed("layout", layout).rects:
+        tile, sizing = timed("crop", crop, rect)
+        if tile is None:
+            continue
+        tile = timed("scale", tile.resize, sizing.size, Image.LANCZOS)
+        encoded = timed("encode", encode_tile, tile, params["min_ssim"], params["max_bytes"])
+        timed("base64", base64.b64encode, encoded.data)
+        tiles.append(len(encoded.data))
+    return {"stages": spent, "tiles": tiles}
+
+
+def _status_kb(field: str) -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    raise KeyError(field)
+
+
+def _reset_peak_rss() -> int:
+    """Сбросить пиковый RSS процесса (Linux) и вернуть текущий RSS, КБ.
+
+    Без сброса пик остался бы от импортов и прогрева, и прирост от
+    конвейера был бы не виден. Где сброс недоступен — текущий пик.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return _status_kb("VmRSS")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _peak_rss() -> int:
+    try:
+        return _status_kb("VmHWM")
+    except (OSError, KeyError):
+        # ru_maxrss в Linux — килобайты
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def child(path: str, repeat: int):
+    utils = _import_utils()
+    from src.mrdoors.recognition import TILING
+
+    with open(path, "rb") as f:
+        data = f.read()
+    params = {"cols": 2, "rows": 3, **TILING}
+    # Прогрев: ленивые импорты кодеков и движка препроцессинга не должны попадать в замер
+    for tile in utils.preprocess_and_tile(data, **TILING).tiles:
+        tile.release()
+    baseline = _reset_peak_rss()
+
+    best = dict.fromkeys(TIME_METRICS, float("inf"))
+    for _ in range(repeat):
+        run = _stages(utils, data, params)
+        for stage, spent in run["stages"].items():
+            best[stage] = min(best[stage], spent)
+        started = time.perf_counter()
+        tiles = utils.preprocess_and_tile(data, **TILING).tiles
+        best["total"] = min(best["total"], time.perf_counter() - started)
+        for tile in tiles:
+            tile.release()
+    peak = _peak_rss()
+    sizes = run["tiles"]
+    print(json.dumps({
+        "input_bytes": len(data),
+        "time_s": best,
+        "peak_rss_mb": peak / 1024,
+        "pipeline_rss_mb": (peak - baseline) / 1024,
+        "tiles": len(sizes),
+        "tile_bytes": sum(sizes),
+        "tile_max_bytes": max(sizes, default=0),
+        "base64_bytes": sum(4 * ((n + 2) // 3) for n in sizes),
+    }))
+
+
+def run_size(path: str, repeat: int) -> dict:
+    out = subprocess.run([sys.executable, __file__, "--child", path, "--repeat", str(repeat)],
+                         check=True, capture_output=True, text=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def _commit() -> str:
+    def git(*args):
+        return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+
+    commit = git("rev-parse", "--short", "HEAD") or "unknown"
+    return commit + ("-dirty" if git("status", "--porcelain", "--untracked-files=no") else "")
+
+
+def measure(sizes, repeat: int) -> dict:
+    import PIL
+
+    report = {
+        "commit": _commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "cpus": os.cpu_count(),
+        "repeat": repeat,
+        "results": {},
+    }
+    print(f"{'input':<6} {'total, s':>9} " + " ".join(f"{s:>8}" for s in STAGES)
+          + f" {'RSS, MB':>8} {'tiles':>5} {'KB':>7}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in sizes:
+            path = os.path.join(tmp, f"{name}.jpg")
+            with open(path, "wb") as f:
+                f.write(make_schematic(SIZES[name]))
+            r = report["results"][name] = run_size(path, repeat)
+            t = r["time_s"]
+            print(f"{name:<6} {t['total']:>9.3f} " + " ".join(f"{t[s]:>8.3f}" for s in STAGES)
+                  + f" {r['pipeline_rss_mb']:>8.1f} {r['tiles']:>5} {r['tile_bytes'] / 1024:>7.1f}")
+    return report
+
+
+def compare(base: dict, head: dict, tolerance: float) -> bool:
+    """Напечатать изменения относительно ``base``; ``False``, если есть регрессия."""
+    ok = True
+    print(f"\n{base['commit']} -> {head['commit']} (допуск {tolerance:.0%})")
+    for name, now in head["results"].items():
+        before = base["results"].get(name)
+        if before is None:
+            continue
+        rows = [(m, before["time_s"][m], now["time_s"][m]) for m in TIME_METRICS if m in before["time_s"]]
+        rows += [(m, before[m], now[m]) for m in SIZE_METRICS + ("pipeline_rss_mb",) if m in before]
+        for metric, old, new in rows:
+            change = (new - old) / old if old else 0.0
+            # Прирост в пределах NOISE_S — шум таймера, а не регрессия
+            noise = metric in TIME_METRICS and new - old < NOISE_S
+            regressed = change > tolerance and not noise and metric != "pipeline_rss_mb"
+            ok = ok and not regressed
+            flag = "  REGRESSION" if regressed else ""
+            print(f"{name:<6} {metric:<16} {old:>12.4f} -> {new:>12.4f} {change:>+8.1%}{flag}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default=",".join(SIZES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="куда сохранить JSON (по умолчанию benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--child")
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.repeat)
+        return
+
+    report = measure([s for s in args.sizes.split(",") if s], args.repeat)
+    output = args.output or os.path.join(ROOT, "benchmarks", "results", f"{report['commit']}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"saved {output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            base = json.load(f)
+        if not compare(base, report, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""Бенчмарк пула препроцессинга: фото/с в потоках против пула процессов.
+
+Синтетические 12 Мп снимки прогоняются через ``preprocess_and_tile`` из
+``--threads`` потоков (как обработчики telebot) и через ``PreprocessPool``
+с 1..N процессами. Прирост ограничен числом ядер машины.
+
+    python benchmarks/bench_prepool.py [--photos 12] [--threads 4]
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bench_decode import SIZES, _import_utils, make_photo
+
+PARAMS = {"max_side": 2000, "cols": 2, "rows": 3, "min_ink": 8}
+
+
+def throughput(render, photos, threads: int) -> float:
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(lambda data: render(data, **PARAMS), photos))
+    return len(photos) / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--photos", type=int, default=12)
+    parser.add_argument("--threads", type=int, default=4)
+    args = parser.parse_args()
+
+    utils = _import_utils()
+    from src.mrdoors.prepool import PreprocessPool
+
+    photo = make_photo(SIZES["12MP"])
+    photos = [photo] * args.photos
+    print(f"cpus: {os.cpu_count()}, photos: {args.photos}, client threads: {args.threads}")
+    base = throughput(utils.preprocess_and_tile, photos, args.threads)
+    print(f"{'threads (GIL)':<16} {base:>6.2f} photo/s")
+    for workers in range(1, (os.cpu_count() or 1) + 1):
+        pool = PreprocessPool(workers=workers, max_pending=args.threads, timeout=600)
+        pool.start()
+        try:
+            rate = throughput(pool.render, photos, args.threads)
+        finally:
+            pool.shutdown()
+        print(f"{f'pool x{workers}':<16} {rate:>6.2f} photo/s  (x{rate / base:.2f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,17 @@
 #!/usr/bin/env python3
-"""Точка входа для MrDoors бота."""
+"""Точка входа для MrDoors бота.
 
-from src.mrdoors.bot import run_bot
+Режим выбирается переменной BOT_RUNTIME (sync/async) или флагом --async.
+"""
+
+import sys
+
+from src.mrdoors.config import BOT_RUNTIME
 
 if __name__ == "__main__":
-    run_bot()
+    if "--async" in sys.argv[1:] or BOT_RUNTIME == "async":
+        from src.mrdoors.async_bot import run_async_bot
+        run_async_bot()
+    else:
+        from src.mrdoors.bot import run_bot
+        run_bot()
@@ -0,0 +1,69 @@
+"""Сборка фото одного альбома (media group) в общий пакет.
+
+Telegram присылает каждое фото альбома отдельным сообщением с общим
+``media_group_id``. Коллектор копит их, пока в течение окна ``window``
+не перестанут приходить новые, и отдаёт пакет целиком.
+"""
+
+import logging
+import threading
+from typing import Any, Callable, Dict, List
+
+logger = logging.getLogger(__name__)
+
+# Telegram ограничивает альбом 10 медиафайлами
+MAX_ALBUM_SIZE = 10
+
+
+class MediaGroupCollector:
+    """Копит сообщения с одинаковым ``media_group_id`` и сбрасывает их пачкой."""
+
+    def __init__(self, window: float, on_flush: Callable[[List[Any]], None], max_items: int = MAX_ALBUM_SIZE):
+        self.window = window
+        self.on_flush = on_flush
+        self.max_items = max_items
+        self._lock = threading.Lock()
+        self._groups: Dict[str, List[Any]] = {}
+        self._timers: Dict[str, threading.Timer] = {}
+
+    def add(self, message):
+        """Добавить сообщение альбома. Таймер окна перезапускается."""
+        group_id = message.media_group_id
+        with self._lock:
+            items = self._groups.setdefault(group_id, [])
+            items.append(message)
+            timer = self._timers.pop(group_id, None)
+            if timer is not None:
+                timer.cancel()
+            if len(items) >= self.max_items:
+                # Альбом заполнен — ждать остальных фото незачем
+                delay = 0.0
+            else:
+                delay = self.window
+            timer = threading.Timer(delay, self._flush, args=(group_id,))
+            timer.daemon = True
+            self._timers[group_id] = timer
+            timer.start()
+
+    def _flush(self, group_id: str):
+        with self._lock:
+            self._timers.pop(group_id, None)
+            items = self._groups.pop(group_id, [])
+        if not items:
+            return
+        items.sort(key=lambda m: m.message_id)
+        logger.info(f"Media group {group_id}: flushing {len(items)} photos")
+        try:
+            self.on_flush(items)
+        except Exception as e:
+            logger.exception(f"Media group {group_id} handler failed: {e}")
+
+    def flush_all(self):
+        """Сбросить все незавершённые альбомы (при остановке)."""
+        with self._lock:
+            group_ids = list(self._groups)
+            for timer in self._timers.values():
+                timer.cancel()
+            self._timers.clear()
+        for group_id in group_ids:
+            self._flush(group_id)
@@ -4,6 +4,7 @@ import time
 import json
 import os
 import logging
+import threading
 from datetime import datetime, timezone
 from typing import Dict, Any, Union, Optional, List
 from dataclasses import dataclass
@@ -68,6 +69,8 @@ class RequestAnalytics:
     """Сборщик аналитики запросов."""
 
     def __init__(self):
+        # Запросы к OpenAI идут из нескольких потоков одновременно
+        self._lock = threading.Lock()
         self.lifetime_cost_usd = 0.0
         self.lifetime_requests = 0
         self.lifetime_input_tokens = 0
@@ -111,17 +114,21 @@ class RequestAnalytics:
         self.requests = []
         self.session_start = time.time()
     
-    def add_request(self, stats: RequestStats, extra: Optional[Dict[str, Any]] = None):
-        """Добавить статистику запроса."""
-        self.requests.append(stats)
-        # Обновить пожизненную статистику
-        self.lifetime_cost_usd += stats.cost_usd
-        self.lifetime_requests += 1
-        self.lifetime_input_tokens += stats.input_tokens
-        self.lifetime_output_tokens += stats.output_tokens
-        self.lifetime_duration += stats.duration
-        self.save_lifetime()
+    def _record(self, stats: RequestStats, extra: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Учесть запрос в статистике и собрать событие для сервиса аналитики."""
+        with self._lock:
+            self.requests.append(stats)
+            # Обновить пожизненную статистику
+            self.lifetime_cost_usd += stats.cost_usd
+            self.lifetime_requests += 1
+            self.lifetime_input_tokens += stats.input_tokens
+            self.lifetime_output_tokens += stats.output_tokens
+            self.lifetime_duration += stats.duration
+            self.save_lifetime()
+        return self._payload(stats, extra)
 
+    @staticmethod
+    def _payload(stats: RequestStats, extra: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         payload = {
             "request_id": stats.request_id or str(int(time.time() * 1000)),
             "originated_at": datetime.fromtimestamp(stats.originated_at or time.time(), tz=timezone.utc).isoformat(),
@@ -141,12 +148,31 @@ class RequestAnalytics:
         }
         if extra:
             payload.update(extra)
+        return payload
 
+    def add_request(self, stats: RequestStats, extra: Optional[Dict[str, Any]] = None):
+        """Добавить статистику запроса."""
+        payload = self._record(stats, extra)
         try:
             analytics_client.send_event(payload)
         except Exception as exc:  # noqa: BLE001
             logger.warning("Failed to send analytics event: %s", exc)
-    
+
+    def add_event(self, stats: RequestStats, extra: Optional[Dict[str, Any]] = None):
+        """Отправить служебное событие (не запрос к OpenAI) — в статистику сессии оно не входит."""
+        try:
+            analytics_client.send_event(self._payload(stats, extra))
+        except Exception as exc:  # noqa: BLE001
+            logger.warning("Failed to send analytics event: %s", exc)
+
+    async def add_request_async(self, stats: RequestStats, extra: Optional[Dict[str, Any]] = None):
+        """Добавить статистику запроса, не блокируя event loop отправкой события."""
+        payload = self._record(stats, extra)
+        try:
+            await analytics_client.send_event_async(payload)
+        except Exception as exc:  # noqa: BLE001
+            logger.warning("Failed to send analytics event: %s", exc)
+
     def get_session_summary(self) -> Dict[str, Any]:
         """Получить сводку по текущей сессии."""
         if not self.requests:
@@ -219,26 +245,48 @@ class AnalyticsClient:
         self.base_url = base_url.rstrip("/") if base_url else ""
         self.token = token
         self._client: Optional[httpx.Client] = None
+        self._async_client: Optional[httpx.AsyncClient] = None
 
     def _get_client(self) -> httpx.Client:
         if not self._client:
             self._client = httpx.Client(base_url=self.base_url, timeout=5.0)
         return self._client
 
+    def _get_async_client(self) -> httpx.AsyncClient:
+        if not self._async_client:
+            self._async_client = httpx.AsyncClient(base_url=self.base_url, timeout=5.0)
+        return self._async_client
+
+    def _headers(self) -> Dict[str, str]:
+        headers = {}
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        return headers
+
     def close(self):
         if self._client:
             self._client.close()
             self._client = None
 
+    async def aclose(self):
+        if self._async_client:
+            await self._async_client.aclose()
+            self._async_client = None
+
     @retry(wait=wait_exponential(multiplier=0.4, min=0.5, max=5), stop=stop_after_attempt(3))
     def send_event(self, payload: Dict[str, Any]):
         if not self.enabled:
             return
-        headers = {}
-        if self.token:
-            headers["Authorization"] = f"Bearer {self.token}"
         client = self._get_client()
-        response = client.post("/api/v1/ingestion/events", json=payload, headers=headers)
+        response = client.post("/api/v1/ingestion/events", json=payload, headers=self._headers())
+        response.raise_for_status()
+
+    @retry(wait=wait_exponential(multiplier=0.4, min=0.5, max=5), stop=stop_after_attempt(3))
+    async def send_event_async(self, payload: Dict[str, Any]):
+        if not self.enabled:
+            return
+        client = self._get_async_client()
+        response = await client.post("/api/v1/ingestion/events", json=payload, headers=self._headers())
         response.raise_for_status()
 
 
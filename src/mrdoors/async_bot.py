@@ -0,0 +1,335 @@
+"""Асинхронный вариант бота: AsyncTeleBot + AsyncOpenAI на одном event loop."""
+
+import asyncio
+import time
+import logging
+from dataclasses import replace
+from typing import Callable, List, Optional, Union
+
+from telebot import asyncio_helper
+from telebot.util import smart_split
+from telebot.async_telebot import AsyncTeleBot
+from openai import AsyncOpenAI
+
+from .config import (
+    BOT_TOKEN, OPENAI_API_KEY, OPENAI_TIMEOUT, OPENAI_RETRIES, TILE_CONCURRENCY, OPENAI_MAX_CONCURRENCY,
+    TILES_PER_REQUEST, BOT_INTAKE, DOCUMENT_MAX_MB, DOCUMENT_MAX_PAGES,
+)
+from .utils import Tile, TileSet, ask_openai_for_numbers_async, ask_openai_for_tiles_async
+from .cache import AsyncSingleFlight, cache_key, recognition_cache
+from .analytics import analytics, analytics_client
+from .recognition import (
+    TILING, TileResult, PhotoError, PhotoOutcome, group_jobs, prepare_tiles, lookup_cached, store_cached,
+)
+from .ratelimit import rate_limiter
+from .breaker import breakers
+from .prepool import preprocess_pool
+from .bot import setup_logging, format_result_message, format_document_message
+from .documents import SpooledDocument, TOO_LARGE, is_supported, page_count, prepare_page_tiles, spool_document
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncTypingIndicator:
+    """Индикатор печати в виде задачи event loop вместо отдельного потока."""
+
+    def __init__(self, bot_instance: AsyncTeleBot, chat_id: int, interval_seconds: float = 4.0):
+        self.bot = bot_instance
+        self.chat_id = chat_id
+        self.interval = interval_seconds
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.bot.send_chat_action(self.chat_id, 'typing')
+            except Exception as e:
+                logger.debug(f"typing emit failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def __aenter__(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+
+class AsyncTileExecutor:
+    """Асинхронный аналог ``TileExecutor`` на семафорах asyncio."""
+
+    def __init__(self, max_concurrency: int = OPENAI_MAX_CONCURRENCY, per_photo: int = TILE_CONCURRENCY,
+                 tiles_per_request: int = TILES_PER_REQUEST):
+        self.per_photo = max(1, per_photo)
+        self.tiles_per_request = max(0, tiles_per_request)
+        self._global = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def _run_tile(self, tile: Tile, req_id: str, client: AsyncOpenAI,
+                        photo_limit: asyncio.Semaphore) -> TileResult:
+        result = TileResult(index=tile.index, req_id=req_id, rect=tile.rect)
+        async with photo_limit, self._global:
+            try:
+                result.numbers = await ask_openai_for_numbers_async(
+                    tile.payload,
+                    f"{req_id}#t{tile.index}",
+                    client,
+                    collected=result.stats,
+                    phash=tile.phash,
+                    positions=result.positions,
+                    image_info=tile.image_info,
+                )
+            except Exception as e:
+                logger.warning(f"[{req_id}] Tile {tile.index} failed: {e}")
+                result.error = str(e)
+            finally:
+                # Тайл отправлен — буфер изображения больше не нужен
+                tile.release()
+        return result
+
+    async def _run_group(self, tiles: List[Tile], req_id: str, client: AsyncOpenAI,
+                         photo_limit: asyncio.Semaphore) -> List[TileResult]:
+        if len(tiles) == 1:
+            return [await self._run_tile(tiles[0], req_id, client, photo_limit)]
+        results = [TileResult(index=tile.index, req_id=req_id, rect=tile.rect) for tile in tiles]
+        async with photo_limit, self._global:
+            try:
+                answers = await ask_openai_for_tiles_async(tiles, req_id, client)
+                for result, answer in zip(results, answers):
+                    result.numbers, result.positions, result.stats = answer
+            except Exception as e:
+                logger.warning(f"[{req_id}] Tiles {[t.index for t in tiles]} failed: {e}")
+                for result in results:
+                    result.error = str(e)
+            finally:
+                for tile in tiles:
+                    tile.release()
+        return results
+
+    async def recognize(self, tiles: List[Tile], req_id: str, client: AsyncOpenAI) -> List[TileResult]:
+        """Распознать тайлы фото. Результаты возвращаются в порядке тайлов."""
+        photo_limit = asyncio.Semaphore(self.per_photo)
+        groups = group_jobs([(req_id, tile) for tile in tiles], self.tiles_per_request)
+        done = await asyncio.gather(*(
+            self._run_group([tiles[pos] for pos in group], req_id, client, photo_limit) for group in groups
+        ))
+        return [result for results in done for result in results]
+
+
+def create_async_bot():
+    """Создание и настройка асинхронного бота."""
+    logger = setup_logging()
+
+    bot = AsyncTeleBot(BOT_TOKEN, parse_mode=None)
+    # Увеличим таймауты HTTP для Telegram API
+    asyncio_helper.REQUEST_TIMEOUT = 60
+
+    client = AsyncOpenAI(api_key=OPENAI_API_KEY, timeout=OPENAI_TIMEOUT, max_retries=OPENAI_RETRIES)
+    executor = AsyncTileExecutor()
+    flights = AsyncSingleFlight()
+
+    async def recognize_prepared(data: Union[bytes, str], prepare: Callable[[], TileSet], req_id: str) -> PhotoOutcome:
+        """Как ``recognition.recognize_prepared``: кэш и схлопывание одновременных запросов одного фото."""
+        loop = asyncio.get_running_loop()
+        # Кэш распознавания — запросы к SQLite, с event loop их уводим так же, как препроцессинг
+        hit = await loop.run_in_executor(None, lookup_cached, data, req_id)
+        if hit is not None:
+            return hit
+
+        async def run() -> PhotoOutcome:
+            # Препроцессинг — CPU-работа, уводим её с event loop (и в пул процессов, если он включён)
+            tiles, planned = await loop.run_in_executor(None, prepare)
+            results = await executor.recognize(tiles, req_id, client)
+            outcome = PhotoOutcome.from_results(results, len(tiles), planned - len(tiles))
+            await loop.run_in_executor(None, store_cached, data, req_id, outcome)
+            return outcome
+
+        if recognition_cache is None:
+            return await run()
+        outcome, shared = await flights.do(cache_key(data, **TILING), run)
+        if shared:
+            logger.info(f"[{req_id}] Reused result of a concurrent request for the same photo")
+            return replace(outcome, cost_usd=0.0, cached=True)
+        return outcome
+
+    @bot.message_handler(commands=['start'])
+    async def send_welcome(message):
+        await bot.reply_to(message, "Привет! Отправь фото схемы замера — найду на ней числа (OpenAI Vision).")
+
+    @bot.message_handler(commands=['stats'])
+    async def send_stats(message):
+        summary = analytics.get_session_summary()
+        formatted = analytics.format_summary(summary)
+        if rate_limiter.enabled:
+            formatted += "\n⏳ Очередь OpenAI:\n" + (rate_limiter.format_metrics() or "  пусто")
+        health = breakers.format_health()
+        if health:
+            formatted += "\n🩺 Модели:\n" + health
+        await bot.reply_to(message, f"Статистика сессии:\n{formatted}")
+
+    @bot.message_handler(content_types=['photo'])
+    async def handle_photo(message):
+        req_id = f"{message.chat.id}:{message.message_id}"
+        logger.info(f"[{req_id}] Received photo set sizes={len(message.photo)}")
+        await bot.reply_to(message, "Получил фото. Распознаю (подготовка → разбиение → OpenAI)...")
+
+        try:
+            async with AsyncTypingIndicator(bot, message.chat.id):
+                # Самое большое фото
+                file_id = message.photo[-1].file_id
+
+                try:
+                    file_info = await bot.get_file(file_id)
+                    file_path = file_info.file_path
+                    logger.info(f"[{req_id}] TG file_path={file_path}")
+                except Exception as e:
+                    logger.error(f"[{req_id}] Failed to get file info: {e}")
+                    await bot.send_message(message.chat.id, "Ошибка при получении файла. Попробуйте отправить фото еще раз.")
+                    return
+
+                try:
+                    original_bytes = await bot.download_file(file_path)
+                except Exception as e:
+                    logger.error(f"[{req_id}] Failed to download file: {e}")
+                    await bot.send_message(message.chat.id, "Ошибка при получении файла. Попробуйте отправить фото еще раз.")
+                    return
+
+                started = time.time()
+                try:
+                    outcome = await recognize_prepared(
+                        original_bytes, lambda: prepare_tiles(original_bytes, req_id), req_id)
+                except PhotoError as e:
+                    await bot.send_message(message.chat.id, e.user_message)
+                    return
+                total_time = time.time() - started
+
+                if outcome.failed:
+                    logger.error(f"[{req_id}] All tiles failed to process")
+                    await bot.send_message(message.chat.id, "Ошибка при обращении к OpenAI API. Попробуйте позже.")
+                    return
+
+            cents = int(outcome.cost_usd * 100)
+            logger.info(f"[{req_id}] Total time: {total_time:.1f}s, cents: {cents}, cached: {outcome.cached}")
+
+            numbers = outcome.numbers
+            logger.info(f"[{req_id}] Extracted numbers: {numbers}")
+            await bot.send_message(message.chat.id,
+                                   format_result_message(numbers, total_time, cents, cached=outcome.cached))
+            logger.info(f"[{req_id}] Extracted {len(numbers)} numbers from {outcome.successful_tiles}/{outcome.tile_count} "
+                        f"tiles ({outcome.skipped_tiles} blank skipped)")
+
+        except Exception as e:
+            logger.exception(f"[{req_id}] Fatal error while handling photo: {e}")
+            await bot.send_message(message.chat.id, "Произошла неожиданная ошибка. Попробуйте отправить фото еще раз.")
+
+    async def recognize_page(document: SpooledDocument, page: int, req_id: str) -> PhotoOutcome:
+        return await recognize_prepared(document.page_key(page),
+                                        lambda: prepare_page_tiles(document, page, req_id), req_id)
+
+    @bot.message_handler(content_types=['document'],
+                         func=lambda m: is_supported(m.document.mime_type, m.document.file_name))
+    async def handle_document(message):
+        req_id = f"{message.chat.id}:{message.message_id}"
+        doc = message.document
+        logger.info(f"[{req_id}] Received document {doc.mime_type} size={doc.file_size}")
+        if doc.file_size and doc.file_size > DOCUMENT_MAX_MB * 1024 * 1024:
+            await bot.reply_to(message, TOO_LARGE.format(mb=DOCUMENT_MAX_MB))
+            return
+        await bot.reply_to(message, "Получил файл. Распознаю постранично (подготовка → разбиение → OpenAI)...")
+
+        try:
+            async with AsyncTypingIndicator(bot, message.chat.id):
+                try:
+                    file_info = await bot.get_file(doc.file_id)
+                    logger.info(f"[{req_id}] TG file_path={file_info.file_path}")
+                    loop = asyncio.get_running_loop()
+                    # Потоковое скачивание во временный файл — в потоке, чтобы не блокировать event loop
+                    document = await loop.run_in_executor(None, spool_document, bot.token, file_info.file_path)
+                except PhotoError as e:
+                    await bot.send_message(message.chat.id, e.user_message)
+                    return
+                except Exception as e:
+                    logger.error(f"[{req_id}] Failed to download file: {e}")
+                    await bot.send_message(message.chat.id, "Ошибка при получении файла. Попробуйте отправить его еще раз.")
+                    return
+
+                with document:
+                    try:
+                        total_pages = page_count(document.path)
+                    except PhotoError as e:
+                        await bot.send_message(message.chat.id, e.user_message)
+                        return
+                    pages = min(total_pages, max(1, DOCUMENT_MAX_PAGES))
+                    started = time.time()
+                    outcomes: List[Optional[PhotoOutcome]] = []
+                    for page in range(pages):
+                        page_req_id = req_id if total_pages == 1 else f"{req_id}#p{page + 1}"
+                        try:
+                            outcomes.append(await recognize_page(document, page, page_req_id))
+                        except PhotoError as e:
+                            if pages == 1:
+                                await bot.send_message(message.chat.id, e.user_message)
+                                return
+                            outcomes.append(None)
+                    total_time = time.time() - started
+
+                if all(o is None or o.failed for o in outcomes):
+                    logger.error(f"[{req_id}] All document pages failed to process")
+                    await bot.send_message(message.chat.id, "Ошибка при обращении к OpenAI API. Попробуйте позже.")
+                    return
+
+            cents = int(sum(o.cost_usd for o in outcomes if o is not None) * 100)
+            if total_pages == 1:
+                text = format_result_message(outcomes[0].numbers, total_time, cents, cached=outcomes[0].cached)
+            else:
+                sections = [(page + 1, o.numbers if o is not None and not o.failed else None)
+                            for page, o in enumerate(outcomes)]
+                text = format_document_message(sections, total_pages, total_time, cents)
+            for part in smart_split(text):
+                await bot.send_message(message.chat.id, part)
+            logger.info(f"[{req_id}] Document done: {pages} pages, {total_time:.1f}s, cents: {cents}")
+
+        except Exception as e:
+            logger.exception(f"[{req_id}] Fatal error while handling document: {e}")
+            await bot.send_message(message.chat.id, "Произошла неожиданная ошибка. Попробуйте отправить файл еще раз.")
+
+    # Защита от нерелевантных сообщений
+    @bot.message_handler(func=lambda m: True, content_types=['text', 'document', 'video', 'audio', 'sticker'])
+    async def fallback_handler(message):
+        await bot.reply_to(message, "Отправьте, пожалуйста, фото или схему файлом (jpeg/png/tiff/webp/pdf). Команды: /start, /stats.")
+
+    return bot, client, logger
+
+
+async def _run(bot: AsyncTeleBot, client: AsyncOpenAI):
+    try:
+        if BOT_INTAKE == "webhook":
+            from .webhook import run_webhook_async
+            await run_webhook_async(bot, logging.getLogger("mrdoors.bot"))
+        else:
+            # AsyncTeleBot сам перезапускает polling при сетевых ошибках
+            await bot.infinity_polling(timeout=30, request_timeout=60, skip_pending=True)
+    finally:
+        preprocess_pool.shutdown()
+        await client.close()
+        await analytics_client.aclose()
+        await bot.close_session()
+
+
+def run_async_bot():
+    """Запуск асинхронного бота."""
+    bot, client, logger = create_async_bot()
+
+    logger.info("Async bot starting...")
+    if preprocess_pool.enabled:
+        preprocess_pool.start()
+    print("Бот запущен (async)...")
+    asyncio.run(_run(bot, client))
+
+
+if __name__ == "__main__":
+    run_async_bot()
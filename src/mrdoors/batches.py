@@ -0,0 +1,449 @@
+"""Отложенное распознавание через OpenAI Batch API.
+
+Для фото, ответ по которым не нужен сразу (архивные загрузки), запросы
+тайлов пишутся в JSONL и отправляются одним пакетом: Batch API вдвое
+дешевле синхронных запросов, но отвечает в пределах суток. Поток
+``BatchPoller`` опрашивает пакеты и отдаёт готовый результат в чат.
+
+Состояние пакетов хранится в SQLite: после рестарта опрос продолжается, а
+пакеты, которые не успели создать в OpenAI, отправляются заново из
+сохранённого JSONL. Итог фото сохраняется до отправки ответа в чат, так
+что неудачная доставка повторяет только её, без повторного учёта тайлов.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import asdict, dataclass, replace
+from typing import Any, Callable, Dict, List, Optional
+
+from openai import OpenAI
+from openai.types.chat import ChatCompletion
+
+from . import utils
+from .analytics import RequestStats, analytics
+from .cache import cache_key
+from .config import BATCH_STORE_PATH, BATCH_DIR, BATCH_POLL_INTERVAL, BATCH_COMPLETION_WINDOW
+from .recognition import TILING, PhotoOutcome, TileResult, prepare_tiles, store_outcome
+from .tilecache import TileSignature
+
+logger = logging.getLogger(__name__)
+
+# Подпись фото, по которой оно распознаётся отложенно
+DEFERRED_FLAGS = ("/batch", "#batch", "#отложить")
+# Batch API тарифицируется за половину цены синхронных запросов
+BATCH_DISCOUNT = 0.5
+ENDPOINT = "/v1/chat/completions"
+
+CREATED = "created"  # JSONL записан, пакет в OpenAI ещё не создан
+SUBMITTING = "submitting"  # JSONL загружается, пакет создаёт обработчик фото или опрос
+SUBMITTED = "submitted"  # пакет создан, ждём готовности
+COLLECTED = "collected"  # итог сохранён, ответ в чат ещё не доставлен
+DONE = "done"
+# Через сколько секунд отправку считать зависшей (процесс упал посреди загрузки) и начинать заново
+SUBMIT_LEASE = 15 * 60
+# Сколько раз пытаться доставить ответ, прежде чем закрыть запись
+MAX_DELIVERY_ATTEMPTS = 5
+# Ошибки Telegram, которые не исправятся повтором: бот заблокирован, чат недоступен
+PERMANENT_DELIVERY_ERRORS = (400, 403)
+# Статусы пакета в OpenAI, после которых он больше не изменится
+FINAL_STATUSES = ("completed", "expired", "cancelled", "failed")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS batches (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    req_id TEXT NOT NULL UNIQUE,
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER,
+    model TEXT NOT NULL,
+    status TEXT NOT NULL,
+    input_path TEXT NOT NULL,
+    batch_id TEXT,
+    tiles TEXT NOT NULL,
+    skipped INTEGER NOT NULL,
+    cache_key TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    outcome TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS batches_status ON batches (status);
+"""
+# Колонки, добавленные после первой версии схемы
+_ADDED_COLUMNS = {"outcome": "TEXT", "attempts": "INTEGER NOT NULL DEFAULT 0"}
+
+
+def is_deferred(caption: Optional[str]) -> bool:
+    """Подпись фото просит отложенного распознавания."""
+    words = (caption or "").lower().split()
+    return any(flag in words for flag in DEFERRED_FLAGS)
+
+
+@dataclass
+class BatchRecord:
+    """Отложенное фото и его пакет в OpenAI."""
+    id: int
+    req_id: str
+    chat_id: int
+    message_id: Optional[int]
+    model: str
+    status: str
+    input_path: str
+    batch_id: Optional[str]
+    tiles: List[Dict[str, Any]]  # по тайлу: index, rect, phash, image (Tile.image_info)
+    skipped: int
+    cache_key: Optional[str]
+    created_at: float
+    outcome: Optional[PhotoOutcome] = None  # сохранённый итог (статус collected)
+    attempts: int = 0  # неудачных попыток доставки
+
+
+class BatchStore:
+    """Пакеты в файле SQLite; соединение открывается при первом обращении."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        # Вызывается под self._lock
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(batches)")}
+            for name, definition in _ADDED_COLUMNS.items():
+                if name not in columns:
+                    conn.execute(f"ALTER TABLE batches ADD COLUMN {name} {definition}")
+            self._conn = conn
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def add(self, req_id: str, chat_id: int, message_id: Optional[int], model: str, input_path: str,
+            tiles: List[Dict[str, Any]], skipped: int, key: Optional[str]) -> Optional[int]:
+        """Записать новое фото. ``None`` — фото с этим ``req_id`` уже отложено (повтор задания)."""
+        now = time.time()
+        with self._lock:
+            cur = self._connect().execute(
+                "INSERT OR IGNORE INTO batches (req_id, chat_id, message_id, model, status, input_path, tiles, "
+                "skipped, cache_key, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (req_id, chat_id, message_id, model, CREATED, input_path, json.dumps(tiles), skipped, key, now, now),
+            )
+        return cur.lastrowid if cur.rowcount == 1 else None
+
+    def get(self, record_id: int) -> BatchRecord:
+        with self._lock:
+            row = self._connect().execute("SELECT * FROM batches WHERE id = ?", (record_id,)).fetchone()
+        return self._record(row)
+
+    def pending(self) -> List[BatchRecord]:
+        """Фото, по которым ещё не отправлен ответ, в порядке поступления."""
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT * FROM batches WHERE status IN (?, ?, ?, ?) ORDER BY id",
+                (CREATED, SUBMITTING, SUBMITTED, COLLECTED),
+            ).fetchall()
+        return [self._record(row) for row in rows]
+
+    def claim(self, record_id: int, stale_before: float) -> bool:
+        """Атомарно взять запись на отправку: ``created`` или зависшую ``submitting``. ``False`` — её уже отправляют."""
+        with self._lock:
+            cur = self._connect().execute(
+                "UPDATE batches SET status = ?, updated_at = ? WHERE id = ? "
+                "AND (status = ? OR (status = ? AND updated_at < ?))",
+                (SUBMITTING, time.time(), record_id, CREATED, SUBMITTING, stale_before),
+            )
+        return cur.rowcount == 1
+
+    def release(self, record_id: int):
+        """Отправка не удалась — вернуть запись опросу."""
+        self._update(record_id, status=CREATED)
+
+    def mark_submitted(self, record_id: int, batch_id: str):
+        self._update(record_id, status=SUBMITTED, batch_id=batch_id)
+
+    def mark_collected(self, record_id: int, outcome: PhotoOutcome):
+        self._update(record_id, status=COLLECTED, outcome=json.dumps(asdict(outcome)))
+
+    def delivery_failed(self, record_id: int, error: str):
+        with self._lock:
+            self._connect().execute(
+                "UPDATE batches SET attempts = attempts + 1, error = ?, updated_at = ? WHERE id = ?",
+                (error, time.time(), record_id),
+            )
+
+    def finish(self, record_id: int, error: Optional[str] = None):
+        self._update(record_id, status=DONE, error=error)
+
+    def _update(self, record_id: int, **fields: Any):
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            self._connect().execute(
+                f"UPDATE batches SET {columns}, updated_at = ? WHERE id = ?",
+                (*fields.values(), time.time(), record_id),
+            )
+
+    @staticmethod
+    def _record(row: sqlite3.Row) -> BatchRecord:
+        return BatchRecord(
+            id=row["id"], req_id=row["req_id"], chat_id=row["chat_id"], message_id=row["message_id"],
+            model=row["model"], status=row["status"], input_path=row["input_path"], batch_id=row["batch_id"],
+            tiles=json.loads(row["tiles"]), skipped=row["skipped"], cache_key=row["cache_key"],
+            created_at=row["created_at"],
+            outcome=PhotoOutcome(**json.loads(row["outcome"])) if row["outcome"] else None,
+            attempts=row["attempts"],
+        )
+
+
+# Глобальное хранилище пакетов
+batch_store = BatchStore(BATCH_STORE_PATH)
+
+
+def write_requests(path: str, tiles: List[utils.Tile], req_id: str, model: str):
+    """Записать запросы тайлов в JSONL для Batch API (по строке на тайл).
+
+    Тело запроса — то же, что у синхронного вызова (``_vision_request``);
+    data URL строится по одному тайлу за раз.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        for tile in tiles:
+            f.write(json.dumps({
+                "custom_id": f"{req_id}#t{tile.index}",
+                "method": "POST",
+                "url": ENDPOINT,
+                "body": utils._vision_request(model, tile.payload),
+            }, ensure_ascii=False) + "\n")
+
+
+def submit(client: OpenAI, record: BatchRecord, store: BatchStore = batch_store) -> Optional[str]:
+    """Загрузить JSONL и создать пакет в OpenAI. Возвращает id пакета.
+
+    Запись сначала атомарно берётся на отправку (``BatchStore.claim``), так
+    что обработчик фото и опрос не создадут два пакета одного фото;
+    ``None`` — запись уже отправляет другой.
+    """
+    if not store.claim(record.id, time.time() - SUBMIT_LEASE):
+        logger.info(f"[{record.req_id}] Batch is already being submitted")
+        return None
+    try:
+        with open(record.input_path, "rb") as f:
+            uploaded = client.files.create(file=f, purpose="batch")
+        batch = client.batches.create(input_file_id=uploaded.id, endpoint=ENDPOINT,
+                                      completion_window=BATCH_COMPLETION_WINDOW, metadata={"req_id": record.req_id})
+    except BaseException:
+        store.release(record.id)
+        raise
+    store.mark_submitted(record.id, batch.id)
+    logger.info(f"[{record.req_id}] Batch {batch.id} submitted ({len(record.tiles)} tiles)")
+    return batch.id
+
+
+def defer_photo(data: bytes, req_id: str, chat_id: int, message_id: Optional[int], client: OpenAI,
+                store: BatchStore = batch_store) -> Optional[int]:
+    """Подготовить тайлы фото и отправить их пакетом.
+
+    Возвращает число тайлов в пакете (0 — все тайлы пустые, пакет не
+    нужен) или ``None``, если фото уже отложено. Если создать пакет не
+    удалось, запись остаётся в хранилище и отправляется заново при опросе.
+    """
+    tiles, planned = prepare_tiles(data, req_id)
+    if not tiles:
+        return 0
+    model = utils._models_to_try()[0]
+    path = os.path.join(BATCH_DIR, req_id.replace(":", "_") + ".jsonl")
+    try:
+        write_requests(path, tiles, req_id, model)
+        meta = [{"index": t.index, "rect": t.rect, "phash": t.phash.to_json() if t.phash else None, "image": t.image_info} for t in tiles]
+    finally:
+        for tile in tiles:
+            tile.release()
+    record_id = store.add(req_id, chat_id, message_id, model, path, meta, planned - len(tiles),
+                          cache_key(data, **TILING))
+    if record_id is None:
+        logger.info(f"[{req_id}] Photo is already deferred")
+        return None
+    try:
+        submit(client, store.get(record_id), store)
+    except Exception as e:
+        logger.warning(f"[{req_id}] Batch submit failed, will retry on poll: {e}")
+    return len(tiles)
+
+
+def _batch_stats(record: BatchRecord, batch_id: str, line: Dict[str, Any]) -> RequestStats:
+    """Ошибка запроса тайла в пакете — событие аналитики со статусом error."""
+    custom_id = line.get("custom_id") or record.req_id
+    return RequestStats(
+        duration=time.time() - record.created_at,
+        input_tokens=0,
+        output_tokens=0,
+        cost_usd=0.0,
+        model=record.model,
+        request_id=custom_id,
+        **utils._origin(custom_id),
+        status="error",
+        raw_prompt={"mode": "batch", "batch_id": batch_id},
+        error_payload={"error": line.get("error"), "response": line.get("response")},
+        originated_at=record.created_at,
+    )
+
+
+def _tile_result(record: BatchRecord, batch_id: str, tile: Dict[str, Any],
+                 line: Optional[Dict[str, Any]]) -> TileResult:
+    result = TileResult(index=tile["index"], req_id=record.req_id,
+                        rect=tuple(tile["rect"]) if tile["rect"] else None)
+    response = (line or {}).get("response") or {}
+    if line is None:
+        result.error = "no result in batch output"
+        return result
+    if response.get("status_code") != 200:
+        result.error = json.dumps(line.get("error") or response.get("body"), ensure_ascii=False)
+        analytics.add_request(_batch_stats(record, batch_id, line))
+        return result
+
+    custom_id = line["custom_id"]
+    completion = ChatCompletion.model_validate(response["body"])
+    stats, raw = utils._parse_response(completion, record.model, custom_id, record.created_at, tile["image"])
+    # Время — от отправки фото до готовности пакета
+    stats = replace(stats, cost_usd=stats.cost_usd * BATCH_DISCOUNT,
+                    raw_prompt={**stats.raw_prompt, "mode": "batch", "batch_id": batch_id})
+    analytics.add_request(stats, extra=utils._numbers_extra(raw))
+    result.stats.append(stats)
+    found = utils._valid_numbers(raw)
+    result.numbers = [n for n, _ in found]
+    result.positions = [pos for _, pos in found]
+    if found:
+        utils._remember_tile(TileSignature.from_json(tile["phash"]), custom_id, result.numbers)
+    return result
+
+
+def _read_lines(client: OpenAI, file_id: Optional[str]) -> Dict[str, Dict[str, Any]]:
+    if not file_id:
+        return {}
+    text = client.files.content(file_id).text
+    lines = (json.loads(line) for line in text.splitlines() if line.strip())
+    return {line["custom_id"]: line for line in lines}
+
+
+def collect(client: OpenAI, record: BatchRecord) -> Optional[PhotoOutcome]:
+    """Итог фото, если пакет завершён (``None`` — ещё выполняется).
+
+    У истёкшего или отменённого пакета OpenAI отдаёт то, что успел
+    выполнить; остальные тайлы считаются неудачными.
+    """
+    batch = client.batches.retrieve(record.batch_id)
+    if batch.status not in FINAL_STATUSES:
+        return None
+    lines = _read_lines(client, batch.error_file_id)
+    lines.update(_read_lines(client, batch.output_file_id))
+    results = [
+        _tile_result(record, batch.id, tile, lines.get(f"{record.req_id}#t{tile['index']}"))
+        for tile in record.tiles
+    ]
+    outcome = PhotoOutcome.from_results(results, len(record.tiles), record.skipped)
+    logger.info(f"[{record.req_id}] Batch {batch.id} {batch.status}: "
+                f"{outcome.successful_tiles}/{outcome.tile_count} tiles, ${outcome.cost_usd:.4f}")
+    if record.cache_key is not None:
+        store_outcome(record.cache_key, record.req_id, outcome)
+    return outcome
+
+
+def _permanent(error: Exception) -> bool:
+    return getattr(error, "error_code", None) in PERMANENT_DELIVERY_ERRORS
+
+
+class BatchPoller:
+    """Фоновый поток: отправляет неотправленные пакеты и забирает готовые.
+
+    Итог готового пакета сохраняется (статус ``collected``) до вызова
+    ``deliver(record, outcome)``, который отправляет ответ в чат; после
+    доставки запись закрывается, а JSONL удаляется. Если ``deliver`` упал,
+    при следующем опросе повторяется только доставка — до
+    ``MAX_DELIVERY_ATTEMPTS`` раз, а при постоянной ошибке (бот
+    заблокирован) запись закрывается сразу.
+    """
+
+    def __init__(self, client: OpenAI, deliver: Callable[[BatchRecord, PhotoOutcome], None],
+                 store: BatchStore = batch_store, interval: float = BATCH_POLL_INTERVAL):
+        self.client = client
+        self.deliver = deliver
+        self.store = store
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def poll_once(self) -> int:
+        """Один проход по незавершённым фото. Возвращает число доставленных."""
+        delivered = 0
+        for record in self.store.pending():
+            try:
+                if record.status in (CREATED, SUBMITTING):
+                    # Запись, которую сейчас отправляет обработчик фото, submit пропустит
+                    submit(self.client, record, self.store)
+                    continue
+                if record.status == SUBMITTED:
+                    outcome = collect(self.client, record)
+                    if outcome is None:
+                        continue
+                    self.store.mark_collected(record.id, outcome)
+                    record = replace(record, status=COLLECTED, outcome=outcome)
+            except Exception as e:
+                logger.warning(f"[{record.req_id}] Batch poll failed: {e}")
+                continue
+            delivered += self._deliver(record)
+        return delivered
+
+    def _deliver(self, record: BatchRecord) -> bool:
+        """Отправить сохранённый итог в чат. ``True`` — доставлен."""
+        try:
+            self.deliver(record, record.outcome)
+        except Exception as e:
+            attempts = record.attempts + 1
+            if _permanent(e) or attempts >= MAX_DELIVERY_ATTEMPTS:
+                logger.error(f"[{record.req_id}] Giving up batch delivery after {attempts} attempts: {e}")
+                self._close(record, f"delivery failed: {e}")
+            else:
+                logger.warning(f"[{record.req_id}] Batch delivery failed (attempt {attempts}), will retry: {e}")
+                self.store.delivery_failed(record.id, str(e))
+            return False
+        self._close(record, "all tiles failed" if record.outcome.failed else None)
+        return True
+
+    def _close(self, record: BatchRecord, error: Optional[str]):
+        self.store.finish(record.id, error=error)
+        try:
+            os.remove(record.input_path)
+        except OSError:
+            pass
+
+    def _run(self):
+        # Первый проход сразу: после рестарта могли остаться готовые пакеты
+        while True:
+            try:
+                self.poll_once()
+            except Exception as e:
+                logger.warning(f"Batch poll failed: {e}")
+            if self._stop.wait(self.interval):
+                return
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="batch-poller", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
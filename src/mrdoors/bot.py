@@ -2,16 +2,33 @@
 
 import os
 import time
+import signal
 import threading
 import logging
+from functools import partial
 from itertools import groupby
+from typing import Callable, Optional
 from logging.handlers import RotatingFileHandler
 import telebot
-from telebot import apihelper
+from telebot import apihelper, util
 from openai import OpenAI
-from .config import BOT_TOKEN, OPENAI_API_KEY, OPENAI_TIMEOUT, OPENAI_RETRIES, LOG_LEVEL
-from .utils import preprocess_and_tile, ask_openai_for_numbers
+from .config import (
+    BOT_TOKEN, OPENAI_API_KEY, OPENAI_TIMEOUT, OPENAI_RETRIES, LOG_LEVEL,
+    BOT_INTAKE, PROCESSING_MODE, QUEUE_WORKERS, ALBUM_WINDOW, ALBUM_CONCURRENCY,
+    STREAM_REPLIES, STREAM_EDIT_INTERVAL, DOCUMENT_MAX_MB, DOCUMENT_MAX_PAGES,
+)
 from .analytics import analytics
+from .recognition import (
+    PhotoError, RetryableError, PhotoOutcome, recognize_photo, recognize_album, lookup_cached,
+)
+from .ratelimit import rate_limiter
+from .breaker import breakers
+from .prepool import preprocess_pool
+from .jobqueue import JobQueue
+from .albums import MediaGroupCollector
+from .progress import EditThrottle, ProgressiveReply
+from .documents import SpooledDocument, TOO_LARGE, is_supported, page_count, recognize_page, spool_document
+from .batches import BatchPoller, BatchRecord, defer_photo, is_deferred
 def format_numbers_readable(numbers: list[str], per_line: int = 10) -> str:
     """Сформировать компактный и структурированный вывод списка чисел."""
 
@@ -49,8 +66,57 @@ def format_numbers_readable(numbers: list[str], per_line: int = 10) -> str:
     return "\n".join(lines)
 
 
+def sort_numbers(numbers) -> list[str]:
+    """Порядок вывода: сначала короткие, внутри — лексикографически."""
+    return sorted(numbers, key=lambda x: (len(x), x))
+
+
+def format_result_message(numbers: list[str], total_time: float, cents: int, cached: bool = False) -> str:
+    """Итоговый ответ пользователю со сводкой времени и стоимости."""
+    if numbers:
+        response_text = "Нашел следующие числа на схеме:\n\n" + format_numbers_readable(numbers)
+    else:
+        response_text = "К сожалению, не смог найти числа на этом изображении."
+    response_text += f"\n\nЗатрачено времени: {total_time:.1f} сек, затрата: {cents} центов"
+    if cached:
+        response_text += " (это фото уже распознавалось, результат из кэша)"
+    return response_text
+
+
+def format_album_message(sections: list[tuple[int, Optional[list[str]]]], total_time: float, cents: int) -> str:
+    """Общий ответ по альбому: числа по каждому фото и сводка времени и стоимости."""
+    return _format_sections(f"Альбом: {len(sections)} фото.", "Фото", sections, total_time, cents)
+
+
+def format_document_message(sections: list[tuple[int, Optional[list[str]]]], total_pages: int,
+                            total_time: float, cents: int) -> str:
+    """Общий ответ по многостраничному документу: числа по страницам."""
+    title = f"Документ: {total_pages} стр."
+    if total_pages > len(sections):
+        title += f" Распознаны первые {len(sections)}."
+    return _format_sections(title, "Страница", sections, total_time, cents)
+
+
+def _format_sections(title: str, label: str, sections: list[tuple[int, Optional[list[str]]]],
+                     total_time: float, cents: int) -> str:
+    parts = [title]
+    for number, numbers in sections:
+        if numbers is None:
+            body = "не удалось обработать изображение"
+        elif numbers:
+            body = format_numbers_readable(numbers)
+        else:
+            body = "числа не найдены"
+        parts.append(f"{label} {number}:\n{body}")
+    parts.append(f"Затрачено времени: {total_time:.1f} сек, затрата: {cents} центов")
+    return "\n\n".join(parts)
+
+
 logger = logging.getLogger(__name__)
 
+# Общий для процесса учёт правок сообщений по чатам
+edit_throttle = EditThrottle(STREAM_EDIT_INTERVAL)
+
 
 class TypingIndicator:
     """Индикатор печати для Telegram бота."""
@@ -100,16 +166,362 @@ def setup_logging():
     return logger
 
 
-def create_bot():
-    """Создание и настройка бота."""
-    logger = setup_logging()
-    
+def download_photo(bot: telebot.TeleBot, file_id: str, req_id: str) -> bytes:
+    """Скачать фото из Telegram."""
+    logger = logging.getLogger("mrdoors.bot")
+    try:
+        file_info = bot.get_file(file_id)
+        file_path = file_info.file_path
+        logger.info(f"[{req_id}] TG file_path={file_path}")
+    except Exception as e:
+        logger.error(f"[{req_id}] Failed to get file info: {e}")
+        raise PhotoError("Ошибка при получении файла. Попробуйте отправить фото еще раз.", retryable=True) from e
+
+    try:
+        return bot.download_file(file_path)
+    except Exception as e:
+        logger.error(f"[{req_id}] Failed to download file: {e}")
+        raise PhotoError("Ошибка при получении файла. Попробуйте отправить фото еще раз.", retryable=True) from e
+
+
+def download_document(bot: telebot.TeleBot, file_id: str, req_id: str) -> SpooledDocument:
+    """Скачать документ из Telegram во временный файл (не в память)."""
+    logger = logging.getLogger("mrdoors.bot")
+    try:
+        file_info = bot.get_file(file_id)
+        file_path = file_info.file_path
+        logger.info(f"[{req_id}] TG file_path={file_path} size={file_info.file_size}")
+    except Exception as e:
+        logger.error(f"[{req_id}] Failed to get file info: {e}")
+        raise PhotoError("Ошибка при получении файла. Попробуйте отправить его еще раз.", retryable=True) from e
+
+    try:
+        return spool_document(bot.token, file_path)
+    except PhotoError:
+        raise
+    except Exception as e:
+        logger.error(f"[{req_id}] Failed to download file: {e}")
+        raise PhotoError("Ошибка при получении файла. Попробуйте отправить его еще раз.", retryable=True) from e
+
+
+def retry_or_reply(retry: bool, error: PhotoError, reply: Callable[[str], None]):
+    """Временную ошибку задания, у которого остались попытки, отдать воркеру на повтор, иначе ответить."""
+    if retry and error.retryable:
+        raise RetryableError(error.user_message) from error
+    reply(error.user_message)
+
+
+def format_progress_message(numbers: list[str], done: int, total: int) -> str:
+    """Промежуточный ответ, пока распознаются оставшиеся тайлы."""
+    text = f"Распознаю... готово частей: {done}/{total}"
+    if numbers:
+        text += "\n\nУже нашел:\n" + format_numbers_readable(numbers)
+    return text
+
+
+def process_photo(bot: telebot.TeleBot, client: OpenAI, chat_id: int, file_id: str, req_id: str,
+                  status_message_id: Optional[int] = None, retry: bool = False):
+    """Скачать фото, распознать числа по тайлам и отправить ответ в чат.
+
+    Если передан ``status_message_id`` и включён ``STREAM_REPLIES``, ответ
+    не отправляется новым сообщением, а дописывается в статусное сообщение
+    по мере готовности тайлов. С ``retry=True`` (задание очереди с
+    оставшимися попытками) временные ошибки не отвечаются, а пробрасываются
+    как ``RetryableError``.
+    """
+    logger = logging.getLogger("mrdoors.bot")
+    progressive = None
+    if STREAM_REPLIES and status_message_id is not None:
+        progressive = ProgressiveReply(bot, chat_id, status_message_id, edit_throttle)
+
+    def reply(text: str):
+        if progressive is not None:
+            progressive.finish(text)
+        else:
+            bot.send_message(chat_id, text)
+
+    try:
+        with TypingIndicator(bot, chat_id):
+            try:
+                data = download_photo(bot, file_id, req_id)
+            except PhotoError as e:
+                retry_or_reply(retry, e, reply)
+                return
+
+            numbers_set = set()
+            done = 0
+
+            def on_progress(result, total):
+                nonlocal done
+                done += 1
+                numbers_set.update(result.numbers)
+                if progressive is not None and done < total:
+                    progressive.update(format_progress_message(sort_numbers(numbers_set), done, total))
+
+            started = time.time()
+            try:
+                outcome = recognize_photo(data, req_id, client, on_progress=on_progress)
+            except PhotoError as e:
+                retry_or_reply(retry, e, reply)
+                return
+            total_time = time.time() - started
+
+            if outcome.failed:
+                logger.error(f"[{req_id}] All tiles failed to process")
+                if retry:
+                    raise RetryableError("all tiles failed")
+                reply("Ошибка при обращении к OpenAI API. Попробуйте позже.")
+                return
+
+        # Время — по часам (тайлы идут параллельно), стоимость — по тайлам этого фото
+        cents = int(outcome.cost_usd * 100)
+        logger.info(f"[{req_id}] Total time: {total_time:.1f}s, cents: {cents}, cached: {outcome.cached}")
+
+        numbers = outcome.numbers
+        logger.info(f"[{req_id}] Extracted numbers: {numbers}")
+        reply(format_result_message(numbers, total_time, cents, cached=outcome.cached))
+        tiles_info = f"{outcome.successful_tiles}/{outcome.tile_count} tiles ({outcome.skipped_tiles} blank skipped)"
+        if numbers:
+            logger.info(f"[{req_id}] Successfully extracted {len(numbers)} numbers from {tiles_info}")
+        else:
+            logger.warning(f"[{req_id}] No numbers found after processing {tiles_info}")
+
+    except RetryableError:
+        raise
+    except Exception as e:
+        if retry:
+            raise RetryableError(f"unexpected error: {e}") from e
+        logger.exception(f"[{req_id}] Fatal error while handling photo: {e}")
+        bot.send_message(chat_id, "Произошла неожиданная ошибка. Попробуйте отправить фото еще раз.")
+
+
+def process_deferred(bot: telebot.TeleBot, client: OpenAI, chat_id: int, file_id: str, req_id: str,
+                     message_id: Optional[int] = None, retry: bool = False):
+    """Скачать фото и отправить его тайлы в Batch API; ответ придёт от ``BatchPoller``.
+
+    Фото, которое уже есть в кэше распознавания, отвечается сразу. С ``retry``
+    повторяются только ошибки скачивания: после отправки пакета повтор
+    создал бы его дубликат.
+    """
+    logger = logging.getLogger("mrdoors.bot")
+    try:
+        data = download_photo(bot, file_id, req_id)
+        cached = lookup_cached(data, req_id)
+        if cached is not None:
+            bot.send_message(chat_id, format_result_message(cached.numbers, 0.0, 0, cached=True))
+            return
+        count = defer_photo(data, req_id, chat_id, message_id, client)
+    except PhotoError as e:
+        retry_or_reply(retry, e, lambda text: bot.send_message(chat_id, text))
+        return
+    except Exception as e:
+        logger.exception(f"[{req_id}] Fatal error while deferring photo: {e}")
+        bot.send_message(chat_id, "Произошла неожиданная ошибка. Попробуйте отправить фото еще раз.")
+        return
+
+    if count == 0:
+        bot.send_message(chat_id, format_result_message([], 0.0, 0))
+    elif count is not None:
+        logger.info(f"[{req_id}] Deferred {count} tiles to Batch API")
+        bot.send_message(chat_id, f"Отправил фото на отложенное распознавание ({count} частей, OpenAI Batch API — "
+                                  "вдвое дешевле). Результат придёт ответом на фото, обычно в течение нескольких часов.")
+
+
+def deliver_batch(bot: telebot.TeleBot, record: BatchRecord, outcome: PhotoOutcome):
+    """Ответ по отложенному фото, когда его пакет завершён."""
+    if outcome.failed:
+        text = "Отложенное распознавание не удалось. Отправьте фото еще раз."
+    else:
+        # Время — от отправки фото до готовности пакета
+        text = "Результат отложенного распознавания.\n\n" + format_result_message(
+            outcome.numbers, time.time() - record.created_at, int(outcome.cost_usd * 100))
+    bot.send_message(record.chat_id, text, reply_to_message_id=record.message_id,
+                     allow_sending_without_reply=True)
+
+
+def process_document(bot: telebot.TeleBot, client: OpenAI, chat_id: int, file_id: str, req_id: str,
+                     status_message_id: Optional[int] = None, retry: bool = False):
+    """Скачать документ во временный файл и распознать его постранично.
+
+    Страницы идут по одной: в памяти одновременно только тайлы текущей
+    страницы. Одна страница — ответ как на фото, несколько — по страницам.
+    ``retry`` — как в ``process_photo``.
+    """
+    logger = logging.getLogger("mrdoors.bot")
+    progressive = None
+    if STREAM_REPLIES and status_message_id is not None:
+        progressive = ProgressiveReply(bot, chat_id, status_message_id, edit_throttle)
+
+    def reply(text: str):
+        if progressive is not None:
+            progressive.finish(text)
+        else:
+            for part in util.smart_split(text):
+                bot.send_message(chat_id, part)
+
+    try:
+        with TypingIndicator(bot, chat_id):
+            try:
+                document = download_document(bot, file_id, req_id)
+            except PhotoError as e:
+                retry_or_reply(retry, e, reply)
+                return
+
+            with document:
+                try:
+                    total_pages = page_count(document.path)
+                except PhotoError as e:
+                    reply(e.user_message)
+                    return
+                pages = min(total_pages, max(1, DOCUMENT_MAX_PAGES))
+                logger.info(f"[{req_id}] Document {document.size} bytes, {total_pages} pages, recognizing {pages}")
+
+                started = time.time()
+                outcomes: list[Optional[PhotoOutcome]] = []
+                for page in range(pages):
+                    page_req_id = req_id if total_pages == 1 else f"{req_id}#p{page + 1}"
+                    if progressive is not None and pages > 1:
+                        progressive.update(f"Распознаю... страница {page + 1}/{pages}")
+                    try:
+                        outcomes.append(recognize_page(document, page, page_req_id, client))
+                    except PhotoError as e:
+                        if pages == 1:
+                            retry_or_reply(retry, e, reply)
+                            return
+                        logger.warning(f"[{page_req_id}] Page skipped: {e.user_message}")
+                        outcomes.append(None)
+                total_time = time.time() - started
+
+            if all(o is None or o.failed for o in outcomes):
+                logger.error(f"[{req_id}] All document pages failed to process")
+                if retry:
+                    raise RetryableError("all document pages failed")
+                reply("Ошибка при обращении к OpenAI API. Попробуйте позже.")
+                return
+
+        cents = int(sum(o.cost_usd for o in outcomes if o is not None) * 100)
+        if total_pages == 1:
+            outcome = outcomes[0]
+            reply(format_result_message(outcome.numbers, total_time, cents, cached=outcome.cached))
+        else:
+            sections = [(page + 1, o.numbers if o is not None and not o.failed else None)
+                        for page, o in enumerate(outcomes)]
+            reply(format_document_message(sections, total_pages, total_time, cents))
+        found = sum(len(o.numbers) for o in outcomes if o is not None)
+        logger.info(f"[{req_id}] Document done: {pages} pages, {found} numbers, {total_time:.1f}s, cents: {cents}")
+
+    except RetryableError:
+        raise
+    except Exception as e:
+        if retry:
+            raise RetryableError(f"unexpected error: {e}") from e
+        logger.exception(f"[{req_id}] Fatal error while handling document: {e}")
+        bot.send_message(chat_id, "Произошла неожиданная ошибка. Попробуйте отправить файл еще раз.")
+
+
+def process_album(bot: telebot.TeleBot, client: OpenAI, chat_id: int, photos: list[dict], retry: bool = False):
+    """Распознать альбом одним пакетом и ответить одним сообщением.
+
+    ``photos`` — список ``{"file_id": ..., "req_id": ...}`` в порядке альбома.
+    Фото скачиваются и готовятся параллельно, их тайлы идут через общий
+    лимит ``ALBUM_CONCURRENCY``.
+    ``retry`` — как в ``process_photo``: временная ошибка любого фото
+    повторяет альбом целиком (готовые фото возьмутся из кэша).
+    """
+    logger = logging.getLogger("mrdoors.bot")
+    album_id = photos[0]["req_id"]
+
+    try:
+        with TypingIndicator(bot, chat_id):
+            loads = [(photo["req_id"], partial(download_photo, bot, photo["file_id"], photo["req_id"]))
+                     for photo in photos]
+            started = time.time()
+            results = recognize_album(loads, client, ALBUM_CONCURRENCY)
+            total_time = time.time() - started
+
+        outcomes: dict[str, PhotoOutcome] = {}
+        for req_id, result in results.items():
+            if isinstance(result, PhotoError):
+                if retry and result.retryable:
+                    raise RetryableError(result.user_message) from result
+                # Фото без результата — в ответе будет отмечено отдельно
+                continue
+            outcomes[req_id] = result
+
+        if not outcomes or all(o.failed for o in outcomes.values()):
+            logger.error(f"[{album_id}] All album tiles failed to process")
+            if retry:
+                raise RetryableError("all album tiles failed")
+            bot.send_message(chat_id, "Ошибка при обращении к OpenAI API. Попробуйте позже.")
+            return
+
+        cents = int(sum(o.cost_usd for o in outcomes.values()) * 100)
+
+        sections = []
+        for number, photo in enumerate(photos, start=1):
+            outcome = outcomes.get(photo["req_id"])
+            sections.append((number, outcome.numbers if outcome is not None else None))
+
+        text = format_album_message(sections, total_time, cents)
+        for part in util.smart_split(text):
+            bot.send_message(chat_id, part)
+        cached = sum(1 for o in outcomes.values() if o.cached)
+        tiles = sum(o.tile_count for o in outcomes.values() if not o.cached)
+        skipped = sum(o.skipped_tiles for o in outcomes.values())
+        logger.info(f"[{album_id}] Album of {len(photos)} photos: {tiles} tiles, "
+                    f"{skipped} blank skipped, {cached} cached, {total_time:.1f}s, cents: {cents}")
+
+    except RetryableError:
+        raise
+    except Exception as e:
+        if retry:
+            raise RetryableError(f"unexpected error: {e}") from e
+        logger.exception(f"[{album_id}] Fatal error while handling album: {e}")
+        bot.send_message(chat_id, "Произошла неожиданная ошибка. Попробуйте отправить фото еще раз.")
+
+
+def create_telebot() -> telebot.TeleBot:
+    """Экземпляр TeleBot с увеличенными HTTP-таймаутами."""
     bot = telebot.TeleBot(BOT_TOKEN, parse_mode=None)
     # Увеличим таймауты HTTP для Telegram API
     apihelper.READ_TIMEOUT = 60
     apihelper.CONNECT_TIMEOUT = 15
+    return bot
+
+
+def create_openai_client() -> OpenAI:
+    return OpenAI(api_key=OPENAI_API_KEY, timeout=OPENAI_TIMEOUT, max_retries=OPENAI_RETRIES)
+
+
+def create_bot(job_queue: Optional[JobQueue] = None):
+    """Создание и настройка бота.
+
+    С ``job_queue`` фото не обрабатываются в потоке telebot, а ставятся
+    в очередь для воркеров (см. ``worker.py``). Возвращает также сборщик
+    альбомов (``None``, если альбомы не собираются): при остановке
+    недособранные альбомы нужно сбросить через ``flush_all``.
+    """
+    logger = setup_logging()
 
-    client = OpenAI(api_key=OPENAI_API_KEY, timeout=OPENAI_TIMEOUT, max_retries=OPENAI_RETRIES)
+    bot = create_telebot()
+    client = create_openai_client()
+
+    def handle_album(messages):
+        first = messages[0]
+        photos = [
+            {"file_id": m.photo[-1].file_id, "req_id": f"{m.chat.id}:{m.message_id}"}
+            for m in messages
+        ]
+        logger.info(f"[{photos[0]['req_id']}] Received album of {len(photos)} photos")
+        if job_queue is not None:
+            job_id = job_queue.enqueue("album", {"chat_id": first.chat.id, "photos": photos})
+            logger.info(f"[{photos[0]['req_id']}] Enqueued album job {job_id}")
+            bot.reply_to(first, f"Получил альбом из {len(photos)} фото. Поставил в очередь на распознавание...")
+            return
+        bot.reply_to(first, f"Получил альбом из {len(photos)} фото. Распознаю одним пакетом...")
+        process_album(bot, client, first.chat.id, photos)
+
+    albums = MediaGroupCollector(ALBUM_WINDOW, handle_album) if ALBUM_WINDOW > 0 else None
 
     @bot.message_handler(commands=['start'])
     def send_welcome(message):
@@ -119,103 +531,140 @@ def create_bot():
     def send_stats(message):
         summary = analytics.get_session_summary()
         formatted = analytics.format_summary(summary)
+        if rate_limiter.enabled:
+            formatted += "\n⏳ Очередь OpenAI:\n" + (rate_limiter.format_metrics() or "  пусто")
+        health = breakers.format_health()
+        if health:
+            formatted += "\n🩺 Модели:\n" + health
         bot.reply_to(message, f"Статистика сессии:\n{formatted}")
 
+    def defer(message, photo_message):
+        req_id = f"{photo_message.chat.id}:{photo_message.message_id}"
+        file_id = photo_message.photo[-1].file_id
+        logger.info(f"[{req_id}] Received photo for deferred recognition")
+        if job_queue is not None:
+            job_id = job_queue.enqueue("batch", {
+                "chat_id": message.chat.id,
+                "file_id": file_id,
+                "req_id": req_id,
+                "message_id": photo_message.message_id,
+            })
+            logger.info(f"[{req_id}] Enqueued batch job {job_id}")
+            return
+        process_deferred(bot, client, message.chat.id, file_id, req_id, photo_message.message_id)
+
+    @bot.message_handler(commands=['batch'])
+    def handle_batch(message):
+        photo_message = message.reply_to_message
+        if photo_message is None or not photo_message.photo:
+            bot.reply_to(message, "Ответьте командой /batch на фото или подпишите фото /batch — "
+                                  "оно распознается отложенно, вдвое дешевле.")
+            return
+        defer(message, photo_message)
+
     @bot.message_handler(content_types=['photo'])
     def handle_photo(message):
+        if albums is not None and message.media_group_id:
+            albums.add(message)
+            return
+        if is_deferred(message.caption):
+            defer(message, message)
+            return
+
         req_id = f"{message.chat.id}:{message.message_id}"
         logger.info(f"[{req_id}] Received photo set sizes={len(message.photo)}")
-        bot.reply_to(message, "Получил фото. Распознаю (подготовка → разбиение → OpenAI)...")
-
-        try:
-            with TypingIndicator(bot, message.chat.id):
-                # Самое большое фото
-                file_id = message.photo[-1].file_id
-                
-                try:
-                    file_info = bot.get_file(file_id)
-                    file_path = file_info.file_path
-                    logger.info(f"[{req_id}] TG file_path={file_path}")
-                except Exception as e:
-                    logger.error(f"[{req_id}] Failed to get file info: {e}")
-                    bot.send_message(message.chat.id, "Ошибка при получении файла. Попробуйте отправить фото еще раз.")
-                    return
-
-                try:
-                    # Скачиваем файл и делаем локальный лёгкий препроцессинг + разбиение
-                    original_bytes = bot.download_file(file_path)
-                    tiles = preprocess_and_tile(original_bytes, max_side=2000, cols=2, rows=3)
-                    logger.info(f"[{req_id}] Prepared {len(tiles)} tiles")
-                except Exception as e:
-                    logger.error(f"[{req_id}] Failed to process image: {e}")
-                    bot.send_message(message.chat.id, "Ошибка при обработке изображения. Убедитесь, что это корректный файл изображения.")
-                    return
-
-                numbers_set = set()
-                old_requests_len = len(analytics.requests)
-
-                for idx, data_url in enumerate(tiles, start=1):
-                    try:
-                        got = ask_openai_for_numbers(
-                            {"type": "image_url", "image_url": {"url": data_url}},
-                            f"{req_id}#t{idx}",
-                            client
-                        )
-                        for n in got:
-                            numbers_set.add(n)
-                    except Exception as e:
-                        logger.warning(f"[{req_id}] Tile {idx} failed: {e}")
-
-                successful_tiles = len(analytics.requests) - old_requests_len
-                if successful_tiles == 0:
-                    logger.error(f"[{req_id}] All tiles failed to process")
-                    bot.send_message(message.chat.id, "Ошибка при обращении к OpenAI API. Попробуйте позже.")
-                    return
-
-            # Суммировать время и стоимость по обработанным тайлам
-            total_time = 0.0
-            cents = 0
-            if successful_tiles > 0:
-                recent_requests = analytics.requests[-successful_tiles:]
-                total_time = sum(r.duration for r in recent_requests)
-                total_cost = sum(r.cost_usd for r in recent_requests)
-                cents = int(total_cost * 100)
-                logger.info(f"[{req_id}] Total time: {total_time:.1f}s, cents: {cents}")
-
-            numbers = sorted(numbers_set, key=lambda x: (len(x), x))
-            logger.info(f"[{req_id}] Extracted numbers: {numbers}")
-            if numbers:
-                response_text = "Нашел следующие числа на схеме:\n\n" + format_numbers_readable(numbers)
-                if successful_tiles > 0:
-                    response_text += f"\n\nЗатрачено времени: {total_time:.1f} сек, затрата: {cents} центов"
-                bot.send_message(message.chat.id, response_text)
-                logger.info(f"[{req_id}] Successfully extracted {len(numbers)} numbers from {successful_tiles}/{len(tiles)} tiles")
-            else:
-                response_text = "К сожалению, не смог найти числа на этом изображении."
-                if successful_tiles > 0:
-                    response_text += f"\n\nЗатрачено времени: {total_time:.1f} сек, затрата: {cents} центов"
-                bot.send_message(message.chat.id, response_text)
-                logger.warning(f"[{req_id}] No numbers found after processing {successful_tiles}/{len(tiles)} tiles")
-
-        except Exception as e:
-            logger.exception(f"[{req_id}] Fatal error while handling photo: {e}")
-            bot.send_message(message.chat.id, "Произошла неожиданная ошибка. Попробуйте отправить фото еще раз.")
+        # Самое большое фото
+        file_id = message.photo[-1].file_id
+
+        if job_queue is not None:
+            status = bot.reply_to(message, "Получил фото. Поставил в очередь на распознавание...")
+            job_id = job_queue.enqueue("photo", {
+                "chat_id": message.chat.id,
+                "file_id": file_id,
+                "req_id": req_id,
+                "status_message_id": status.message_id,
+            })
+            logger.info(f"[{req_id}] Enqueued job {job_id}")
+            return
+
+        status = bot.reply_to(message, "Получил фото. Распознаю (подготовка → разбиение → OpenAI)...")
+        process_photo(bot, client, message.chat.id, file_id, req_id, status.message_id)
+
+    @bot.message_handler(content_types=['document'],
+                         func=lambda m: is_supported(m.document.mime_type, m.document.file_name))
+    def handle_document(message):
+        req_id = f"{message.chat.id}:{message.message_id}"
+        doc = message.document
+        logger.info(f"[{req_id}] Received document {doc.mime_type} size={doc.file_size}")
+        if doc.file_size and doc.file_size > DOCUMENT_MAX_MB * 1024 * 1024:
+            bot.reply_to(message, TOO_LARGE.format(mb=DOCUMENT_MAX_MB))
+            return
+
+        if job_queue is not None:
+            status = bot.reply_to(message, "Получил файл. Поставил в очередь на распознавание...")
+            job_id = job_queue.enqueue("document", {
+                "chat_id": message.chat.id,
+                "file_id": doc.file_id,
+                "req_id": req_id,
+                "status_message_id": status.message_id,
+            })
+            logger.info(f"[{req_id}] Enqueued job {job_id}")
+            return
+
+        status = bot.reply_to(message, "Получил файл. Распознаю постранично (подготовка → разбиение → OpenAI)...")
+        process_document(bot, client, message.chat.id, doc.file_id, req_id, status.message_id)
 
     # Защита от нерелевантных сообщений
     @bot.message_handler(func=lambda m: True, content_types=['text', 'document', 'video', 'audio', 'sticker'])
     def fallback_handler(message):
-        bot.reply_to(message, "Отправьте, пожалуйста, фото (jpeg/png/webp). Команды: /start, /stats.")
+        bot.reply_to(message, "Отправьте, пожалуйста, фото или схему файлом (jpeg/png/tiff/webp/pdf). Команды: /start, /stats, /batch.")
 
-    return bot, logger
+    return bot, logger, albums
 
 
 def run_bot():
     """Запуск бота с перезапуском при ошибках."""
-    bot, logger = create_bot()
-    
-    logger.info("Bot starting...")
+    job_queue = None
+    pool = None
+    if PROCESSING_MODE == "queue":
+        from .worker import WorkerPool, open_job_queue, raise_system_exit, stale_worker
+
+        job_queue = open_job_queue()
+        # Сразу освобождаем задания воркеров, умерших вместе с прошлым запуском;
+        # чужие живые аренды (общая очередь) дождутся истечения
+        job_queue.recover(stale_worker)
+        pool = WorkerPool(QUEUE_WORKERS)
+        signal.signal(signal.SIGTERM, raise_system_exit)
+        pool.start()
+
+    bot, logger, albums = create_bot(job_queue)
+    # Пакеты Batch API опрашивает только главный процесс
+    batch_poller = BatchPoller(create_openai_client(), lambda record, outcome: deliver_batch(bot, record, outcome))
+    batch_poller.start()
+
+    logger.info(f"Bot starting (intake={BOT_INTAKE}, processing={PROCESSING_MODE})...")
+    if job_queue is None and preprocess_pool.enabled:
+        # В режиме очереди фото препроцессят воркеры, пул в главном процессе не нужен
+        preprocess_pool.start()
     print("Бот запущен...")
 
+    try:
+        if BOT_INTAKE == "webhook":
+            from .webhook import run_webhook
+            run_webhook(bot, logger)
+        else:
+            _poll_forever(bot, logger)
+    finally:
+        if albums is not None:
+            # Альбомы, чьё окно сборки ещё не истекло, иначе потерялись бы
+            albums.flush_all()
+        batch_poller.stop()
+        if pool is not None:
+            pool.stop()
+        preprocess_pool.shutdown()
+
+
+def _poll_forever(bot: telebot.TeleBot, logger: logging.Logger):
     # Устойчивый цикл polling с перезапуском при сетевых таймаутах
     consecutive_errors = 0
     max_consecutive_errors = 5
@@ -0,0 +1,167 @@
+"""Автоматические выключатели (circuit breaker) по моделям OpenAI.
+
+Когда модель деградирует, каждый тайл ждёт ``OPENAI_TIMEOUT`` на каждый
+повтор клиента, прежде чем перейти к запасной модели. Выключатель общий
+для процесса: по скользящему окну последних вызовов модели считаются доля
+ошибок и доля медленных ответов. Если одна из них выше порога, выключатель
+размыкается, и модель пропускается сразу. Через ``BREAKER_OPEN_SECONDS``
+он переходит в полуоткрытое состояние: пропускается один пробный запрос,
+успех замыкает выключатель, ошибка снова размыкает.
+
+Переходы пишутся в лог и в аналитику (модель, состояние, доли за окно).
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+from .analytics import RequestStats, analytics
+from .config import (
+    BREAKER_WINDOW, BREAKER_MIN_CALLS, BREAKER_ERROR_RATE, BREAKER_SLOW_SECONDS, BREAKER_SLOW_RATE,
+    BREAKER_OPEN_SECONDS,
+)
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Статус события аналитики для состояния выключателя (сервис принимает success|error|partial)
+EVENT_STATUS = {CLOSED: "success", OPEN: "error", HALF_OPEN: "partial"}
+STATE_TITLES = {CLOSED: "работает", OPEN: "отключена", HALF_OPEN: "пробный запрос"}
+
+
+class CircuitBreaker:
+    """Выключатель одной модели."""
+
+    def __init__(self, model: str, window: int = BREAKER_WINDOW, min_calls: int = BREAKER_MIN_CALLS,
+                 error_rate: float = BREAKER_ERROR_RATE, slow_seconds: float = BREAKER_SLOW_SECONDS,
+                 slow_rate: float = BREAKER_SLOW_RATE, open_seconds: float = BREAKER_OPEN_SECONDS,
+                 clock=time.monotonic):
+        self.model = model
+        self.enabled = min_calls > 0
+        self.min_calls = max(1, min_calls)
+        self.error_rate = error_rate
+        self.slow_seconds = slow_seconds
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        # (успех, длительность) последних вызовов
+        self._calls: Deque[Tuple[bool, float]] = deque(maxlen=max(1, window))
+        self._opened_at = 0.0
+        self._probe_at: Optional[float] = None
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    def rates(self) -> Tuple[float, float]:
+        """Доля ошибок и доля медленных успешных ответов за окно."""
+        calls = len(self._calls)
+        if not calls:
+            return 0.0, 0.0
+        errors = sum(1 for ok, _ in self._calls if not ok)
+        slow = sum(1 for ok, duration in self._calls if ok and duration >= self.slow_seconds)
+        return errors / calls, slow / calls
+
+    def allow(self) -> bool:
+        """Можно ли сейчас вызывать модель. В полуоткрытом состоянии — один пробный вызов."""
+        if not self.enabled:
+            return True
+        with self._lock:
+            now = self._clock()
+            if self.state == OPEN:
+                if now - self._opened_at < self.open_seconds:
+                    return False
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                # Пробный вызов, не вернувший результат за open_seconds, считается потерянным
+                if self._probe_at is not None and now - self._probe_at < self.open_seconds:
+                    return False
+                self._probe_at = now
+            return True
+
+    def record(self, ok: bool, duration: float):
+        """Учесть результат вызова модели."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self.state == OPEN:
+                # Вызовы, начатые до размыкания, на состояние не влияют
+                return
+            if self.state == HALF_OPEN:
+                self._probe_at = None
+                if ok and duration < self.slow_seconds:
+                    self._calls.clear()
+                    self._transition(CLOSED)
+                else:
+                    self._open()
+                return
+            self._calls.append((ok, duration))
+            if len(self._calls) < self.min_calls:
+                return
+            errors, slow = self.rates()
+            if errors >= self.error_rate or slow >= self.slow_rate:
+                self._open()
+
+    def _open(self):
+        self._opened_at = self._clock()
+        self._transition(OPEN)
+
+    def _transition(self, state: str):
+        # Вызывается под self._lock
+        previous, self.state = self.state, state
+        errors, slow = self.rates()
+        logger.warning(f"Circuit breaker for {self.model}: {previous} -> {state} "
+                       f"(errors {errors:.0%}, slow {slow:.0%} of {len(self._calls)} calls)")
+        stats = RequestStats(
+            duration=0.0,
+            input_tokens=0,
+            output_tokens=0,
+            cost_usd=0.0,
+            model=self.model,
+            request_id=f"breaker:{self.model}:{int(time.time() * 1000)}",
+            status=EVENT_STATUS[state],
+            raw_response={"breaker": {"from": previous, "to": state, "error_rate": round(errors, 3),
+                                      "slow_rate": round(slow, 3), "calls": len(self._calls)}},
+            originated_at=time.time(),
+        )
+        # Отправка события — сетевой вызов; не держим ни блокировку, ни event loop
+        threading.Thread(target=analytics.add_event, args=(stats,), daemon=True).start()
+
+
+class BreakerRegistry:
+    """Выключатели по моделям, общие для процесса."""
+
+    def __init__(self, **params):
+        self.params = params
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def for_model(self, model: str) -> CircuitBreaker:
+        with self._lock:
+            if model not in self._breakers:
+                self._breakers[model] = CircuitBreaker(model, **self.params)
+            return self._breakers[model]
+
+    def allow(self, model: str) -> bool:
+        return self.for_model(model).allow()
+
+    def record(self, model: str, ok: bool, duration: float):
+        self.for_model(model).record(ok, duration)
+
+    def format_health(self) -> str:
+        """Сводка для /stats."""
+        with self._lock:
+            breakers = list(self._breakers.values())
+        lines = []
+        for b in breakers:
+            with b._lock:
+                errors, slow = b.rates()
+            lines.append(f"  {b.model}: {STATE_TITLES[b.state]}, ошибок {errors:.0%}, медленных {slow:.0%}")
+        return "\n".join(lines)
+
+
+# Глобальные выключатели процесса
+breakers = BreakerRegistry()
@@ -0,0 +1,211 @@
+"""Кэш результатов распознавания по содержимому изображения.
+
+Ключ — SHA-256 от байтов файла из Telegram, параметров препроцессинга и
+версии промпта/моделей: пересланная или повторно отправленная схема
+распознаётся один раз. Записи хранятся в SQLite на диске, вытесняются по
+TTL и по суммарному размеру (LRU).
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+from .config import RECOGNITION_CACHE_PATH, RECOGNITION_CACHE_MAX_MB, RECOGNITION_CACHE_TTL
+from .utils import PROMPT_VERSION
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_lru ON entries (accessed_at);
+"""
+
+
+def cache_key(data: bytes, **params: Any) -> str:
+    """Ключ кэша: байты изображения + параметры препроцессинга + версия промпта."""
+    h = hashlib.sha256()
+    h.update(data)
+    h.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+    h.update(PROMPT_VERSION.encode("ascii"))
+    return h.hexdigest()
+
+
+class RecognitionCache:
+    """Дисковый кэш с TTL и ограничением суммарного размера (LRU)."""
+
+    def __init__(self, path: str, max_bytes: int, ttl: float):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Файл создаётся при первом обращении, а не при импорте модуля
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Значение по ключу или None (в том числе для просроченных записей)."""
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute("SELECT value, created_at FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if now - row[1] > self.ttl:
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            return None
+        conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Dict[str, Any]):
+        encoded = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO entries (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            (key, encoded, len(encoded.encode("utf-8")), now, now),
+        )
+        self.evict()
+
+    def evict(self):
+        """Удалить просроченные записи и самые давно использованные сверх лимита размера."""
+        conn = self._connect()
+        conn.execute("DELETE FROM entries WHERE created_at < ?", (time.time() - self.ttl,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        freed = 0
+        victims = []
+        for key, size in conn.execute("SELECT key, size FROM entries ORDER BY accessed_at"):
+            victims.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        conn.executemany("DELETE FROM entries WHERE key = ?", victims)
+        logger.debug(f"Recognition cache evicted {len(victims)} entries ({freed} bytes)")
+
+    def stats(self) -> Dict[str, int]:
+        count, size = self._connect().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+        return {"entries": count, "bytes": size}
+
+
+class SingleFlight:
+    """Схлопывание одновременных вычислений с одинаковым ключом.
+
+    Первый вызов ``do`` выполняет функцию, остальные с тем же ключом ждут
+    и получают тот же результат (или то же исключение).
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result: Any = None
+            self.error: Optional[BaseException] = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, "SingleFlight._Call"] = {}
+
+    def begin(self, key: str) -> Tuple["SingleFlight._Call", bool]:
+        """Занять ключ: (вызов, leader). Лидер обязан завершить вызов через ``finish``.
+
+        Нужно, когда вычисления нескольких ключей идут одним пакетом (альбом):
+        лидер публикует результаты ``finish``, остальные ждут их в ``wait``.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                return call, False
+            call = self._calls[key] = SingleFlight._Call()
+            return call, True
+
+    def finish(self, key: str, call: "SingleFlight._Call", result: Any = None,
+               error: Optional[BaseException] = None):
+        """Отдать результат (или исключение) ожидающим и освободить ключ."""
+        call.result, call.error = result, error
+        with self._lock:
+            self._calls.pop(key, None)
+        call.done.set()
+
+    @staticmethod
+    def wait(call: "SingleFlight._Call") -> Any:
+        """Дождаться результата чужого вызова."""
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def do(self, key: str, fn: Callable[[], T]) -> Tuple[T, bool]:
+        """Выполнить ``fn`` один раз на ключ. Возвращает (результат, shared)."""
+        call, leader = self.begin(key)
+        if not leader:
+            return self.wait(call), True
+        try:
+            result = fn()
+        except BaseException as e:
+            self.finish(key, call, error=e)
+            raise
+        self.finish(key, call, result)
+        return result, False
+
+
+class AsyncSingleFlight:
+    """``SingleFlight`` для event loop: ожидающие ждут ``asyncio.Future``, не блокируя поток."""
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Future] = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> Tuple[T, bool]:
+        """Выполнить ``fn`` один раз на ключ. Возвращает (результат, shared)."""
+        future = self._calls.get(key)
+        if future is not None:
+            # shield: отмена ожидающего не должна отменять общий результат
+            return await asyncio.shield(future), True
+
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Ожидающих может не быть — не даём asyncio ругаться на непрочитанное исключение
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            self._calls.pop(key, None)
+        return result, False
+
+
+recognition_cache = (
+    RecognitionCache(RECOGNITION_CACHE_PATH, int(RECOGNITION_CACHE_MAX_MB * 1024 * 1024), RECOGNITION_CACHE_TTL)
+    if RECOGNITION_CACHE_MAX_MB > 0 else None
+)
+single_flight = SingleFlight()
@@ -14,6 +14,141 @@ PREFERRED_MODEL = os.getenv('OPENAI_VISION_MODEL', 'gpt-4o')
 OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', '45'))
 OPENAI_RETRIES = int(os.getenv('OPENAI_RETRIES', '2'))
 
+# Каскад моделей: тайл сначала распознаёт дешёвая CASCADE_MODEL, к OPENAI_VISION_MODEL он уходит при плохом ответе
+MODEL_CASCADE = os.getenv('MODEL_CASCADE', '0').lower() in ('1', 'true', 'yes')
+CASCADE_MODEL = os.getenv('CASCADE_MODEL', 'gpt-4o-mini')
+# Ожидается хотя бы одно число на столько «чернильных» пикселей тайла (0 — не проверять)
+CASCADE_INK_PER_NUMBER = int(os.getenv('CASCADE_INK_PER_NUMBER', '600'))
+# Сколько значений, не прошедших NUMBER_REGEX, допускается в ответе дешёвой модели
+CASCADE_MAX_INVALID = int(os.getenv('CASCADE_MAX_INVALID', '0'))
+# Минимальное сходство чисел двух ответов дешёвой модели (0 — второй ответ не запрашивается)
+CASCADE_MIN_AGREEMENT = float(os.getenv('CASCADE_MIN_AGREEMENT', '0'))
+
+# Concurrency
+# Сколько тайлов одного фото распознаются одновременно
+TILE_CONCURRENCY = int(os.getenv('TILE_CONCURRENCY', '6'))
+# Общий лимит одновременных запросов к OpenAI на процесс
+OPENAI_MAX_CONCURRENCY = int(os.getenv('OPENAI_MAX_CONCURRENCY', '16'))
+# Сколько тайлов фото отправлять в одном запросе к OpenAI (1 — по одному, 0 — все тайлы фото)
+TILES_PER_REQUEST = int(os.getenv('TILES_PER_REQUEST', '1'))
+
+# Постепенный ответ: статусное сообщение редактируется по мере готовности тайлов
+STREAM_REPLIES = os.getenv('STREAM_REPLIES', '0').lower() in ('1', 'true', 'yes')
+# Минимальный интервал между правками сообщений в одном чате, секунды
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.5'))
+
+# Альбомы: сколько секунд ждать остальные фото media group (0 — обрабатывать фото по отдельности)
+ALBUM_WINDOW = float(os.getenv('ALBUM_WINDOW', '1.5'))
+# Общий лимит одновременных тайлов для всех фото альбома (им же ограничено параллельное скачивание фото)
+ALBUM_CONCURRENCY = int(os.getenv('ALBUM_CONCURRENCY', '12'))
+
+# Лимиты OpenAI на процесс (0 — без ограничения)
+OPENAI_RPM_LIMIT = int(os.getenv('OPENAI_RPM_LIMIT', '0'))
+OPENAI_TPM_LIMIT = int(os.getenv('OPENAI_TPM_LIMIT', '0'))
+# Переопределение по моделям: "gpt-4o=500:30000,gpt-4o-mini=500:200000"
+OPENAI_RATE_LIMITS = os.getenv('OPENAI_RATE_LIMITS', '')
+# Хеджирование: запрос без ответа дольше перцентиля недавних задержек модели дублируется
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', '95'))
+# Сколько задержек модели нужно накопить, прежде чем хеджировать
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', '20'))
+# Порог хеджирования не меньше стольких секунд
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', '2'))
+# Бюджет дубликатов: дополнительных запросов на один обычный (0 — хеджирование выключено)
+HEDGE_MAX_EXTRA = float(os.getenv('HEDGE_MAX_EXTRA', '0.05'))
+# Модель дубликата (пусто — та же модель)
+HEDGE_MODEL = os.getenv('HEDGE_MODEL', '')
+
+# Выключатель модели: окно последних вызовов и сколько вызовов нужно для решения (0 — выключатель не используется)
+BREAKER_WINDOW = int(os.getenv('BREAKER_WINDOW', '20'))
+BREAKER_MIN_CALLS = int(os.getenv('BREAKER_MIN_CALLS', '6'))
+# Модель отключается, если за окно доля ошибок или доля ответов дольше BREAKER_SLOW_SECONDS достигла порога
+BREAKER_ERROR_RATE = float(os.getenv('BREAKER_ERROR_RATE', '0.5'))
+BREAKER_SLOW_SECONDS = float(os.getenv('BREAKER_SLOW_SECONDS', '30'))
+BREAKER_SLOW_RATE = float(os.getenv('BREAKER_SLOW_RATE', '0.5'))
+# Через сколько секунд отключённой модели пропускается пробный запрос
+BREAKER_OPEN_SECONDS = float(os.getenv('BREAKER_OPEN_SECONDS', '30'))
+
+# Сколько раз повторять запрос после 429 до перехода к следующей модели
+OPENAI_RATE_LIMIT_RETRIES = int(os.getenv('OPENAI_RATE_LIMIT_RETRIES', '3'))
+
+# Runtime: sync (TeleBot + потоки) или async (AsyncTeleBot + AsyncOpenAI)
+BOT_RUNTIME = os.getenv('BOT_RUNTIME', 'sync').lower()
+
+# Приём обновлений: polling (long polling) или webhook (ASGI-приложение за nginx)
+BOT_INTAKE = os.getenv('BOT_INTAKE', 'polling').lower()
+# Публичный https-адрес webhook; если задан, бот регистрирует его при старте
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram/webhook')
+
+# Обработка фото: inline (в потоке telebot) или queue (через очередь и воркеры)
+PROCESSING_MODE = os.getenv('PROCESSING_MODE', 'inline').lower()
+JOB_QUEUE_PATH = os.getenv('JOB_QUEUE_PATH', 'logs/jobs.sqlite3')
+QUEUE_WORKERS = int(os.getenv('QUEUE_WORKERS', '2'))
+# Через сколько секунд без подтверждения задание снова выдаётся воркерам
+QUEUE_VISIBILITY_TIMEOUT = float(os.getenv('QUEUE_VISIBILITY_TIMEOUT', '300'))
+QUEUE_MAX_ATTEMPTS = int(os.getenv('QUEUE_MAX_ATTEMPTS', '3'))
+
+# Движок усиления контраста/резкости: pillow или numpy (один проход по буферу, нужен numpy)
+PREPROCESS_BACKEND = os.getenv('PREPROCESS_BACKEND', 'pillow').lower()
+
+# Пул процессов препроцессинга (0 — в потоке обработчика). Воркеры очереди препроцессят сами.
+PREPROCESS_WORKERS = int(os.getenv('PREPROCESS_WORKERS', '0'))
+# Сколько фото одновременно принимается в пул (0 — вдвое больше процессов) и сколько секунд ждать места
+PREPROCESS_MAX_PENDING = int(os.getenv('PREPROCESS_MAX_PENDING', '0'))
+PREPROCESS_TIMEOUT = float(os.getenv('PREPROCESS_TIMEOUT', '30'))
+
+# Тайлы, где меньше стольких «чернильных» пикселей (на копии 256px), не отправляются в OpenAI (0 — не пропускать)
+TILE_MIN_INK = int(os.getenv('TILE_MIN_INK', '8'))
+
+# Раскладка фото на тайлы: adaptive — по содержимому, grid — фиксированная сетка 2x3
+TILE_LAYOUT = os.getenv('TILE_LAYOUT', 'adaptive').lower()
+# Сторона тайла (px после уменьшения до 2000) для содержимого обычной плотности
+TILE_TARGET_SIDE = int(os.getenv('TILE_TARGET_SIDE', '800'))
+# Верхний предел числа тайлов в адаптивной раскладке
+TILE_MAX_COUNT = int(os.getenv('TILE_MAX_COUNT', '9'))
+# Перекрытие соседних тайлов, доля размера тайла (0 — тайлы встык)
+TILE_OVERLAP = float(os.getenv('TILE_OVERLAP', '0.08'))
+# Минимальный масштаб тайла относительно рабочего изображения; в его пределах размер подбирается
+# под блоки 512 px, которыми OpenAI считает токены изображений
+TILE_MIN_SCALE = float(os.getenv('TILE_MIN_SCALE', '1.0'))
+# Кодирование тайлов: порог читаемости (SSIM краёв относительно исходного тайла) для серых,
+# бинаризованных и сжатых вариантов; 0 — всегда RGB JPEG q92
+TILE_MIN_SSIM = float(os.getenv('TILE_MIN_SSIM', '0.98'))
+# Бюджет байт на тайл: первый читаемый вариант в пределах бюджета принимается без перебора остальных
+TILE_MAX_BYTES = int(os.getenv('TILE_MAX_BYTES', '100000'))
+
+# Документы (несжатые изображения и PDF): предел размера файла, МБ (Bot API отдаёт ботам до 20 МБ)
+DOCUMENT_MAX_MB = float(os.getenv('DOCUMENT_MAX_MB', '20'))
+# Сколько страниц многостраничного TIFF/PDF распознавать
+DOCUMENT_MAX_PAGES = int(os.getenv('DOCUMENT_MAX_PAGES', '10'))
+# Потолок памяти на декодирование одной страницы, МБ; больше — страница декодируется полосами или отклоняется
+DOCUMENT_DECODE_MAX_MB = float(os.getenv('DOCUMENT_DECODE_MAX_MB', '256'))
+# Каталог временных файлов для скачанных документов (пусто — системный)
+DOCUMENT_SPOOL_DIR = os.getenv('DOCUMENT_SPOOL_DIR', '')
+
+# Отложенное распознавание через Batch API (фото с подписью /batch или #batch)
+BATCH_STORE_PATH = os.getenv('BATCH_STORE_PATH', 'logs/batches.sqlite3')
+# Каталог JSONL-файлов с запросами пакетов
+BATCH_DIR = os.getenv('BATCH_DIR', 'logs/batches')
+# Как часто опрашивать незавершённые пакеты, секунды
+BATCH_POLL_INTERVAL = float(os.getenv('BATCH_POLL_INTERVAL', '60'))
+BATCH_COMPLETION_WINDOW = os.getenv('BATCH_COMPLETION_WINDOW', '24h')
+
+# Кэш распознавания по содержимому фото (RECOGNITION_CACHE_MAX_MB=0 — выключен)
+RECOGNITION_CACHE_PATH = os.getenv('RECOGNITION_CACHE_PATH', 'logs/recognition_cache.sqlite3')
+RECOGNITION_CACHE_MAX_MB = float(os.getenv('RECOGNITION_CACHE_MAX_MB', '64'))
+# Срок жизни записи, секунды (по умолчанию неделя)
+RECOGNITION_CACHE_TTL = float(os.getenv('RECOGNITION_CACHE_TTL', str(7 * 24 * 3600)))
+
+# Кэш тайлов по перцептивной сигнатуре (по умолчанию выключен: TILE_CACHE_DISTANCE=-1)
+TILE_CACHE_PATH = os.getenv('TILE_CACHE_PATH', 'logs/tile_cache.sqlite3')
+# Допустимое расстояние Хэмминга между 256-битными хэшами карт чернил; кандидат ещё проверяется по маске
+TILE_CACHE_DISTANCE = int(os.getenv('TILE_CACHE_DISTANCE', '-1'))
+TILE_CACHE_MAX_ENTRIES = int(os.getenv('TILE_CACHE_MAX_ENTRIES', '50000'))
+
 # Logging
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
 
@@ -22,3 +157,5 @@ if not BOT_TOKEN:
     raise ValueError("Переменная окружения BOT_TOKEN не задана. Создайте .env и укажите BOT_TOKEN=<ваш токен>.")
 if not OPENAI_API_KEY:
     raise ValueError("Переменная окружения OPENAI_API_KEY не задана. Создайте .env и укажите OPENAI_API_KEY=<ваш ключ>.")
+if BOT_INTAKE == 'webhook' and not WEBHOOK_SECRET:
+    raise ValueError("Для BOT_INTAKE=webhook задайте WEBHOOK_SECRET — им проверяются запросы от Telegram.")
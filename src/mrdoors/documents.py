@@ -0,0 +1,334 @@
+"""Схемы, отправленные документом: без сжатия Telegram, в том числе TIFF и PDF.
+
+Документ может быть намного больше фото, поэтому он не держится в памяти
+целиком:
+
+* файл скачивается потоком во временный файл (``spool_document``), хэш
+  для кэша считается по ходу скачивания;
+* страница декодируется сразу в рабочий размер (``decode_page``): JPEG —
+  с DCT-уменьшением, PDF — растеризацией в нужном масштабе (нужен
+  ``pypdfium2``), несжатый TIFF, не помещающийся в ``DOCUMENT_DECODE_MAX_MB``,
+  — полосами по strip/tile, остальное — целиком, если укладывается в потолок;
+* дальше страница идёт тем же путём, что и фото: усиление, раскладка,
+  тайлы (``render_image_tiles``), кэш и распознавание — постранично.
+"""
+
+import hashlib
+import logging
+import math
+import os
+import tempfile
+import threading
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple
+
+import requests
+from PIL import Image
+from openai import OpenAI
+from telebot import apihelper
+
+from . import utils
+from .config import DOCUMENT_MAX_MB, DOCUMENT_DECODE_MAX_MB, DOCUMENT_SPOOL_DIR
+from .prepool import preprocess_pool
+from .recognition import TILING, PhotoError, PhotoOutcome, TileResult, recognize_prepared, run_preprocess
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:  # pypdfium2 нужен только для PDF
+    pdfium = None
+
+logger = logging.getLogger(__name__)
+
+# Что принимается документом; остальное получает подсказку отправить фото
+SUPPORTED_MIME = {"image/jpeg", "image/png", "image/tiff", "image/webp", "image/bmp", "application/pdf"}
+SUPPORTED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".tif", ".tiff", ".webp", ".bmp", ".pdf"}
+CHUNK_SIZE = 1 << 20
+# Несжатое изображение читается полосами по столько строк; байт на пиксель в файле по rawmode
+BAND_ROWS = 64
+RAW_PIXEL_BYTES = {"1": 1 / 8, "1;I": 1 / 8, "L": 1, "P": 1, "RGB": 3, "RGBX": 4, "RGBA": 4, "CMYK": 4}
+PDF_MAGIC = b"%PDF"
+DEFAULT_FILE_URL = "https://api.telegram.org/file/bot{0}/{1}"
+
+TOO_LARGE = "Файл слишком большой. Отправьте схему размером до {mb:.0f} МБ или фото."
+TOO_DETAILED = "Изображение слишком большое для обработки. Уменьшите разрешение скана или отправьте фото."
+UNREADABLE = "Не удалось прочитать документ. Отправьте изображение (jpeg/png/tiff/webp) или PDF."
+
+# PDFium не потокобезопасен
+_pdfium_lock = threading.Lock()
+
+
+def is_supported(mime_type: Optional[str], file_name: Optional[str]) -> bool:
+    """Документ — изображение или PDF (по MIME-типу, а без него — по расширению)."""
+    if mime_type:
+        return mime_type.lower() in SUPPORTED_MIME
+    return os.path.splitext(file_name or "")[1].lower() in SUPPORTED_EXTENSIONS
+
+
+@dataclass
+class SpooledDocument:
+    """Скачанный во временный файл документ; файл удаляется в ``close``."""
+    path: str
+    digest: str  # SHA-256 содержимого
+    size: int
+
+    def page_key(self, page: int) -> bytes:
+        """Ключ кэша распознавания страницы (вместо байтов фото)."""
+        return f"document:{self.digest}:{page}".encode("ascii")
+
+    def close(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def spool_document(token: str, file_path: str, max_bytes: int = int(DOCUMENT_MAX_MB * 1024 * 1024)) -> SpooledDocument:
+    """Скачать файл Telegram потоком во временный файл (в памяти — не больше ``CHUNK_SIZE``).
+
+    Качаем сами по публичному URL файла: ``bot.download_file`` отдаёт файл
+    целиком в памяти. Адрес сервера, прокси и таймауты — из настроек telebot.
+    """
+    url = (apihelper.FILE_URL or DEFAULT_FILE_URL).format(token, file_path)
+    fd, path = tempfile.mkstemp(prefix="mrdoors-", suffix=os.path.splitext(file_path)[1],
+                                dir=DOCUMENT_SPOOL_DIR or None)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as out, requests.get(
+                url, proxies=apihelper.proxy, stream=True,
+                timeout=(apihelper.CONNECT_TIMEOUT, apihelper.READ_TIMEOUT)) as resp:
+            resp.raise_for_status()
+            for chunk in resp.iter_content(CHUNK_SIZE):
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise PhotoError(TOO_LARGE.format(mb=max_bytes / 1024 / 1024))
+                digest.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        os.unlink(path)
+        raise
+    return SpooledDocument(path, digest.hexdigest(), size)
+
+
+def _is_pdf(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(PDF_MAGIC)) == PDF_MAGIC
+
+
+def _require_pdfium():
+    if pdfium is None:
+        logger.warning("PDF document received but pypdfium2 is not installed")
+        raise PhotoError("PDF пока не поддерживается. Отправьте страницы схемы изображениями.")
+
+
+def page_count(path: str) -> int:
+    """Число страниц документа (кадров TIFF или страниц PDF)."""
+    try:
+        if _is_pdf(path):
+            _require_pdfium()
+            with _pdfium_lock:
+                pdf = pdfium.PdfDocument(path)
+                try:
+                    return len(pdf)
+                finally:
+                    pdf.close()
+        with Image.open(path) as img:
+            return getattr(img, "n_frames", 1)
+    except PhotoError:
+        raise
+    except Exception as e:
+        raise PhotoError(UNREADABLE) from e
+
+
+def _pixel_bytes(mode: str) -> int:
+    # Pillow хранит многоканальные и 16/32-битные режимы по 4 байта на пиксель
+    return 1 if mode in ("1", "L", "P") else 4
+
+
+def _working_mode(mode: str) -> str:
+    """Режим, в котором изображение уменьшается: серое остаётся серым (вчетверо меньше памяти)."""
+    return "L" if mode in ("1", "L") else "RGB"
+
+
+def _decode_bytes(img: Image.Image) -> int:
+    """Сколько памяти займёт декодирование ``img`` целиком и перевод в рабочий режим."""
+    pixels = img.width * img.height
+    need = pixels * _pixel_bytes(img.mode)
+    if img.mode != _working_mode(img.mode):
+        need += pixels * _pixel_bytes(_working_mode(img.mode))
+    return need
+
+
+def _shrink(img: Image.Image, size: Tuple[int, int]) -> Image.Image:
+    img = img.convert(_working_mode(img.mode))
+    if img.size != size:
+        img = img.resize(size, Image.LANCZOS, reducing_gap=3.0)
+    return img
+
+
+def _raw_args(args) -> Tuple[str, int, int]:
+    """(rawmode, stride, orientation) из аргументов декодера raw; 0 — stride по ширине."""
+    return (tuple(args) + (0, 1))[:3] if isinstance(args, tuple) else (args, 0, 1)
+
+
+def _split_rows(entry, width: int) -> list:
+    """Разбить несжатый кусок на всю ширину на полосы по ``BAND_ROWS`` строк (смещения — по stride)."""
+    name, (x0, top, x1, bottom), offset, args = entry
+    rawmode, stride, orientation = _raw_args(args)
+    if x0 != 0 or x1 != width or orientation != 1:
+        return [entry]
+    stride = stride or math.ceil(width * RAW_PIXEL_BYTES[rawmode])
+    return [(name, (0, y, width, min(bottom, y + BAND_ROWS)), offset + (y - top) * stride, args)
+            for y in range(top, bottom, BAND_ROWS)]
+
+
+def _bands(img: Image.Image) -> Optional[List[Tuple[int, int, list]]]:
+    """Полосы строк ``(y0, y1, записи tile)``, если их можно читать по отдельности.
+
+    Так устроены несжатые TIFF (strip/tile): каждый кусок — непрерывные
+    строки в файле по известному смещению; читаются они сами
+    (``_read_raw``), без вмешательства в декодер Pillow.
+    """
+    if not img.tile or any(name != "raw" or _raw_args(args)[0] not in RAW_PIXEL_BYTES
+                           for name, _, _, args in img.tile):
+        return None
+    rows = {}
+    for entry in img.tile:
+        for part in _split_rows(entry, img.width):
+            rows.setdefault((part[1][1], part[1][3]), []).append(part)
+    if len(rows) < 2:
+        return None
+    return [(top, bottom, entries) for (top, bottom), entries in sorted(rows.items())]
+
+
+def _decode_banded(path: str, img: Image.Image, size: Tuple[int, int], max_bytes: int) -> Image.Image:
+    """Декодировать полосами не больше ``max_bytes`` и уменьшать каждую сразу до ``size``."""
+    width, height = img.size
+    mode = _working_mode(img.mode)
+    row_bytes = width * (_pixel_bytes(img.mode) + _pixel_bytes(mode))
+    out = Image.new(mode, size)
+    scale = size[1] / height
+
+    groups, current = [], []
+    for top, bottom, entries in _bands(img):
+        if current and (bottom - current[0][0]) * row_bytes > max_bytes:
+            groups.append(current)
+            current = []
+        current.append((top, bottom, entries))
+    groups.append(current)
+
+    with open(path, "rb") as f:
+        for group in groups:
+            y0, y1 = group[0][0], group[-1][1]
+            out_top, out_bottom = round(y0 * scale), round(y1 * scale)
+            if out_bottom <= out_top:
+                continue
+            band = _palette_of(img, Image.new(img.mode, (width, y1 - y0)))
+            for _, _, entries in group:
+                for entry in entries:
+                    band.paste(_read_raw(f, img.mode, entry), (entry[1][0], entry[1][1] - y0))
+            out.paste(_shrink(band, (size[0], out_bottom - out_top)), (0, out_top))
+    return out
+
+
+def _palette_of(img: Image.Image, band: Image.Image) -> Image.Image:
+    """Палитра и прозрачность страницы — полосе ``P``-изображения (без ``getpalette``: тот декодирует страницу)."""
+    if img.mode == "P" and img.palette is not None:
+        rawmode, data = img.palette.getdata()
+        band.putpalette(data, rawmode)
+    if "transparency" in img.info:
+        band.info["transparency"] = img.info["transparency"]
+    return band
+
+
+def _read_raw(f, mode: str, entry) -> Image.Image:
+    """Прочитать несжатый кусок из файла и декодировать его ``Image.frombytes``."""
+    _, (x0, top, x1, bottom), offset, args = entry
+    rawmode, stride, orientation = _raw_args(args)
+    width, rows = x1 - x0, bottom - top
+    stride = stride or math.ceil(width * RAW_PIXEL_BYTES[rawmode])
+    f.seek(offset)
+    # Последняя строка в файле может быть короче stride — дополняем, декодер её не читает
+    data = f.read(stride * rows).ljust(stride * rows, b"\0")
+    return Image.frombytes(mode, (width, rows), data, "raw", rawmode, stride, orientation)
+
+
+def _decode_raster(path: str, page: int, max_side: int, max_bytes: int) -> Image.Image:
+    with Image.open(path) as img:
+        img.seek(page)
+        w, h = img.size
+        k = max(w, h) / max_side if max(w, h) > max_side else 1.0
+        size = (max(1, int(w / k)), max(1, int(h / k)))
+        if k > 1.0:
+            # Для JPEG декодер сразу отдаёт уменьшенное изображение (см. utils.load_image)
+            img.draft(img.mode, size)
+        if _decode_bytes(img) <= max_bytes:
+            img.load()
+            return _shrink(img, size).convert("RGB")
+        if _bands(img) is not None:
+            logger.info(f"Decoding {w}x{h} {img.mode} page in bands under {max_bytes} bytes")
+            return _decode_banded(path, img, size, max_bytes).convert("RGB")
+        logger.warning(f"Document page {w}x{h} {img.mode} needs {_decode_bytes(img)} bytes, limit {max_bytes}")
+        raise PhotoError(TOO_DETAILED)
+
+
+def _decode_pdf(path: str, page: int, max_side: int) -> Image.Image:
+    _require_pdfium()
+    with _pdfium_lock:
+        pdf = pdfium.PdfDocument(path)
+        try:
+            pdf_page = pdf[page]
+            width, height = pdf_page.get_size()
+            # Растеризация сразу в рабочий размер: память на страницу не зависит от её формата
+            bitmap = pdf_page.render(scale=max_side / max(width, height))
+            img = bitmap.to_pil().convert("RGB")
+            bitmap.close()
+            pdf_page.close()
+        finally:
+            pdf.close()
+    return img
+
+
+def decode_page(path: str, page: int, max_side: int,
+                max_bytes: int = int(DOCUMENT_DECODE_MAX_MB * 1024 * 1024)) -> Image.Image:
+    """Страница документа в RGB с длинной стороной не больше ``max_side``.
+
+    На декодирование уходит не больше ``max_bytes`` памяти; страница,
+    которую нельзя уложить в потолок, отклоняется с ``PhotoError``.
+    """
+    try:
+        if _is_pdf(path):
+            return _decode_pdf(path, page, max_side)
+        return _decode_raster(path, page, max_side, max_bytes)
+    except PhotoError:
+        raise
+    except Image.DecompressionBombError as e:
+        raise PhotoError(TOO_DETAILED) from e
+    except Exception as e:
+        raise PhotoError(UNREADABLE) from e
+
+
+def render_page(path: str, page: int, max_side: int = 1800, cols: int = 2, rows: int = 3,
+                min_ink: int = 0, **layout) -> Tuple[int, List[utils.RenderedTile]]:
+    """Декодирование и нарезка страницы; параметры — как у ``utils.render_tiles``."""
+    return utils.render_image_tiles(decode_page(path, page, max_side), cols, rows, min_ink, **layout)
+
+
+def prepare_page_tiles(document: SpooledDocument, page: int, req_id: str) -> utils.TileSet:
+    """Тайлы страницы документа (в пуле процессов, если он включён)."""
+    if preprocess_pool.enabled:
+        return run_preprocess(lambda: preprocess_pool.render_page(document.path, page, **TILING), req_id)
+    return run_preprocess(lambda: utils.make_tiles(*render_page(document.path, page, **TILING)), req_id)
+
+
+def recognize_page(document: SpooledDocument, page: int, req_id: str, client: OpenAI,
+                   on_progress: Optional[Callable[[TileResult, int], None]] = None) -> PhotoOutcome:
+    """Распознать страницу документа с учётом кэша (как ``recognize_photo``)."""
+    return recognize_prepared(document.page_key(page), lambda: prepare_page_tiles(document, page, req_id),
+                              req_id, client, on_progress)
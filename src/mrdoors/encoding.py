@@ -0,0 +1,182 @@
+"""Кодирование тайла для отправки в OpenAI.
+
+Тайл чертежа — почти всегда тёмные линии и цифры на светлой бумаге, и
+RGB JPEG q92 тратит байты на цвет и шум бумаги. Кодировщик пробует
+варианты от самых компактных — бинаризованный PNG, серый WebP и серый
+JPEG на нескольких уровнях качества — и оставляет самый маленький,
+который проходит проверку читаемости и укладывается в бюджет байт.
+Если ни один не прошёл, отправляется прежний RGB JPEG q92.
+
+Читаемость — SSIM градиентов (Собель по x и y) относительно исходного
+тайла: для OCR важны края штрихов, а не тон бумаги. SSIM считается по
+блокам 8x8 средствами Pillow, без numpy.
+"""
+
+import logging
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from PIL import Image, ImageChops, ImageFilter, ImageMath
+
+logger = logging.getLogger(__name__)
+
+MIME = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+# Базовый вариант — как до появления кодировщика; проверку проходит всегда
+BASELINE = ("rgb", "JPEG", 92)
+# Уровни качества по возрастанию: берётся первый, прошедший проверку
+QUALITIES = (50, 70, 85)
+# Пиксель «цветной», если каналы расходятся на столько уровней; при доле таких
+# пикселей больше COLOR_SHARE (цветные пометки, штампы) тайл остаётся в RGB
+COLOR_CHROMA = 60
+COLOR_SHARE = 0.002
+SSIM_BLOCK = 8
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+
+_SOBEL_X = ImageFilter.Kernel((3, 3), [-1, 0, 1, -2, 0, 2, -1, 0, 1], scale=8, offset=128)
+_SOBEL_Y = ImageFilter.Kernel((3, 3), [-1, -2, -1, 0, 0, 0, 1, 2, 1], scale=8, offset=128)
+
+
+@dataclass
+class EncodedTile:
+    """Закодированный тайл и сведения о кодировании для аналитики."""
+    data: bytes
+    format: str  # JPEG | PNG | WEBP
+    variant: str  # rgb | gray | binary
+    quality: Optional[int]
+    ssim: float
+    baseline_bytes: int
+
+    @property
+    def mime(self) -> str:
+        return MIME[self.format]
+
+    @property
+    def info(self) -> Dict[str, Any]:
+        return {"format": self.format.lower(), "variant": self.variant, "quality": self.quality,
+                "bytes": len(self.data), "baseline_bytes": self.baseline_bytes, "ssim": round(self.ssim, 4)}
+
+
+def _save(img: Image.Image, fmt: str, quality: Optional[int]) -> bytes:
+    buf = BytesIO()
+    if fmt == "PNG":
+        img.save(buf, format="PNG", optimize=True)
+    elif fmt == "WEBP":
+        img.save(buf, format="WEBP", quality=quality, method=4)
+    else:
+        img.save(buf, format="JPEG", quality=quality)
+    return buf.getvalue()
+
+
+def _block_ssim(a: Image.Image, b: Image.Image) -> float:
+    """SSIM по неперекрывающимся блокам ``SSIM_BLOCK`` x ``SSIM_BLOCK`` (изображения ``L``).
+
+    Блоки усредняются с весом дисперсии эталона.
+    """
+    size = (max(1, a.width // SSIM_BLOCK), max(1, a.height // SSIM_BLOCK))
+    x, y = a.convert("F"), b.convert("F")
+
+    def block_mean(img: Image.Image) -> Image.Image:
+        return img.resize(size, Image.BOX)
+
+    mx, my = block_mean(x), block_mean(y)
+    xx = block_mean(ImageMath.lambda_eval(lambda v: v["x"] * v["x"], x=x))
+    yy = block_mean(ImageMath.lambda_eval(lambda v: v["y"] * v["y"], y=y))
+    xy = block_mean(ImageMath.lambda_eval(lambda v: v["x"] * v["y"], x=x, y=y))
+    # Вес блока — дисперсия эталона: пустая бумага не должна «разбавлять» оценку штрихов
+    weight = ImageMath.lambda_eval(lambda v: v["xx"] - v["mx"] * v["mx"] + SSIM_C2, mx=mx, xx=xx)
+    weighted = ImageMath.lambda_eval(
+        lambda v: (v["mx"] * v["my"] * 2 + SSIM_C1) * ((v["xy"] - v["mx"] * v["my"]) * 2 + SSIM_C2)
+        / ((v["mx"] * v["mx"] + v["my"] * v["my"] + SSIM_C1)
+           * (v["xx"] - v["mx"] * v["mx"] + v["yy"] - v["my"] * v["my"] + SSIM_C2)) * v["w"],
+        mx=mx, my=my, xx=xx, yy=yy, xy=xy, w=weight,
+    )
+
+    # Средние по всем блокам — BOX-уменьшение до одного пикселя
+    def total(img: Image.Image) -> float:
+        return img.resize((1, 1), Image.BOX).getpixel((0, 0))
+
+    return total(weighted) / total(weight)
+
+
+def edge_ssim(reference: Image.Image, candidate: Image.Image) -> float:
+    """SSIM градиентов: насколько кандидат сохранил края штрихов эталона."""
+    ref, cand = reference.convert("L"), candidate.convert("L")
+    return min(_block_ssim(ref.filter(k), cand.filter(k)) for k in (_SOBEL_X, _SOBEL_Y))
+
+
+def _colored_share(img: Image.Image) -> float:
+    """Доля заметно цветных пикселей (max - min по каналам не меньше ``COLOR_CHROMA``)."""
+    r, g, b = img.convert("RGB").split()
+    chroma = ImageChops.subtract(ImageChops.lighter(ImageChops.lighter(r, g), b),
+                                 ImageChops.darker(ImageChops.darker(r, g), b))
+    hist = chroma.histogram()
+    return sum(hist[COLOR_CHROMA:]) / max(1, img.width * img.height)
+
+
+def _binarize(gray: Image.Image) -> Image.Image:
+    """Порог Оцу по гистограмме, без дизеринга."""
+    hist = gray.histogram()
+    total = sum(hist)
+    sum_all = sum(i * h for i, h in enumerate(hist))
+    best, threshold = -1.0, 128
+    weight = acc = 0
+    for t, count in enumerate(hist):
+        weight += count
+        acc += t * count
+        if weight == 0 or weight == total:
+            continue
+        m0, m1 = acc / weight, (sum_all - acc) / (total - weight)
+        between = weight * (total - weight) * (m0 - m1) ** 2
+        if between > best:
+            best, threshold = between, t
+    return gray.point(lambda v: 255 if v > threshold else 0).convert("1", dither=Image.Dither.NONE)
+
+
+def _families(img: Image.Image) -> List[Tuple[str, Callable[[], Image.Image], str, Tuple[Optional[int], ...]]]:
+    """Семейства кандидатов: (вариант, построение изображения, формат, уровни качества)."""
+    if _colored_share(img) > COLOR_SHARE:
+        return [("rgb", lambda: img, "WEBP", QUALITIES), ("rgb", lambda: img, "JPEG", QUALITIES)]
+    gray = img.convert("L")
+    return [
+        ("binary", lambda: _binarize(gray), "PNG", (None,)),
+        ("gray", lambda: gray, "WEBP", QUALITIES),
+        ("gray", lambda: gray, "JPEG", QUALITIES),
+    ]
+
+
+def encode_tile(img: Image.Image, min_ssim: float, max_bytes: int = 0) -> EncodedTile:
+    """Самое компактное кодирование тайла, прошедшее проверку читаемости.
+
+    ``min_ssim`` — порог ``edge_ssim`` (0 — кодировщик выключен, всегда
+    базовый RGB JPEG q92). Семейства перебираются от самых компактных;
+    первый прошедший вариант не больше ``max_bytes`` сразу принимается,
+    остальные семейства не кодируются. Без бюджета (0) или если в него
+    ничего не уложилось — берётся самый маленький из прошедших.
+    """
+    variant, fmt, quality = BASELINE
+    baseline = _save(img, fmt, quality)
+    best = EncodedTile(baseline, fmt, variant, quality, 1.0, len(baseline))
+    if min_ssim <= 0:
+        return best
+
+    passed = []
+    for variant, build, fmt, qualities in _families(img):
+        candidate = build()
+        for quality in qualities:
+            data = _save(candidate, fmt, quality)
+            if len(data) >= len(baseline):
+                break
+            score = edge_ssim(img, Image.open(BytesIO(data)))
+            if score >= min_ssim:
+                encoded = EncodedTile(data, fmt, variant, quality, score, len(baseline))
+                if max_bytes and len(data) <= max_bytes:
+                    return encoded
+                passed.append(encoded)
+                break
+    if passed:
+        best = min(passed, key=lambda e: len(e.data))
+    if max_bytes and len(best.data) > max_bytes:
+        logger.debug(f"Tile encoding {len(best.data)} bytes exceeds budget {max_bytes}")
+    return best
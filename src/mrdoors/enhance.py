@@ -0,0 +1,152 @@
+"""Усиление контраста и резкости перед нарезкой на тайлы.
+
+Два взаимозаменяемых движка (``PREPROCESS_BACKEND``):
+
+* ``pillow`` — цепочка ``ImageEnhance.Contrast`` → ``ImageEnhance.Sharpness``
+  → ``ImageFilter.UnsharpMask``: три прохода и три промежуточных изображения;
+* ``numpy`` — те же операции одним конвейером над одним float32-буфером
+  (плюс два рабочих буфера), все шаги на месте, без копий между стадиями.
+
+Результаты совпадают с точностью до нескольких уровней яркости.
+"""
+
+import logging
+
+from PIL import Image, ImageEnhance, ImageFilter, ImageStat
+
+from .config import PREPROCESS_BACKEND
+
+try:
+    import numpy as np
+except ImportError:  # numpy нужен только движку numpy
+    np = None
+
+logger = logging.getLogger(__name__)
+
+CONTRAST = 1.3
+SHARPNESS = 1.4
+UNSHARP_RADIUS = 2
+UNSHARP_PERCENT = 150
+UNSHARP_THRESHOLD = 3
+# Гауссово размытие в Pillow — три прохода расширенного box-фильтра
+BLUR_PASSES = 3
+
+
+def enhance_pillow(img: Image.Image) -> Image.Image:
+    img = ImageEnhance.Contrast(img).enhance(CONTRAST)
+    img = ImageEnhance.Sharpness(img).enhance(SHARPNESS)
+    return img.filter(ImageFilter.UnsharpMask(radius=UNSHARP_RADIUS, percent=UNSHARP_PERCENT,
+                                              threshold=UNSHARP_THRESHOLD))
+
+
+def _extended_box(radius: float, passes: int):
+    """Целый радиус и вес крайних отсчётов box-фильтра, как в ImagingGaussianBlur."""
+    sigma2 = radius * radius / passes
+    full = int(((12 * sigma2 + 1) ** 0.5 - 1) // 2)
+    edge = (2 * full + 1) * (full * (full + 1) - 3 * sigma2) / (6 * (sigma2 - (full + 1) ** 2))
+    return full, edge
+
+
+def _box_pass(src, dst, axis: int, full: int, edge: float):
+    """Один проход расширенного box-фильтра вдоль ``axis``: ``src`` → ``dst``.
+
+    Сумма не нормируется — делитель применяется один раз после всех
+    проходов. Края дополняются крайним пикселем (как в Pillow) только на
+    полосе шириной в радиус — без копирования всего буфера в np.pad.
+    """
+    n = src.shape[axis]
+    reach = full + 1
+
+    def cut(arr, start, stop):
+        return arr[:, start:stop] if axis == 1 else arr[start:stop]
+
+    # Сначала крайние отсчёты с весом edge — так не нужен отдельный буфер
+    inner = cut(dst, reach, n - reach)
+    np.add(cut(src, 0, n - 2 * reach), cut(src, 2 * reach, n), out=inner)
+    inner *= edge
+    inner += cut(src, reach, n - reach)
+    for k in range(1, full + 1):
+        inner += cut(src, reach - k, n - reach - k)
+        inner += cut(src, reach + k, n - reach + k)
+
+    # Полосы у краёв: небольшой буфер с повторённым крайним пикселем
+    for start, stop in ((0, reach), (n - reach, n)):
+        lo, hi = max(start - reach, 0), min(stop + reach, n)
+        strip = cut(src, lo, hi)
+        padding = [(0, 0)] * src.ndim
+        padding[axis] = (reach - (start - lo), reach - (hi - stop))
+        padded = np.pad(strip, padding, mode="edge")
+        width = stop - start
+        acc = cut(padded, reach, reach + width).copy()
+        for k in range(1, full + 1):
+            acc += cut(padded, reach - k, reach - k + width)
+            acc += cut(padded, reach + k, reach + k + width)
+        acc += edge * (cut(padded, 0, width) + cut(padded, 2 * reach, 2 * reach + width))
+        np.copyto(cut(dst, start, stop), acc)
+
+
+def enhance_numpy(img: Image.Image) -> Image.Image:
+    if np is None:
+        raise RuntimeError("PREPROCESS_BACKEND=numpy требует пакет numpy")
+    # Среднее по яркости — как у ImageEnhance.Contrast
+    mean = int(ImageStat.Stat(img.convert("L")).mean[0] + 0.5)
+    pixels = np.asarray(img)
+    h, w, _ = pixels.shape
+    full, edge = _extended_box(UNSHARP_RADIUS, BLUR_PASSES)
+    # Резкости нужна рамка 3x3, box-проходу — по full + 1 отсчёту с каждой стороны
+    if min(h, w) < max(3, 2 * (full + 1)):
+        return enhance_pillow(img)
+
+    # Контраст: mean + k * (x - mean); умножение сразу создаёт float32-буфер
+    buf = np.multiply(pixels, np.float32(CONTRAST), dtype=np.float32)
+    tmp = np.empty_like(buf)
+    blur = np.empty_like(buf)
+    buf += mean * (1 - CONTRAST)
+    np.clip(buf, 0, 255, out=buf)
+
+    # Резкость: x + (s - 1) * (x - smooth), smooth = (сумма 3x3 + 4x) / 13 (ядро SMOOTH).
+    # Крайние пиксели Pillow оставляет как есть — считаем только внутреннюю часть.
+    row_sum = tmp[:, 1:-1]
+    np.add(buf[:, :-2], buf[:, 1:-1], out=row_sum)
+    row_sum += buf[:, 2:]
+    box = blur[1:-1, 1:-1]
+    np.add(tmp[:-2, 1:-1], tmp[1:-1, 1:-1], out=box)
+    box += tmp[2:, 1:-1]
+    inner = buf[1:-1, 1:-1]
+    inner *= SHARPNESS - (SHARPNESS - 1) * 4 / 13
+    box *= -(SHARPNESS - 1) / 13
+    inner += box
+    np.clip(buf, 0, 255, out=buf)
+
+    # Нерезкая маска: гауссово размытие, box-проходы попеременно пишут в blur и tmp
+    src, dst = buf, blur
+    for axis in (1, 0):
+        for _ in range(BLUR_PASSES):
+            _box_pass(src, dst, axis, full, edge)
+            src, dst = dst, (tmp if dst is blur else blur)
+    # src — размытое изображение без нормировки, dst свободен; diff = x - blurred
+    diff = src
+    diff *= -(2 * full + 1 + 2 * edge) ** (-2 * BLUR_PASSES)
+    diff += buf
+    mask = dst
+    np.abs(diff, out=mask)
+    np.greater_equal(mask, UNSHARP_THRESHOLD, out=mask, casting="unsafe")
+    diff *= UNSHARP_PERCENT / 100
+    np.trunc(diff, out=diff)
+    diff *= mask
+    buf += diff
+    np.clip(buf, 0, 255, out=buf)
+    return Image.fromarray(buf.astype(np.uint8), "RGB")
+
+
+BACKENDS = {"pillow": enhance_pillow, "numpy": enhance_numpy}
+
+if PREPROCESS_BACKEND not in BACKENDS:
+    raise ValueError(f"PREPROCESS_BACKEND должен быть одним из: {', '.join(BACKENDS)}")
+if PREPROCESS_BACKEND == "numpy" and np is None:
+    raise ValueError("PREPROCESS_BACKEND=numpy требует пакет numpy: pip install numpy")
+
+
+def enhance(img: Image.Image, backend: str = PREPROCESS_BACKEND) -> Image.Image:
+    """Усилить контраст и резкость RGB-изображения выбранным движком."""
+    return BACKENDS[backend](img)
@@ -0,0 +1,190 @@
+"""Хеджирование медленных запросов к OpenAI.
+
+p99 одного запроса к vision-модели в разы больше медианы, а фото ждёт все
+свои тайлы — ответ определяет самый медленный. Если запрос не ответил за
+перцентиль недавних задержек модели (время самого вызова, без очереди
+лимитов, под той моделью, что ответила), вдогонку уходит дубликат к той
+же или запасной модели; берётся первый ответ, второй отменяется. Доля дубликатов ограничена бюджетом
+(``HEDGE_MAX_EXTRA`` дополнительных запросов на один обычный).
+
+В синхронном рантайме HTTP-запрос проигравшего прервать нельзя: его ответ
+отбрасывается, а токены и стоимость пишутся в аналитику, чтобы перерасход
+был виден. В асинхронном проигравший отменяется.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError as FutureTimeout, wait
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+from .analytics import CostCalculator, RequestStats, analytics
+from .config import (
+    HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES, HEDGE_MIN_DELAY, HEDGE_MAX_EXTRA, HEDGE_MODEL, OPENAI_MAX_CONCURRENCY,
+)
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних задержек модели учитывается в перцентиле
+WINDOW = 200
+# Сколько неизрасходованного бюджета можно накопить (дубликатов подряд)
+MAX_CREDIT = 5.0
+
+# Результат хеджированного вызова: ответ, модель ответившего запроса, сведения для аналитики
+Hedged = Tuple[Any, str, Optional[Dict[str, Any]]]
+
+
+def percentile(values, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+
+class Hedger:
+    """Порог хеджирования по задержкам моделей и бюджет дубликатов."""
+
+    def __init__(self, q: float = HEDGE_PERCENTILE, min_samples: int = HEDGE_MIN_SAMPLES,
+                 min_delay: float = HEDGE_MIN_DELAY, max_extra: float = HEDGE_MAX_EXTRA, model: str = HEDGE_MODEL):
+        self.q = q
+        self.min_samples = max(1, min_samples)
+        self.min_delay = min_delay
+        self.max_extra = max_extra
+        self.model = model
+        self._latencies: Dict[str, Deque[float]] = {}
+        self._credit = 0.0
+        self._lock = threading.Lock()
+        self._pool: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_extra > 0
+
+    def observe(self, model: str, duration: float):
+        """Учесть задержку успешного запроса модели."""
+        with self._lock:
+            self._latencies.setdefault(model, deque(maxlen=WINDOW)).append(duration)
+
+    def delay(self, model: str) -> Optional[float]:
+        """Через сколько секунд без ответа запрос хеджируется (``None`` — не хеджируется).
+
+        Заодно начисляет бюджет: каждый обычный запрос даёт ``max_extra`` дубликата.
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            self._credit = min(MAX_CREDIT, self._credit + self.max_extra)
+            latencies = self._latencies.get(model)
+            if latencies is None or len(latencies) < self.min_samples:
+                return None
+            return max(self.min_delay, percentile(latencies, self.q))
+
+    def _spend(self) -> bool:
+        with self._lock:
+            if self._credit < 1.0:
+                return False
+            self._credit -= 1.0
+            return True
+
+    def backup_model(self, model: str) -> str:
+        return self.model or model
+
+    def _get_pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                # Основной запрос и дубликат на каждый одновременный тайл
+                self._pool = ThreadPoolExecutor(max_workers=2 * OPENAI_MAX_CONCURRENCY, thread_name_prefix="hedge")
+            return self._pool
+
+    def call(self, fn: Callable[[str, str], Any], model: str, req_id: str) -> Hedged:
+        """Вызвать ``fn(model, req_id)`` с хеджированием."""
+        delay = self.delay(model)
+        if delay is None:
+            return fn(model, req_id), model, None
+        pool = self._get_pool()
+        primary = pool.submit(fn, model, req_id)
+        try:
+            return primary.result(timeout=delay), model, None
+        except FutureTimeout:
+            pass
+        if not self._spend():
+            return primary.result(), model, None
+
+        backup_model, backup_id = self.backup_model(model), f"{req_id}~hedge"
+        logger.info(f"[{req_id}] No answer from {model} after {delay:.1f}s, hedging with {backup_model}")
+        backup = pool.submit(fn, backup_model, backup_id)
+        calls = {primary: (model, req_id, "primary"), backup: (backup_model, backup_id, "hedge")}
+        pending, error = set(calls), None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                for loser in pending:
+                    if not loser.cancel():
+                        loser.add_done_callback(lambda f, call=calls[loser]: self._record_loser(f, *call[:2]))
+                winner_model, _, role = calls[future]
+                logger.info(f"[{req_id}] Hedged call answered by {role} ({winner_model})")
+                return future.result(), winner_model, self._info(delay, backup_model, role)
+        raise error
+
+    async def call_async(self, fn: Callable[[str, str], Awaitable[Any]], model: str, req_id: str) -> Hedged:
+        """Асинхронный вариант ``call``; проигравший запрос отменяется."""
+        delay = self.delay(model)
+        if delay is None:
+            return await fn(model, req_id), model, None
+        primary = asyncio.ensure_future(fn(model, req_id))
+        tasks = {primary: (model, "primary")}
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done or not self._spend():
+                return await primary, model, None
+
+            backup_model = self.backup_model(model)
+            logger.info(f"[{req_id}] No answer from {model} after {delay:.1f}s, hedging with {backup_model}")
+            tasks[asyncio.ensure_future(fn(backup_model, f"{req_id}~hedge"))] = (backup_model, "hedge")
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    winner_model, role = tasks[task]
+                    logger.info(f"[{req_id}] Hedged call answered by {role} ({winner_model})")
+                    return task.result(), winner_model, self._info(delay, backup_model, role)
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @staticmethod
+    def _info(delay: float, backup_model: str, won: str) -> Dict[str, Any]:
+        return {"delay": round(delay, 3), "model": backup_model, "won": won}
+
+    def _record_loser(self, future: Future, model: str, req_id: str):
+        """Ответ проигравшего запроса уже не нужен, но оплачен — в аналитику."""
+        if future.cancelled() or future.exception() is not None:
+            return
+        usage = getattr(future.result(), "usage", None)
+        input_tokens = usage.prompt_tokens if usage else 0
+        output_tokens = usage.completion_tokens if usage else 0
+        try:
+            analytics.add_request(RequestStats(
+                duration=0.0,
+                input_tokens=input_tokens,
+                output_tokens=output_tokens,
+                cost_usd=CostCalculator.calculate_cost(model, input_tokens, output_tokens),
+                model=model,
+                request_id=f"{req_id}@lost",
+                status="success",
+                raw_prompt={"hedge": "lost"},
+                originated_at=time.time(),
+            ))
+        except Exception as e:
+            logger.debug(f"[{req_id}] Hedge loser analytics failed: {e}")
+
+
+# Глобальный хеджер процесса
+hedger = Hedger()
@@ -0,0 +1,193 @@
+"""Персистентная очередь заданий на SQLite (без внешнего брокера).
+
+Семантика — at-least-once: задание, взятое воркером, получает аренду
+(visibility timeout). Если воркер не подтвердил его до истечения аренды
+(упал, был убит при рестарте), задание снова становится видимым.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+RUNNING = "running"
+DEAD = "dead"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    lease_token TEXT,
+    worker TEXT,
+    last_error TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, available_at);
+"""
+
+
+@dataclass
+class Job:
+    """Взятое в работу задание."""
+    id: int
+    kind: str
+    payload: Dict[str, Any]
+    attempts: int
+    lease_token: str
+    created_at: float
+
+
+class JobQueue:
+    """Очередь заданий в файле SQLite, общая для процесса бота и воркеров."""
+
+    def __init__(self, path: str, visibility_timeout: float = 300.0, max_attempts: int = 3):
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max(1, max_attempts)
+        self._local = threading.local()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        # Отдельное соединение на поток: sqlite3 не любит общих соединений
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def enqueue(self, kind: str, payload: Dict[str, Any], delay: float = 0.0) -> int:
+        """Поставить задание в очередь. Возвращает id задания."""
+        now = time.time()
+        cur = self._connect().execute(
+            "INSERT INTO jobs (kind, payload, status, available_at, created_at) VALUES (?, ?, ?, ?, ?)",
+            (kind, json.dumps(payload, ensure_ascii=False), PENDING, now + delay, now),
+        )
+        return cur.lastrowid
+
+    def claim(self, worker: str) -> Optional[Job]:
+        """Взять самое старое доступное задание и арендовать его.
+
+        Доступны ожидающие задания и задания с истёкшей арендой.
+        """
+        conn = self._connect()
+        now = time.time()
+        token = uuid.uuid4().hex
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status IN (?, ?) AND available_at <= ? ORDER BY id LIMIT 1",
+                (PENDING, RUNNING, now),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            if row["status"] == RUNNING:
+                logger.warning(f"Job {row['id']} lease expired (worker={row['worker']}), redelivering")
+            conn.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts + 1, available_at = ?, lease_token = ?, worker = ? "
+                "WHERE id = ?",
+                (RUNNING, now + self.visibility_timeout, token, worker, row["id"]),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return Job(
+            id=row["id"],
+            kind=row["kind"],
+            payload=json.loads(row["payload"]),
+            attempts=row["attempts"] + 1,
+            lease_token=token,
+            created_at=row["created_at"],
+        )
+
+    def extend(self, job: Job) -> bool:
+        """Продлить аренду. False — аренда уже потеряна."""
+        cur = self._connect().execute(
+            "UPDATE jobs SET available_at = ? WHERE id = ? AND lease_token = ? AND status = ?",
+            (time.time() + self.visibility_timeout, job.id, job.lease_token, RUNNING),
+        )
+        return cur.rowcount == 1
+
+    def ack(self, job: Job) -> bool:
+        """Подтвердить выполнение: задание удаляется из очереди."""
+        cur = self._connect().execute(
+            "DELETE FROM jobs WHERE id = ? AND lease_token = ?", (job.id, job.lease_token)
+        )
+        return cur.rowcount == 1
+
+    def fail(self, job: Job, error: str, retry_delay: float = 5.0) -> bool:
+        """Отметить неудачную попытку: повтор позже или dead после max_attempts."""
+        if job.attempts >= self.max_attempts:
+            status, available_at = DEAD, time.time()
+            logger.error(f"Job {job.id} is dead after {job.attempts} attempts: {error}")
+        else:
+            status, available_at = PENDING, time.time() + retry_delay
+        cur = self._connect().execute(
+            "UPDATE jobs SET status = ?, available_at = ?, lease_token = NULL, last_error = ? "
+            "WHERE id = ? AND lease_token = ?",
+            (status, available_at, error[:2000], job.id, job.lease_token),
+        )
+        return cur.rowcount == 1
+
+    def release(self, job: Job) -> bool:
+        """Вернуть задание в очередь без учёта попытки (штатная остановка воркера)."""
+        cur = self._connect().execute(
+            "UPDATE jobs SET status = ?, available_at = ?, attempts = MAX(attempts - 1, 0), lease_token = NULL "
+            "WHERE id = ? AND lease_token = ?",
+            (PENDING, time.time(), job.id, job.lease_token),
+        )
+        return cur.rowcount == 1
+
+    def recover(self, stale: Callable[[str], bool]) -> int:
+        """Вернуть в очередь задания, чьи воркеры заведомо мертвы.
+
+        ``stale(worker)`` решает по идентификатору аренды, что её держатель
+        завершился. Остальные задания в работе не трогаются: очередь могут
+        делить несколько процессов, и их аренды освободятся сами по истечении
+        ``visibility_timeout``.
+        """
+        conn = self._connect()
+        rows = conn.execute("SELECT id, worker FROM jobs WHERE status = ?", (RUNNING,)).fetchall()
+        recovered = 0
+        for row in rows:
+            if row["worker"] and stale(row["worker"]):
+                cur = conn.execute(
+                    "UPDATE jobs SET status = ?, available_at = ?, lease_token = NULL WHERE id = ? AND status = ?",
+                    (PENDING, time.time(), row["id"], RUNNING),
+                )
+                recovered += cur.rowcount
+        if recovered:
+            logger.info(f"Recovered {recovered} jobs left by dead workers")
+        return recovered
+
+    def stats(self) -> Dict[str, int]:
+        """Количество заданий по статусам."""
+        rows = self._connect().execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        counts = {PENDING: 0, RUNNING: 0, DEAD: 0}
+        counts.update({row["status"]: row["n"] for row in rows})
+        return counts
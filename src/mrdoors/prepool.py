@@ -0,0 +1,190 @@
+"""Пул процессов для препроцессинга фото.
+
+Декодирование, усиление, нарезка и JPEG-кодирование тайлов — CPU-работа,
+которую в потоках telebot сериализует GIL. Пул держит ``workers`` тёплых
+процессов (PIL и движок препроцессинга загружены заранее). Байты фото
+передаются через разделяемую память (страницу документа процесс читает
+сам из временного файла), тайлы возвращаются так же — по каналу между
+процессами идут только имена сегментов, пути и смещения.
+
+Одновременно в пул принимается не больше ``max_pending`` фото; остальные
+ждут свободного места до ``timeout`` секунд (back-pressure), затем
+получают ``PreprocessBusy``.
+"""
+
+import logging
+import multiprocessing
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import Any, Dict, List, Optional, Tuple
+
+from .config import PREPROCESS_WORKERS, PREPROCESS_MAX_PENDING, PREPROCESS_TIMEOUT
+from .tilecache import TileSignature
+from .tiling import Rect
+from .utils import Tile, TileSet
+
+logger = logging.getLogger(__name__)
+
+# Поля RenderedTile без данных, плюс (смещение, длина) данных внутри выходного сегмента
+SharedTile = Tuple[int, Rect, Tuple[int, int], Optional[TileSignature], str, Dict[str, Any], int, int]
+
+
+class PreprocessBusy(Exception):
+    """Пул препроцессинга перегружен: фото не дождалось свободного места."""
+
+
+def _warm_worker():
+    """Инициализатор процесса: заранее загрузить PIL, кодеки и движок препроцессинга."""
+    from PIL import Image
+
+    from . import utils  # noqa: F401 — импорт тянет enhance/numpy и кэш тайлов
+
+    Image.init()
+
+
+def _ping() -> bool:
+    return True
+
+
+def _render_shared(in_name: str, size: int, params: dict) -> Tuple[Optional[str], int, List[SharedTile]]:
+    """Выполняется в процессе пула: фото из сегмента ``in_name``, тайлы — в новый сегмент.
+
+    Возвращает имя сегмента, число тайлов в раскладке и расположение тайлов.
+    """
+    from .utils import render_tiles
+
+    shm_in = shared_memory.SharedMemory(name=in_name)
+    try:
+        data = bytes(shm_in.buf[:size])
+    finally:
+        shm_in.close()
+
+    return _share_tiles(*render_tiles(data, **params))
+
+
+def _render_page_shared(path: str, page: int, params: dict) -> Tuple[Optional[str], int, List[SharedTile]]:
+    """Выполняется в процессе пула: страница документа читается из файла, тайлы — в новый сегмент."""
+    from .documents import render_page
+
+    return _share_tiles(*render_page(path, page, **params))
+
+
+def _share_tiles(planned: int, tiles: list) -> Tuple[Optional[str], int, List[SharedTile]]:
+    """Сложить данные тайлов в новый сегмент: ``(имя сегмента, тайлов в раскладке, расположение)``."""
+    total = sum(len(tile.data) for tile in tiles)
+    if total == 0:
+        return None, planned, []
+
+    shm_out = shared_memory.SharedMemory(create=True, size=total)
+    layout = []
+    offset = 0
+    for tile in tiles:
+        shm_out.buf[offset:offset + len(tile.data)] = tile.data
+        layout.append((*tile[:-1], offset, len(tile.data)))
+        offset += len(tile.data)
+    # Сегмент удаляет вызывающий процесс, когда прочитает тайлы
+    shm_out.close()
+    return shm_out.name, planned, layout
+
+
+class PreprocessPool:
+    """Тёплый пул процессов с передачей данных через разделяемую память."""
+
+    def __init__(self, workers: int = PREPROCESS_WORKERS, max_pending: int = PREPROCESS_MAX_PENDING,
+                 timeout: float = PREPROCESS_TIMEOUT):
+        self.workers = workers
+        self.max_pending = max(1, max_pending or 2 * workers)
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def enabled(self) -> bool:
+        # Процессы-воркеры очереди — демоны, им нельзя заводить дочерние процессы
+        return self.workers > 0 and not multiprocessing.current_process().daemon
+
+    def start(self) -> ProcessPoolExecutor:
+        """Запустить процессы заранее, чтобы первое фото не ждало их старта."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_warm_worker,
+                )
+                for future in [self._executor.submit(_ping) for _ in range(self.workers)]:
+                    future.result()
+                logger.info(f"Preprocess pool started with {self.workers} processes")
+            return self._executor
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def _reset(self, executor: ProcessPoolExecutor):
+        """Пересоздать пул после падения процесса (следующий вызов поднимет новый)."""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def render(self, data: bytes, **params) -> TileSet:
+        """Препроцессинг и нарезка фото в пуле. Параметры — как у ``preprocess_and_tile``."""
+        with self._slot():
+            shm_in = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+            try:
+                shm_in.buf[:len(data)] = data
+                return self._collect(*self._run(_render_shared, shm_in.name, len(data), params))
+            finally:
+                shm_in.close()
+                shm_in.unlink()
+
+    def render_page(self, path: str, page: int, **params) -> TileSet:
+        """Страница документа из файла ``path`` — декодирование и нарезка в пуле."""
+        with self._slot():
+            return self._collect(*self._run(_render_page_shared, path, page, params))
+
+    @contextmanager
+    def _slot(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PreprocessBusy(f"no free preprocess slot in {self.timeout:.0f}s")
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    def _run(self, fn, *args):
+        executor = self.start()
+        try:
+            return executor.submit(fn, *args).result()
+        except BrokenProcessPool:
+            self._reset(executor)
+            raise
+
+    @staticmethod
+    def _collect(out_name: Optional[str], planned: int, layout: List[SharedTile]) -> TileSet:
+        if out_name is None:
+            return TileSet([], planned)
+        shm_out = shared_memory.SharedMemory(name=out_name)
+        try:
+            # Одна копия из сегмента на все тайлы; тайлы держат срезы без копирования
+            total = sum(entry[-1] for entry in layout)
+            blob = memoryview(bytes(shm_out.buf[:total]))
+        finally:
+            shm_out.close()
+            shm_out.unlink()
+        return TileSet([
+            Tile(index=index, data=blob[offset:offset + length], mime=mime, phash=phash,
+                 rect=tuple(rect), size=tuple(size), encoding=encoding)
+            for index, rect, size, phash, mime, encoding, offset, length in layout
+        ], planned)
+
+
+# Глобальный пул препроцессинга (процессы поднимаются при первом фото или в run_bot)
+preprocess_pool = PreprocessPool()
@@ -0,0 +1,86 @@
+"""Постепенная выдача результата: одно сообщение, которое редактируется по мере готовности тайлов."""
+
+import logging
+import threading
+import time
+from typing import Dict, Optional
+
+from telebot import util
+
+logger = logging.getLogger(__name__)
+
+
+class EditThrottle:
+    """Минимальный интервал между правками сообщений в одном чате.
+
+    Telegram ограничивает частоту запросов на чат; правки всех сообщений
+    чата делят один бюджет, поэтому учёт общий.
+    """
+
+    def __init__(self, min_interval: float):
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._last: Dict[int, float] = {}
+
+    def delay(self, chat_id: int) -> float:
+        """Сколько ещё ждать до следующей правки в чате."""
+        with self._lock:
+            last = self._last.get(chat_id)
+        if last is None:
+            return 0.0
+        return max(0.0, last + self.min_interval - time.monotonic())
+
+    def mark(self, chat_id: int):
+        with self._lock:
+            self._last[chat_id] = time.monotonic()
+            # Не копим записи о давно неактивных чатах
+            if len(self._last) > 10_000:
+                cutoff = time.monotonic() - 3600
+                self._last = {k: v for k, v in self._last.items() if v > cutoff}
+
+
+class ProgressiveReply:
+    """Статусное сообщение, которое переписывается по мере распознавания."""
+
+    def __init__(self, bot, chat_id: int, message_id: int, throttle: EditThrottle):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.throttle = throttle
+        self._text: Optional[str] = None
+
+    def _edit(self, text: str) -> bool:
+        if text == self._text:
+            return True
+        try:
+            self.bot.edit_message_text(text, self.chat_id, self.message_id)
+        except Exception as e:
+            if "message is not modified" in str(e):
+                return True
+            logger.debug(f"[{self.chat_id}:{self.message_id}] edit failed: {e}")
+            return False
+        finally:
+            self.throttle.mark(self.chat_id)
+        self._text = text
+        return True
+
+    def update(self, text: str):
+        """Показать промежуточный результат, если позволяет лимит правок."""
+        # Пропущенная правка не теряется: следующая или итоговая покажет всё накопленное
+        if self.throttle.delay(self.chat_id) > 0:
+            return
+        self._edit(util.smart_split(text)[0])
+
+    def finish(self, text: str):
+        """Итоговый текст: правка выполняется обязательно (с ожиданием лимита)."""
+        parts = util.smart_split(text)
+        wait = self.throttle.delay(self.chat_id)
+        if wait > 0:
+            time.sleep(wait)
+        if not self._edit(parts[0]):
+            # Сообщение недоступно для правки — отправим результат отдельно
+            for part in parts:
+                self.bot.send_message(self.chat_id, part)
+            return
+        for part in parts[1:]:
+            self.bot.send_message(self.chat_id, part)
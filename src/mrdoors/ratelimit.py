@@ -0,0 +1,272 @@
+"""Планировщик запросов к OpenAI с учётом лимитов RPM/TPM.
+
+Для каждой модели — два token bucket (запросы и токены в минуту) и очередь
+ожидающих запросов с round-robin по чатам: один пользователь с 40 фото
+не вытесняет остальных.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from .config import OPENAI_RPM_LIMIT, OPENAI_TPM_LIMIT, OPENAI_RATE_LIMITS
+
+logger = logging.getLogger(__name__)
+
+# Начальная оценка токенов на запрос, пока нет реальных данных usage
+DEFAULT_TOKENS_ESTIMATE = 1500
+
+
+class TokenBucket:
+    """Token bucket с пополнением ``rate_per_minute`` единиц в минуту.
+
+    Баланс может уходить в минус: так учитывается перерасход, когда реальное
+    потребление оказалось больше оценки.
+    """
+
+    def __init__(self, rate_per_minute: float, clock=time.monotonic):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(rate_per_minute)
+        self.enabled = rate_per_minute > 0
+        self._clock = clock
+        self._tokens = self.capacity
+        self._updated = clock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float, now: Optional[float] = None) -> float:
+        """Сколько секунд ждать, пока в корзине будет ``amount``."""
+        if not self.enabled:
+            return 0.0
+        now = self._clock() if now is None else now
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self._tokens >= amount:
+            return 0.0
+        return (amount - self._tokens) / self.rate
+
+    def consume(self, amount: float):
+        if self.enabled:
+            self._refill(self._clock())
+            self._tokens -= amount
+
+    def pause(self, seconds: float):
+        """Опустошить корзину так, чтобы она восстановилась через ``seconds``."""
+        if self.enabled:
+            self._refill(self._clock())
+            self._tokens = min(self._tokens, -seconds * self.rate)
+
+
+@dataclass
+class Ticket:
+    """Заявка на один запрос к OpenAI."""
+    chat_id: str
+    tokens: float
+    enqueued_at: float
+    granted_at: Optional[float] = None
+
+    @property
+    def waited(self) -> float:
+        return (self.granted_at or self.enqueued_at) - self.enqueued_at
+
+
+@dataclass
+class _Metrics:
+    granted: int = 0
+    throttled: int = 0
+    waits: Deque[float] = field(default_factory=lambda: deque(maxlen=500))
+
+
+class OpenAIScheduler:
+    """Лимиты RPM/TPM одной модели и справедливая очередь по чатам."""
+
+    def __init__(self, rpm: int = 0, tpm: int = 0, clock=time.monotonic):
+        self._clock = clock
+        self.requests = TokenBucket(rpm, clock)
+        self.tokens = TokenBucket(tpm, clock)
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        # chat_id -> очередь заявок; порядок ключей — очередь round-robin
+        self._queues: "OrderedDict[str, Deque[Ticket]]" = OrderedDict()
+        self._estimate = float(DEFAULT_TOKENS_ESTIMATE)
+        self._metrics = _Metrics()
+
+    @property
+    def enabled(self) -> bool:
+        return self.requests.enabled or self.tokens.enabled
+
+    def estimate_tokens(self) -> float:
+        """Оценка токенов следующего запроса по реальному usage прошлых."""
+        return self._estimate
+
+    def _enqueue(self, chat_id: Optional[str], tokens: Optional[float]) -> Ticket:
+        ticket = Ticket(
+            chat_id=str(chat_id or "-"),
+            tokens=self._estimate if tokens is None else tokens,
+            enqueued_at=self._clock(),
+        )
+        self._queues.setdefault(ticket.chat_id, deque()).append(ticket)
+        return ticket
+
+    def _dispatch(self) -> float:
+        """Выдать разрешения, сколько позволяют корзины. Возвращает время до следующей попытки."""
+        while self._queues:
+            chat_id, queue = next(iter(self._queues.items()))
+            ticket = queue[0]
+            now = self._clock()
+            wait = max(self.requests.wait_time(1, now), self.tokens.wait_time(ticket.tokens, now))
+            if wait > 0:
+                return wait
+            self.requests.consume(1)
+            self.tokens.consume(ticket.tokens)
+            ticket.granted_at = now
+            queue.popleft()
+            # Чат уходит в конец очереди — следующим обслуживается другой чат
+            del self._queues[chat_id]
+            if queue:
+                self._queues[chat_id] = queue
+            self._metrics.granted += 1
+            self._metrics.waits.append(ticket.waited)
+            self._cond.notify_all()
+        return 0.0
+
+    def acquire(self, chat_id: Optional[str] = None, tokens: Optional[float] = None) -> Ticket:
+        """Дождаться своей очереди (блокирующий вызов)."""
+        with self._cond:
+            ticket = self._enqueue(chat_id, tokens)
+            while True:
+                wait = self._dispatch()
+                if ticket.granted_at is not None:
+                    return ticket
+                self._cond.wait(timeout=min(wait, 1.0) if wait > 0 else 1.0)
+
+    async def acquire_async(self, chat_id: Optional[str] = None, tokens: Optional[float] = None) -> Ticket:
+        """Дождаться своей очереди, не блокируя event loop."""
+        with self._lock:
+            ticket = self._enqueue(chat_id, tokens)
+        try:
+            while True:
+                with self._lock:
+                    wait = self._dispatch()
+                    if ticket.granted_at is not None:
+                        return ticket
+                await asyncio.sleep(min(max(wait, 0.01), 0.25))
+        except asyncio.CancelledError:
+            # Проигравший хеджированный запрос или остановка: заявка не должна тратить лимиты
+            self.cancel(ticket)
+            raise
+
+    def cancel(self, ticket: Ticket):
+        """Отказаться от заявки: ожидающую убрать из очереди, уже выданной вернуть оценку токенов."""
+        with self._lock:
+            if ticket.granted_at is None:
+                queue = self._queues.get(ticket.chat_id)
+                for i, queued in enumerate(queue or ()):
+                    if queued is ticket:
+                        del queue[i]
+                        break
+                if queue is not None and not queue:
+                    del self._queues[ticket.chat_id]
+                return
+        self.complete(ticket, 0)
+
+    def complete(self, ticket: Ticket, used_tokens: int):
+        """Сверить оценку с реальным usage и обновить оценку следующих запросов."""
+        with self._lock:
+            self.tokens.consume(used_tokens - ticket.tokens)
+            if used_tokens > 0:
+                self._estimate = 0.8 * self._estimate + 0.2 * used_tokens
+
+    def throttled(self, ticket: Ticket, retry_after: float):
+        """OpenAI ответил 429: вернуть токены и приостановить выдачу на ``retry_after``."""
+        with self._lock:
+            self.tokens.consume(-ticket.tokens)
+            self.requests.pause(retry_after)
+            self._metrics.throttled += 1
+
+    def metrics(self) -> Dict[str, Any]:
+        """Глубина очереди и время ожидания."""
+        with self._lock:
+            waits = sorted(self._metrics.waits)
+            return {
+                "queue_depth": sum(len(q) for q in self._queues.values()),
+                "chats_waiting": len(self._queues),
+                "granted": self._metrics.granted,
+                "throttled": self._metrics.throttled,
+                "wait_avg": sum(waits) / len(waits) if waits else 0.0,
+                "wait_p95": waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+                "wait_max": waits[-1] if waits else 0.0,
+                "tokens_estimate": self._estimate,
+            }
+
+
+def parse_rate_limits(spec: str) -> Dict[str, Tuple[int, int]]:
+    """Разобрать ``"gpt-4o=500:30000,gpt-4o-mini=500:200000"`` в {модель: (rpm, tpm)}."""
+    limits = {}
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        model, _, values = part.partition("=")
+        rpm, _, tpm = values.partition(":")
+        limits[model.strip()] = (int(rpm or 0), int(tpm or 0))
+    return limits
+
+
+class RateLimiter:
+    """Планировщики по моделям: у OpenAI лимиты считаются отдельно на модель."""
+
+    def __init__(self, rpm: int = OPENAI_RPM_LIMIT, tpm: int = OPENAI_TPM_LIMIT,
+                 per_model: Optional[Dict[str, Tuple[int, int]]] = None):
+        self.default = (rpm, tpm)
+        self.per_model = per_model or {}
+        self._schedulers: Dict[str, OpenAIScheduler] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return any(self.default) or any(any(v) for v in self.per_model.values())
+
+    def for_model(self, model: str) -> OpenAIScheduler:
+        with self._lock:
+            if model not in self._schedulers:
+                rpm, tpm = self.per_model.get(model, self.default)
+                self._schedulers[model] = OpenAIScheduler(rpm, tpm)
+            return self._schedulers[model]
+
+    def metrics(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            schedulers = dict(self._schedulers)
+        return {model: s.metrics() for model, s in schedulers.items()}
+
+    def format_metrics(self) -> str:
+        """Сводка для /stats."""
+        lines = []
+        for model, m in self.metrics().items():
+            lines.append(
+                f"  {model}: в очереди {m['queue_depth']} (чатов {m['chats_waiting']}), "
+                f"ожидание ср. {m['wait_avg']:.1f}с / p95 {m['wait_p95']:.1f}с, 429: {m['throttled']}"
+            )
+        return "\n".join(lines)
+
+
+def retry_after_seconds(exc: Exception, default: float = 2.0) -> float:
+    """Пауза из заголовков 429-ответа OpenAI."""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    for name in ("retry-after-ms", "retry-after"):
+        value = headers.get(name)
+        if value:
+            try:
+                seconds = float(value)
+            except ValueError:
+                continue
+            return seconds / 1000.0 if name.endswith("-ms") else seconds
+    return default
+
+
+# Глобальный планировщик процесса
+rate_limiter = RateLimiter(per_model=parse_rate_limits(OPENAI_RATE_LIMITS))
@@ -0,0 +1,425 @@
+"""Параллельное распознавание тайлов через OpenAI."""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, field, replace
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+from openai import OpenAI
+
+from . import utils
+from .analytics import RequestStats
+from .cache import cache_key, recognition_cache, single_flight
+from .config import (
+    TILE_CONCURRENCY, OPENAI_MAX_CONCURRENCY, TILES_PER_REQUEST, TILE_MIN_INK, TILE_LAYOUT, TILE_TARGET_SIDE, TILE_MAX_COUNT,
+    TILE_OVERLAP, TILE_MIN_SCALE, TILE_MIN_SSIM, TILE_MAX_BYTES,
+)
+from .prepool import PreprocessBusy, preprocess_pool
+from .tiling import Position, Rect, merge_numbers
+
+logger = logging.getLogger(__name__)
+
+# Параметры нарезки фото на тайлы; входят в ключ кэша распознавания
+TILING = {"max_side": 2000, "min_ink": TILE_MIN_INK, "overlap": TILE_OVERLAP, "min_scale": TILE_MIN_SCALE,
+          "min_ssim": TILE_MIN_SSIM, "max_bytes": TILE_MAX_BYTES}
+if TILE_LAYOUT == "adaptive":
+    TILING.update(layout="adaptive", target_side=TILE_TARGET_SIDE, max_tiles=TILE_MAX_COUNT)
+elif TILE_LAYOUT == "grid":
+    TILING.update(cols=2, rows=3)
+else:
+    raise ValueError("TILE_LAYOUT должен быть adaptive или grid")
+
+
+class PhotoError(Exception):
+    """Фото не удалось получить или подготовить; ``user_message`` — текст для пользователя.
+
+    ``retryable`` — ошибка временная (сеть, перегрузка): повтор может пройти.
+    """
+
+    def __init__(self, user_message: str, retryable: bool = False):
+        super().__init__(user_message)
+        self.user_message = user_message
+        self.retryable = retryable
+
+
+class RetryableError(Exception):
+    """Временная ошибка задания очереди: пользователю не отвечаем, воркер повторит задание."""
+
+
+@dataclass
+class TileResult:
+    """Результат распознавания одного тайла."""
+    index: int  # номер тайла, начиная с 1
+    req_id: str = ""  # запрос (фото), к которому относится тайл
+    numbers: List[str] = field(default_factory=list)
+    stats: List[RequestStats] = field(default_factory=list)
+    error: Optional[str] = None
+    rect: Optional[Rect] = None  # область фото, покрытая тайлом
+    positions: List[Optional[Position]] = field(default_factory=list)  # примерные позиции чисел в тайле
+
+    @property
+    def succeeded(self) -> bool:
+        """Тайл дошёл до OpenAI и попал в аналитику."""
+        return bool(self.stats)
+
+
+class TileExecutor:
+    """Ограниченный пул для одновременных запросов к OpenAI.
+
+    Пул общий для всех фото процесса, поэтому ``max_workers`` — глобальный
+    лимит. ``per_photo`` ограничивает число одновременно запущенных тайлов
+    одного фото, чтобы одно большое фото не занимало весь пул.
+    ``tiles_per_request`` — сколько тайлов одного фото уходит в одном
+    запросе (0 — все тайлы фото); лимиты считаются в запросах.
+    """
+
+    def __init__(self, max_workers: int = OPENAI_MAX_CONCURRENCY, per_photo: int = TILE_CONCURRENCY,
+                 tiles_per_request: int = TILES_PER_REQUEST):
+        self.max_workers = max(1, max_workers)
+        self.per_photo = max(1, per_photo)
+        self.tiles_per_request = max(0, tiles_per_request)
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._pool_lock = threading.Lock()
+
+    def _get_pool(self) -> ThreadPoolExecutor:
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="tile")
+            return self._pool
+
+    def shutdown(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+    def _run_tile(self, tile: utils.Tile, req_id: str, client: OpenAI) -> TileResult:
+        result = TileResult(index=tile.index, req_id=req_id, rect=tile.rect)
+        try:
+            result.numbers = utils.ask_openai_for_numbers(
+                tile.payload,
+                f"{req_id}#t{tile.index}",
+                client,
+                collected=result.stats,
+                phash=tile.phash,
+                positions=result.positions,
+                image_info=tile.image_info,
+            )
+        except Exception as e:
+            logger.warning(f"[{req_id}] Tile {tile.index} failed: {e}")
+            result.error = str(e)
+        finally:
+            # Тайл отправлен — буфер изображения больше не нужен
+            tile.release()
+        return result
+
+    def _run_group(self, tiles: List[utils.Tile], req_id: str, client: OpenAI) -> List[TileResult]:
+        """Тайлы одного фото одним запросом; непонятые моделью тайлы переспрашиваются по одному."""
+        if len(tiles) == 1:
+            return [self._run_tile(tiles[0], req_id, client)]
+        results = [TileResult(index=tile.index, req_id=req_id, rect=tile.rect) for tile in tiles]
+        try:
+            answers = utils.ask_openai_for_tiles(tiles, req_id, client)
+            for result, answer in zip(results, answers):
+                result.numbers, result.positions, result.stats = answer
+        except Exception as e:
+            logger.warning(f"[{req_id}] Tiles {[t.index for t in tiles]} failed: {e}")
+            for result in results:
+                result.error = str(e)
+        finally:
+            for tile in tiles:
+                tile.release()
+        return results
+
+    def recognize(self, tiles: List[utils.Tile], req_id: str, client: OpenAI,
+                  on_result: Optional[Callable[[TileResult], None]] = None) -> List[TileResult]:
+        """Распознать тайлы фото. Результаты возвращаются в порядке тайлов.
+
+        ``on_result`` вызывается в вызывающем потоке по мере готовности тайлов.
+        """
+        jobs = [(req_id, tile) for tile in tiles]
+        return self.recognize_many(jobs, client, self.per_photo, on_result)
+
+    def recognize_many(self, jobs: List[Tuple[str, utils.Tile]], client: OpenAI, limit: int,
+                       on_result: Optional[Callable[[TileResult], None]] = None) -> List[TileResult]:
+        """Распознать тайлы нескольких фото с общим лимитом ``limit``.
+
+        ``jobs`` — список ``(req_id, tile)``; результаты — в том же порядке.
+        Подряд идущие тайлы одного фото объединяются в запросы по
+        ``tiles_per_request``.
+        """
+        results: List[Optional[TileResult]] = [None] * len(jobs)
+        pending = group_jobs(jobs, self.tiles_per_request)
+        pending.reverse()
+        in_flight = {}
+        pool = self._get_pool()
+        limit = max(1, limit)
+
+        while pending or in_flight:
+            # Скользящее окно: не больше limit запросов одновременно
+            while pending and len(in_flight) < limit:
+                group = pending.pop()
+                tiles = [jobs[pos][1] for pos in group]
+                in_flight[pool.submit(self._run_group, tiles, jobs[group[0]][0], client)] = group
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                for pos, result in zip(in_flight.pop(future), future.result()):
+                    results[pos] = result
+                    if on_result is not None:
+                        try:
+                            on_result(result)
+                        except Exception as e:
+                            logger.debug(f"[{result.req_id}] on_result callback failed: {e}")
+
+        return [r for r in results if r is not None]
+
+    def run_bounded(self, calls: List[Callable[[], Any]], limit: int) -> List[Any]:
+        """Выполнить ``calls`` в пуле, не больше ``limit`` одновременно; результаты — в том же порядке.
+
+        Вызовы не должны сами ставить работу в этот пул: ожидание внутри
+        пула может его исчерпать.
+        """
+        results: List[Any] = [None] * len(calls)
+        pending = list(enumerate(calls))
+        pending.reverse()
+        in_flight = {}
+        pool = self._get_pool()
+        limit = max(1, limit)
+        error: Optional[BaseException] = None
+
+        while pending or in_flight:
+            while pending and len(in_flight) < limit and error is None:
+                pos, call = pending.pop()
+                in_flight[pool.submit(call)] = pos
+            if not in_flight:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                pos = in_flight.pop(future)
+                try:
+                    results[pos] = future.result()
+                except BaseException as e:
+                    # Запущенные вызовы дожидаемся, новые не запускаем
+                    error = error or e
+        if error is not None:
+            raise error
+        return results
+
+
+def group_jobs(jobs: List[Tuple[str, utils.Tile]], size: int) -> List[List[int]]:
+    """Позиции ``jobs`` по запросам: подряд идущие тайлы одного фото, не больше ``size`` (0 — без ограничения)."""
+    groups: List[List[int]] = []
+    for pos, (req_id, _) in enumerate(jobs):
+        last = groups[-1] if groups else None
+        if last and size != 1 and jobs[last[0]][0] == req_id and (size == 0 or len(last) < size):
+            last.append(pos)
+        else:
+            groups.append([pos])
+    return groups
+
+
+# Глобальный исполнитель тайлов
+tile_executor = TileExecutor()
+
+
+@dataclass
+class PhotoOutcome:
+    """Итог распознавания одного фото."""
+    numbers: List[str]
+    tile_count: int  # тайлов отправлено на распознавание
+    successful_tiles: int
+    cost_usd: float = 0.0
+    cached: bool = False  # результат из кэша или от параллельного запроса того же фото
+    skipped_tiles: int = 0  # пустые тайлы, отброшенные до OpenAI
+
+    @property
+    def failed(self) -> bool:
+        """Были тайлы для распознавания, но ни один не дошёл до OpenAI."""
+        return self.tile_count > 0 and self.successful_tiles == 0
+
+    @classmethod
+    def from_results(cls, results: List[TileResult], tile_count: int, skipped_tiles: int = 0) -> "PhotoOutcome":
+        # Обрывки чисел на стыках перекрывающихся тайлов отбрасываются по позициям
+        numbers = merge_numbers((r.rect, r.numbers, r.positions) for r in results)
+        return cls(
+            numbers=numbers,
+            tile_count=tile_count,
+            successful_tiles=sum(1 for r in results if r.succeeded),
+            cost_usd=sum(s.cost_usd for r in results for s in r.stats),
+            skipped_tiles=skipped_tiles,
+        )
+
+
+def prepare_tiles(data: bytes, req_id: str) -> utils.TileSet:
+    """Препроцессинг и разбиение скачанного фото на тайлы (в пуле процессов, если он включён)."""
+    if preprocess_pool.enabled:
+        return run_preprocess(lambda: preprocess_pool.render(data, **TILING), req_id)
+    return run_preprocess(lambda: utils.preprocess_and_tile(data, **TILING), req_id)
+
+
+def run_preprocess(render: Callable[[], utils.TileSet], req_id: str) -> utils.TileSet:
+    """Выполнить препроцессинг, переведя ошибки в ``PhotoError`` с текстом для пользователя."""
+    try:
+        prepared = render()
+    except PhotoError:
+        raise
+    except PreprocessBusy as e:
+        logger.warning(f"[{req_id}] Preprocess pool saturated: {e}")
+        raise PhotoError("Бот сейчас перегружен. Попробуйте отправить фото через минуту.", retryable=True) from e
+    except Exception as e:
+        logger.error(f"[{req_id}] Failed to process image: {e}")
+        raise PhotoError("Ошибка при обработке изображения. Убедитесь, что это корректный файл изображения.") from e
+    logger.info(f"[{req_id}] Prepared {len(prepared.tiles)} tiles, skipped {prepared.skipped} blank")
+    return prepared
+
+
+def lookup_cached(data: bytes, req_id: str) -> Optional[PhotoOutcome]:
+    """Результат из кэша распознавания, если фото уже встречалось."""
+    if recognition_cache is None:
+        return None
+    key = cache_key(data, **TILING)
+    try:
+        entry = recognition_cache.get(key)
+    except Exception as e:
+        logger.warning(f"[{req_id}] Recognition cache read failed: {e}")
+        return None
+    if entry is None:
+        return None
+    logger.info(f"[{req_id}] Recognition cache hit {key[:12]}")
+    return PhotoOutcome(numbers=entry["numbers"], tile_count=entry["tiles"], successful_tiles=entry["tiles"],
+                        cached=True, skipped_tiles=entry.get("skipped", 0))
+
+
+def store_cached(data: bytes, req_id: str, outcome: PhotoOutcome):
+    """Сохранить результат, если распознаны все тайлы (частичный результат не кэшируем)."""
+    if recognition_cache is None or outcome.cached:
+        return
+    store_outcome(cache_key(data, **TILING), req_id, outcome)
+
+
+def store_outcome(key: str, req_id: str, outcome: PhotoOutcome):
+    """То же, что ``store_cached``, по готовому ключу кэша (когда байтов фото уже нет)."""
+    if recognition_cache is None or outcome.cached:
+        return
+    if outcome.tile_count == 0 or outcome.successful_tiles < outcome.tile_count:
+        return
+    try:
+        recognition_cache.put(key, {
+            "numbers": outcome.numbers, "tiles": outcome.tile_count, "skipped": outcome.skipped_tiles,
+        })
+    except Exception as e:
+        logger.warning(f"[{req_id}] Recognition cache write failed: {e}")
+
+
+def recognize_photo(data: bytes, req_id: str, client: OpenAI,
+                    on_progress: Optional[Callable[[TileResult, int], None]] = None) -> PhotoOutcome:
+    """Распознать скачанное фото с учётом кэша.
+
+    Одновременные запросы одного и того же фото схлопываются: распознаёт
+    первый, остальные получают его результат. ``on_progress(result, total)``
+    вызывается по мере готовности тайлов (только у распознающего запроса).
+    """
+    return recognize_prepared(data, lambda: prepare_tiles(data, req_id), req_id, client, on_progress)
+
+
+def recognize_prepared(data: bytes, prepare: Callable[[], utils.TileSet], req_id: str, client: OpenAI,
+                       on_progress: Optional[Callable[[TileResult, int], None]] = None) -> PhotoOutcome:
+    """То же, что ``recognize_photo``, с тайлами от ``prepare``; ``data`` — ключ для кэша."""
+    hit = lookup_cached(data, req_id)
+    if hit is not None:
+        return hit
+
+    def run() -> PhotoOutcome:
+        tiles, planned = prepare()
+        callback = None
+        if on_progress is not None:
+            callback = lambda result: on_progress(result, len(tiles))
+        results = tile_executor.recognize(tiles, req_id, client, on_result=callback)
+        outcome = PhotoOutcome.from_results(results, len(tiles), planned - len(tiles))
+        store_cached(data, req_id, outcome)
+        return outcome
+
+    if recognition_cache is None:
+        return run()
+    outcome, shared = single_flight.do(cache_key(data, **TILING), run)
+    if shared:
+        logger.info(f"[{req_id}] Reused result of a concurrent request for the same photo")
+        return replace(outcome, cost_usd=0.0, cached=True)
+    return outcome
+
+
+def recognize_album(photos: List[Tuple[str, Callable[[], bytes]]], client: OpenAI,
+                    limit: int) -> Dict[str, Union[PhotoOutcome, PhotoError]]:
+    """Распознать фото альбома одним пакетом тайлов с общим лимитом ``limit``.
+
+    ``photos`` — ``(req_id, load)``, ``load()`` скачивает фото. Скачивание
+    и подготовка фото идут параллельно в пуле ``tile_executor`` (не больше
+    ``limit`` фото сразу), затем тайлы всех фото распознаются вместе. Как и
+    ``recognize_photo``, учитывает кэш и схлопывает фото, которое уже
+    распознаёт другой запрос. Фото, которое не удалось скачать или
+    подготовить, получает ``PhotoError`` вместо итога.
+    """
+    outcomes: Dict[str, Union[PhotoOutcome, PhotoError]] = {}
+    # Ключи у фото разные, поэтому потоки пула пишут в словари без блокировки
+    led = {}  # req_id → (байты, ключ, вызов single-flight, тайлы, размер раскладки)
+    followed = {}
+
+    def load(req_id: str, fetch: Callable[[], bytes]):
+        try:
+            data = fetch()
+        except PhotoError as e:
+            outcomes[req_id] = e
+            return
+        hit = lookup_cached(data, req_id)
+        if hit is not None:
+            outcomes[req_id] = hit
+            return
+        key, call = None, None
+        if recognition_cache is not None:
+            key = cache_key(data, **TILING)
+            call, leader = single_flight.begin(key)
+            if not leader:
+                followed[req_id] = call
+                return
+        try:
+            tiles, planned = prepare_tiles(data, req_id)
+        except BaseException as e:
+            if call is not None:
+                single_flight.finish(key, call, error=e)
+            if not isinstance(e, PhotoError):
+                raise
+            outcomes[req_id] = e
+            return
+        led[req_id] = (data, key, call, tiles, planned)
+
+    try:
+        tile_executor.run_bounded([lambda p=photo: load(*p) for photo in photos], limit)
+        jobs = [(req_id, tile) for req_id, _ in photos if req_id in led for tile in led[req_id][3]]
+        results = tile_executor.recognize_many(jobs, client, limit) if jobs else []
+        for req_id, _ in photos:
+            if req_id not in led:
+                continue
+            data, key, call, tiles, planned = led.pop(req_id)
+            outcome = PhotoOutcome.from_results([r for r in results if r.req_id == req_id], len(tiles),
+                                                planned - len(tiles))
+            store_cached(data, req_id, outcome)
+            if call is not None:
+                single_flight.finish(key, call, outcome)
+            outcomes[req_id] = outcome
+    except BaseException as e:
+        # Ожидающие этих фото в других запросах не должны зависнуть из-за нашей ошибки
+        for data, key, call, *_ in led.values():
+            if call is not None:
+                single_flight.finish(key, call, error=e)
+        raise
+
+    for req_id, call in followed.items():
+        try:
+            outcome = single_flight.wait(call)
+        except PhotoError as e:
+            outcomes[req_id] = e
+            continue
+        logger.info(f"[{req_id}] Reused result of a concurrent request for the same photo")
+        outcomes[req_id] = replace(outcome, cost_usd=0.0, cached=True)
+    return outcomes
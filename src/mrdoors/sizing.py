@@ -0,0 +1,104 @@
+"""Размер тайлов с учётом того, как OpenAI считает токены изображений.
+
+Изображение в режиме ``detail=high`` OpenAI сначала вписывает в
+2048x2048, затем уменьшает так, чтобы короткая сторона была не больше
+768 px, и считает блоки 512x512: ``tokens = base + per_block * blocks``.
+Тайл, отправленный с увеличением 2x, всё равно ужимается на стороне
+OpenAI, а блок, в который попала пара лишних пикселей, оплачивается
+целиком.
+
+Планировщик выбирает масштаб (и, если края тайла пустые, обрезку) так,
+чтобы изображение уже было в пределах OpenAI, каждый пиксель рабочего
+изображения передавался не мельче ``min_scale`` и блоков было как можно
+меньше. Для всех моделей из ``CostCalculator.PRICING`` токены растут с
+числом блоков, поэтому лучший размер у них общий, различается только
+прогноз токенов.
+"""
+
+import math
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+from .tiling import Rect
+
+MAX_SIDE = 2048
+MAX_SHORT_SIDE = 768
+BLOCK = 512
+# (base, per_block) токенов изображения detail=high; ключи — как в CostCalculator.PRICING
+VISION_TOKENS = {
+    'gpt-4o': (85, 170),
+    'gpt-4o-mini': (2833, 5667),
+}
+# Увеличивать тайл сильнее не имеет смысла — резкости это не добавит
+MAX_UPSCALE = 2.0
+
+
+def billed_size(width: int, height: int) -> Tuple[int, int]:
+    """Размер, до которого OpenAI приведёт изображение перед подсчётом блоков."""
+    k = min(1.0, MAX_SIDE / max(width, height))
+    width, height = width * k, height * k
+    k = min(1.0, MAX_SHORT_SIDE / min(width, height))
+    return max(1, int(width * k)), max(1, int(height * k))
+
+
+def billed_blocks(width: int, height: int) -> int:
+    w, h = billed_size(width, height)
+    return math.ceil(w / BLOCK) * math.ceil(h / BLOCK)
+
+
+def image_tokens(model: str, width: int, height: int) -> int:
+    """Прогноз токенов изображения для модели (неизвестная модель считается как gpt-4o)."""
+    base, per_block = VISION_TOKENS.get(model, VISION_TOKENS['gpt-4o'])
+    return base + per_block * billed_blocks(width, height)
+
+
+def _scaled(width: int, height: int, scale: float) -> Tuple[int, int]:
+    return max(1, int(width * scale + 1e-6)), max(1, int(height * scale + 1e-6))
+
+
+def plan_scale(width: int, height: int, min_scale: float) -> float:
+    """Масштаб тайла ``width`` x ``height``: минимум блоков при масштабе не ниже ``min_scale``.
+
+    Если ``min_scale`` не помещается в пределы OpenAI, берётся наибольший
+    допустимый масштаб — OpenAI всё равно уменьшил бы тайл до него.
+    """
+    top = min(MAX_UPSCALE, MAX_SIDE / max(width, height), MAX_SHORT_SIDE / min(width, height))
+    if min_scale >= top:
+        return top
+    # Число блоков меняется только там, где сторона кратна 512 — это и есть кандидаты
+    candidates = {min_scale, top}
+    for side in (width, height):
+        for k in range(1, MAX_SIDE // BLOCK + 1):
+            scale = BLOCK * k / side
+            if min_scale <= scale <= top:
+                candidates.add(scale)
+    # Меньше блоков, при равенстве — крупнее (больше деталей за те же деньги)
+    return min(candidates, key=lambda s: (billed_blocks(*_scaled(width, height, s)), -s))
+
+
+@dataclass
+class TilePlan:
+    """Что отправить: область рабочего изображения и размер после масштабирования."""
+    rect: Rect
+    size: Tuple[int, int]
+    blocks: int
+
+
+def plan_tile(rect: Rect, ink_box: Optional[Rect], min_scale: float, margin: int = 8) -> TilePlan:
+    """Выбрать обрезку и масштаб тайла.
+
+    ``ink_box`` — область с чернилами внутри ``rect`` (в тех же координатах).
+    Пустые полосы по краям срезаются, только если это экономит блоки.
+    """
+    crops = [rect]
+    if ink_box is not None:
+        crops.append((max(rect[0], ink_box[0] - margin), max(rect[1], ink_box[1] - margin),
+                      min(rect[2], ink_box[2] + margin), min(rect[3], ink_box[3] + margin)))
+    best = None
+    for crop in crops:
+        width, height = crop[2] - crop[0], crop[3] - crop[1]
+        size = _scaled(width, height, plan_scale(width, height, min_scale))
+        plan = TilePlan(crop, size, billed_blocks(*size))
+        if best is None or plan.blocks < best.blocks:
+            best = plan
+    return best
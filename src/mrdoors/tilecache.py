@@ -0,0 +1,271 @@
+"""Кэш распознанных тайлов по перцептивной сигнатуре.
+
+Повторная отправка того же чертежа даёт другие байты, но почти те же
+тайлы. Сигнатура тайла (``signature``) — карта чернил, обрезанная по
+содержимому: dHash этой карты служит ключом индекса, бинарная маска —
+для проверки кандидата. Кандидаты ищутся среди тайлов, чей хэш отличается
+не больше чем на ``max_distance`` бит (BK-дерево в памяти), и
+принимаются, только если маски совпадают поблочно (``mask_mismatch``):
+хэш одного шаблона с другими цифрами почти не меняется, а маска — да.
+Записи хранятся в SQLite и подгружаются при старте.
+
+Проверка строгая: пересжатие, шум и сдвиг кадра она пропускает, а
+заметный поворот или перспектива дают промах — лучше лишний запрос к
+OpenAI, чем чужие числа.
+"""
+
+import base64
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, List, NamedTuple, Optional, Tuple
+
+from PIL import Image, ImageChops
+
+from .config import TILE_CACHE_PATH, TILE_CACHE_DISTANCE, TILE_CACHE_MAX_ENTRIES
+from .tiling import INK_CONTRAST, _ink_map
+
+logger = logging.getLogger(__name__)
+
+# Сторона уменьшенной копии для dHash: 16x16 = 256 бит
+HASH_SIZE = 16
+# Маска чернил хранится не крупнее этой стороны — цифры тайла остаются различимыми
+MASK_SIDE = 1024
+# Маски сравниваются блоками BLOCK x BLOCK; каждый блок можно сдвинуть до SHIFT пикселей
+BLOCK = 16
+SHIFT = 2
+# Кандидат принимается, если ни в одном блоке не расходится больше стольких пикселей
+MAX_BLOCK_MISMATCH = 14
+# Сколько ближайших кандидатов проверять по маске
+MAX_CANDIDATES = 4
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tiles (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    phash TEXT NOT NULL,
+    numbers TEXT NOT NULL,
+    version TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    mask BLOB NOT NULL
+);
+"""
+
+
+class TileSignature(NamedTuple):
+    """Сигнатура тайла для кэша: ключ индекса и маска для проверки кандидата."""
+    hash: int  # dHash карты чернил
+    width: int  # размер маски
+    height: int
+    mask: bytes  # бинарная маска чернил (режим "1"), сжатая zlib
+
+    def to_json(self) -> List[Any]:
+        return [format(self.hash, "x"), self.width, self.height, base64.b64encode(self.mask).decode("ascii")]
+
+    @classmethod
+    def from_json(cls, data: Optional[List[Any]]) -> Optional["TileSignature"]:
+        if not data:
+            return None
+        return cls(int(data[0], 16), data[1], data[2], base64.b64decode(data[3]))
+
+    def image(self) -> Image.Image:
+        """Маска как изображение ``L``: 255 — чернила."""
+        return Image.frombytes("1", (self.width, self.height), zlib.decompress(self.mask)).convert("L")
+
+
+def dhash(img: Image.Image, hash_size: int = HASH_SIZE) -> int:
+    """Разностный хэш: знак перепада яркости между соседними пикселями."""
+    small = img.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = small.tobytes()
+    width = hash_size + 1
+    value = 0
+    for row in range(hash_size):
+        offset = row * width
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def signature(img: Image.Image) -> TileSignature:
+    """Сигнатура тайла: dHash и маска карты чернил, обрезанной по содержимому.
+
+    Обрезка по чернилам и карта вместо яркости делают сигнатуру
+    нечувствительной к полям кадра, освещению и цвету бумаги.
+    """
+    gray = img.convert("L")
+    gray.thumbnail((MASK_SIDE, MASK_SIDE))
+    ink = _ink_map(gray)
+    mask = ink.point(lambda v: 255 if v >= INK_CONTRAST else 0)
+    box = mask.getbbox()
+    if box is not None:
+        ink, mask = ink.crop(box), mask.crop(box)
+    return TileSignature(dhash(ink), mask.width, mask.height, zlib.compress(mask.convert("1").tobytes()))
+
+
+def mask_mismatch(a: TileSignature, b: TileSignature) -> int:
+    """Наибольшее число расходящихся пикселей в блоке масок ``a`` и ``b``.
+
+    Маска ``b`` приводится к размеру ``a``; каждый блок ``a`` сравнивается
+    с лучшим из сдвигов ``b`` на расстояние до ``SHIFT`` пикселей, так что
+    небольшие сдвиги и искажения кадра не считаются расхождением.
+    """
+    if a.width < BLOCK or a.height < BLOCK or b.width < BLOCK or b.height < BLOCK:
+        # Почти пустые тайлы сравнивать не по чему
+        return BLOCK * BLOCK
+    x = a.image()
+    y = b.image().resize(x.size, Image.NEAREST)
+    padded = Image.new("L", (x.width + 2 * SHIFT, x.height + 2 * SHIFT), 0)
+    padded.paste(y, (SHIFT, SHIFT))
+    best = None
+    for dy in range(2 * SHIFT + 1):
+        for dx in range(2 * SHIFT + 1):
+            window = padded.crop((dx, dy, dx + x.width, dy + x.height))
+            # Средняя доля расхождения по блокам; минимум по сдвигам — попиксельно
+            blocks = ImageChops.difference(x, window).reduce(BLOCK)
+            best = blocks if best is None else ImageChops.darker(best, blocks)
+    return round(best.getextrema()[1] / 255 * BLOCK * BLOCK)
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """BK-дерево для поиска ближайших хэшей по расстоянию Хэмминга."""
+
+    def __init__(self):
+        # Узел: [хэш, значения (свежие первыми), {расстояние: дочерний узел}]
+        self._root: Optional[list] = None
+        self.size = 0
+
+    def add(self, key: int, value: Any):
+        self.size += 1
+        if self._root is None:
+            self._root = [key, [value], {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming(key, node[0])
+            if distance == 0:
+                # Тот же хэш бывает у разных тайлов (один шаблон, другие цифры) — храним все
+                node[1].insert(0, value)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [key, [value], {}]
+                return
+            node = child
+
+    def search(self, key: int, radius: int) -> List[Tuple[int, Any]]:
+        """Все значения с расстоянием до ``key`` не больше ``radius``, ближайшие первыми."""
+        found = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(key, node[0])
+            if distance <= radius:
+                found.extend((distance, value) for value in node[1])
+            # Неравенство треугольника отсекает поддеревья вне радиуса
+            for edge, child in node[2].items():
+                if distance - radius <= edge <= distance + radius:
+                    stack.append(child)
+        # Сортировка устойчивая: при равном расстоянии свежие остаются первыми
+        found.sort(key=lambda item: item[0])
+        return found
+
+
+class TileCache:
+    """Кэш чисел по сигнатуре тайла с BK-индексом, проверкой по маске и хранением в SQLite."""
+
+    def __init__(self, path: str, max_distance: int, max_entries: int, version: str,
+                 max_mismatch: int = MAX_BLOCK_MISMATCH):
+        self.path = path
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.version = version
+        self.max_mismatch = max_mismatch
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._tree = BKTree()
+
+    def _ensure_loaded(self) -> sqlite3.Connection:
+        # Вызывается под self._lock; файл открывается при первом обращении
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(tiles)")}
+            if columns and "mask" not in columns:
+                # Записи без маски проверить нельзя — прежний формат кэша сбрасывается
+                conn.execute("DROP TABLE tiles")
+            conn.executescript(_SCHEMA)
+            # Записи от другого промпта или модели не годятся
+            conn.execute("DELETE FROM tiles WHERE version != ?", (self.version,))
+            self._conn = conn
+            self._rebuild()
+        return self._conn
+
+    def _rebuild(self):
+        self._tree = BKTree()
+        rows = self._conn.execute(
+            "SELECT id, phash, numbers FROM tiles ORDER BY id DESC LIMIT ?", (self.max_entries,)
+        ).fetchall()
+        # Сначала старые, чтобы при совпадении хэшей свежий результат проверялся первым
+        for row_id, phash, numbers in reversed(rows):
+            self._tree.add(int(phash, 16), (row_id, json.loads(numbers)))
+        logger.info(f"Tile cache loaded {self._tree.size} entries from {self.path}")
+
+    def _stored(self, row_id: int) -> Optional[TileSignature]:
+        with self._lock:
+            row = self._conn.execute("SELECT phash, width, height, mask FROM tiles WHERE id = ?",
+                                     (row_id,)).fetchone()
+        if row is None:
+            return None
+        return TileSignature(int(row[0], 16), row[1], row[2], row[3])
+
+    def lookup(self, sig: TileSignature) -> Optional[Tuple[List[str], int]]:
+        """Числа ближайшего тайла, прошедшего проверку по маске, и расстояние между хэшами."""
+        with self._lock:
+            self._ensure_loaded()
+            matches = self._tree.search(sig.hash, self.max_distance)
+        for distance, (row_id, numbers) in matches[:MAX_CANDIDATES]:
+            stored = self._stored(row_id)
+            if stored is None:
+                continue
+            mismatch = mask_mismatch(sig, stored)
+            if mismatch <= self.max_mismatch:
+                return list(numbers), distance
+            logger.debug(f"Tile cache candidate {row_id} rejected: distance {distance}, "
+                         f"{mismatch} mismatched pixels in a block")
+        return None
+
+    def add(self, sig: TileSignature, numbers: List[str]):
+        with self._lock:
+            conn = self._ensure_loaded()
+            cursor = conn.execute(
+                "INSERT INTO tiles (phash, numbers, version, created_at, width, height, mask) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (format(sig.hash, "x"), json.dumps(numbers), self.version, time.time(),
+                 sig.width, sig.height, sig.mask),
+            )
+            self._tree.add(sig.hash, (cursor.lastrowid, list(numbers)))
+            if self._tree.size > self.max_entries * 1.1:
+                # Из BK-дерева нельзя удалять — срезаем старые записи и строим индекс заново
+                conn.execute(
+                    "DELETE FROM tiles WHERE id NOT IN (SELECT id FROM tiles ORDER BY id DESC LIMIT ?)",
+                    (self.max_entries,),
+                )
+                self._rebuild()
+
+
+def create_tile_cache(version: str) -> Optional[TileCache]:
+    """Кэш тайлов по настройкам окружения (None, если выключен)."""
+    if TILE_CACHE_MAX_ENTRIES <= 0 or TILE_CACHE_DISTANCE < 0:
+        return None
+    return TileCache(TILE_CACHE_PATH, TILE_CACHE_DISTANCE, TILE_CACHE_MAX_ENTRIES, version)
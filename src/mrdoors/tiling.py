@@ -0,0 +1,233 @@
+"""Раскладка фото на тайлы по «чернилам».
+
+Фиксированная сетка 2x3 режет любое фото одинаково: маленькая схема с
+парой размеров уходит в OpenAI шестью запросами, а разрезы проходят
+прямо через цифры. Адаптивная раскладка:
+
+* находит «чернила» (пиксели заметно темнее окружающей бумаги) на
+  уменьшенной копии и обрезает пустые поля;
+* выбирает число столбцов и строк по размеру содержимого в пикселях и
+  плотности чернил — маленькие и разреженные схемы идут одним-двумя
+  тайлами, плотные листы режутся мельче;
+* ставит разрезы по проекциям чернил на оси — в ближайший к равному
+  делению «просвет», где нет штрихов.
+
+Соседние тайлы перекрываются (``with_overlap``), чтобы число на стыке
+целиком попало хотя бы в один из них. Обрывки таких чисел с другого
+тайла убирает ``merge_numbers`` по примерным позициям из ответа модели.
+"""
+
+import math
+from dataclasses import dataclass
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+from PIL import Image, ImageChops, ImageFilter
+
+# Детектор пустых тайлов работает на уменьшенной копии с такой длинной стороной
+INK_ANALYSIS_SIDE = 256
+# На сколько уровней яркости пиксель должен быть темнее окружающей бумаги
+INK_CONTRAST = 40
+# Раскладка считается на копии побольше — разрезы ставятся точнее
+LAYOUT_ANALYSIS_SIDE = 512
+# Поля вокруг найденного содержимого, доля стороны фото
+CONTENT_MARGIN = 0.03
+# Плотность чернил (доля площади содержимого), для которой тайл — ровно target_side;
+# разреженные схемы режутся на тайлы крупнее, плотные — мельче
+REFERENCE_INK = 0.06
+TARGET_SCALE = (0.75, 1.5)
+# Разрез ищется в окне ±CUT_SLACK/2 длины тайла вокруг равного деления
+CUT_SLACK = 0.5
+# Ширина полосы (пиксели копии), которая должна быть пустой вокруг разреза
+CUT_BAND = 2
+# Обрывок и целое число считаются одним, если их центры ближе этой доли стороны тайла
+FRAGMENT_RADIUS = 0.15
+
+Rect = Tuple[int, int, int, int]
+# Примерный центр числа в процентах ширины и высоты тайла
+Position = Tuple[float, float]
+
+
+def _ink_map(gray: Image.Image) -> Image.Image:
+    """Насколько каждый пиксель темнее окружающей бумаги.
+
+    Фон — локальный максимум яркости, поэтому тени и неровное освещение
+    не считаются «чернилами»; лёгкое размытие гасит шум матрицы.
+    """
+    gray = gray.filter(ImageFilter.GaussianBlur(1.0))
+    paper = gray.filter(ImageFilter.MaxFilter(7))
+    return ImageChops.subtract(paper, gray)
+
+
+def _small_ink_map(img: Image.Image) -> Image.Image:
+    gray = img.convert('L')
+    gray.thumbnail((INK_ANALYSIS_SIDE, INK_ANALYSIS_SIDE))
+    return _ink_map(gray)
+
+
+def ink_pixels(img: Image.Image) -> int:
+    """Сколько пикселей заметно темнее окружающей бумаги (на уменьшенной копии)."""
+    return sum(_small_ink_map(img).histogram()[INK_CONTRAST:])
+
+
+def ink_box(img: Image.Image) -> Optional[Rect]:
+    """Область с чернилами в координатах ``img`` (с точностью до пикселя копии) или ``None``."""
+    mask = _small_ink_map(img).point(lambda v: 255 if v >= INK_CONTRAST else 0)
+    box = mask.getbbox()
+    if box is None:
+        return None
+    sx, sy = img.width / mask.width, img.height / mask.height
+    return (int(box[0] * sx), int(box[1] * sy),
+            min(img.width, math.ceil(box[2] * sx)), min(img.height, math.ceil(box[3] * sy)))
+
+
+@dataclass
+class TileLayout:
+    """Раскладка фото: сетка ``cols`` x ``rows`` и прямоугольники тайлов построчно."""
+    cols: int
+    rows: int
+    rects: List[Rect]
+
+
+def grid_layout(size: Tuple[int, int], cols: int, rows: int) -> TileLayout:
+    """Равномерная сетка ``cols`` x ``rows`` (последний ряд и столбец забирают остаток)."""
+    W, H = size
+    tile_w = max(W // cols, 1)
+    tile_h = max(H // rows, 1)
+    rects = []
+    for r in range(rows):
+        for c in range(cols):
+            right = W if c == cols - 1 else min((c + 1) * tile_w, W)
+            bottom = H if r == rows - 1 else min((r + 1) * tile_h, H)
+            rects.append((c * tile_w, r * tile_h, right, bottom))
+    return TileLayout(cols, rows, rects)
+
+
+def _profile(mask: Image.Image, axis: int) -> List[float]:
+    """Доля чернил в каждом столбце (``axis=0``) или строке (``axis=1``) маски."""
+    w, h = mask.size
+    size = (w, 1) if axis == 0 else (1, h)
+    return list(mask.convert('F').resize(size, Image.BOX).getdata())
+
+
+def _cuts(profile: List[float], parts: int) -> List[int]:
+    """Позиции ``parts - 1`` разрезов: самый пустой просвет рядом с равным делением."""
+    n = len(profile)
+    # Разрез «пустой», только если пуста и полоса вокруг него
+    band = [max(profile[max(0, j - CUT_BAND):j + CUT_BAND + 1]) for j in range(n)]
+    cuts = []
+    for i in range(1, parts):
+        ideal = i * n / parts
+        reach = n / parts * CUT_SLACK / 2
+        lo, hi = max(1, int(ideal - reach)), min(n - 1, int(ideal + reach))
+        cuts.append(min(range(lo, hi + 1), key=lambda j: (band[j], abs(j - ideal))))
+    return cuts
+
+
+def _grid_size(width: float, height: float, target: float, max_tiles: int) -> Tuple[int, int]:
+    cols = max(1, math.ceil(width / target))
+    rows = max(1, math.ceil(height / target))
+    while cols * rows > max(1, max_tiles):
+        # Убираем деление по той оси, где тайлы и так мельче
+        if width / cols < height / rows and cols > 1 or rows == 1:
+            cols -= 1
+        else:
+            rows -= 1
+    return cols, rows
+
+
+def adaptive_layout(img: Image.Image, target_side: int, max_tiles: int) -> TileLayout:
+    """Раскладка по содержимому: поля отрезаны, число и положение разрезов — по чернилам.
+
+    ``target_side`` — сторона тайла (в пикселях ``img``) для содержимого
+    обычной плотности, ``max_tiles`` — верхний предел числа тайлов.
+    """
+    W, H = img.size
+    gray = img.convert('L')
+    gray.thumbnail((LAYOUT_ANALYSIS_SIDE, LAYOUT_ANALYSIS_SIDE))
+    mask = _ink_map(gray).point(lambda v: 255 if v >= INK_CONTRAST else 0)
+    box: Optional[Rect] = mask.getbbox()
+    if box is None:
+        # Чернил не нашлось — отдаём фото целиком, детектор пустых тайлов решит сам
+        return TileLayout(1, 1, [(0, 0, W, H)])
+
+    aw, ah = mask.size
+    sx, sy = W / aw, H / ah
+    margin = round(CONTENT_MARGIN * max(aw, ah))
+    left, top = max(0, box[0] - margin), max(0, box[1] - margin)
+    right, bottom = min(aw, box[2] + margin), min(ah, box[3] + margin)
+    content = mask.crop((left, top, right, bottom))
+
+    density = content.histogram()[255] / max(1, content.width * content.height)
+    scale = math.sqrt(REFERENCE_INK / density) if density > 0 else TARGET_SCALE[1]
+    target = target_side * min(max(scale, TARGET_SCALE[0]), TARGET_SCALE[1])
+    cols, rows = _grid_size(content.width * sx, content.height * sy, target, max_tiles)
+
+    xs = [left, *(left + x for x in _cuts(_profile(content, 0), cols)), right]
+    ys = [top, *(top + y for y in _cuts(_profile(content, 1), rows)), bottom]
+    xs = [min(W, round(x * sx)) for x in xs]
+    ys = [min(H, round(y * sy)) for y in ys]
+    rects = [(xs[c], ys[r], xs[c + 1], ys[r + 1]) for r in range(rows) for c in range(cols)]
+    return TileLayout(cols, rows, rects)
+
+
+def with_overlap(layout: TileLayout, overlap: float) -> TileLayout:
+    """Расширить тайлы на ``overlap`` их ширины/высоты через внутренние стыки.
+
+    Внешние края раскладки (граница фото или обрезанных полей) не двигаются.
+    """
+    if overlap <= 0 or len(layout.rects) < 2:
+        return layout
+    x0 = min(r[0] for r in layout.rects)
+    y0 = min(r[1] for r in layout.rects)
+    x1 = max(r[2] for r in layout.rects)
+    y1 = max(r[3] for r in layout.rects)
+    rects = []
+    for left, top, right, bottom in layout.rects:
+        dx = round((right - left) * overlap)
+        dy = round((bottom - top) * overlap)
+        rects.append((
+            max(x0, left - dx) if left > x0 else left,
+            max(y0, top - dy) if top > y0 else top,
+            min(x1, right + dx) if right < x1 else right,
+            min(y1, bottom + dy) if bottom < y1 else bottom,
+        ))
+    return TileLayout(layout.cols, layout.rows, rects)
+
+
+def _inside(rect: Rect, point: Tuple[float, float]) -> bool:
+    return rect[0] <= point[0] <= rect[2] and rect[1] <= point[1] <= rect[3]
+
+
+def merge_numbers(tiles: Iterable[Tuple[Optional[Rect], Sequence[str], Sequence[Optional[Position]]]]) -> List[str]:
+    """Объединить числа тайлов с учётом перекрытий.
+
+    ``tiles`` — ``(прямоугольник тайла, числа, позиции)``; позиция —
+    примерный центр числа в процентах тайла или ``None``. Число в зоне
+    перекрытия, которое соседний тайл видит рядом как часть более
+    длинного («12» при «1250»), считается обрывком на стыке и отбрасывается.
+    Числа без прямоугольника или позиции просто объединяются.
+    """
+    found = []  # (номер тайла, прямоугольник, число, точка на фото или None)
+    for k, (rect, numbers, positions) in enumerate(tiles):
+        positions = list(positions) + [None] * (len(numbers) - len(positions))
+        for number, pos in zip(numbers, positions):
+            point = None
+            if rect is not None and pos is not None:
+                point = (rect[0] + (rect[2] - rect[0]) * pos[0] / 100,
+                         rect[1] + (rect[3] - rect[1]) * pos[1] / 100)
+            found.append((k, rect, number, point))
+
+    kept = set()
+    for k, rect, number, point in found:
+        fragment = False
+        if point is not None:
+            radius = FRAGMENT_RADIUS * max(rect[2] - rect[0], rect[3] - rect[1])
+            for other_k, other_rect, other, other_point in found:
+                if (other_k != k and other_point is not None and _inside(other_rect, point)
+                        and number != other and number.lstrip('-') in other
+                        and math.dist(point, other_point) <= radius):
+                    fragment = True
+                    break
+        if not fragment:
+            kept.add(number)
+    return sorted(kept, key=lambda x: (len(x), x))
@@ -1,31 +1,142 @@
 """Утилиты для обработки изображений и извлечения чисел."""
 
 import re
+import asyncio
 import base64
+import hashlib
 import json
 import logging
 import time
+from dataclasses import dataclass, replace
 from io import BytesIO
-from PIL import Image, ImageEnhance, ImageFilter
-from openai import OpenAI
-from .config import PREFERRED_MODEL, OPENAI_TIMEOUT, OPENAI_RETRIES
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+from PIL import Image
+from openai import OpenAI, AsyncOpenAI, RateLimitError
+from .config import (
+    PREFERRED_MODEL, OPENAI_TIMEOUT, OPENAI_RETRIES, OPENAI_RATE_LIMIT_RETRIES,
+    MODEL_CASCADE, CASCADE_MODEL, CASCADE_INK_PER_NUMBER, CASCADE_MAX_INVALID, CASCADE_MIN_AGREEMENT,
+)
 from .analytics import analytics, analytics_client, CostCalculator, RequestStats
+from .ratelimit import Ticket, rate_limiter, retry_after_seconds
+from .hedging import hedger
+from .breaker import breakers
+from .tilecache import TileSignature, create_tile_cache, signature
+from .enhance import enhance
+from .tiling import Position, Rect, adaptive_layout, grid_layout, ink_box, ink_pixels, with_overlap
+from .sizing import image_tokens, plan_tile
+from .encoding import encode_tile
 
 logger = logging.getLogger(__name__)
 
 NUMBER_REGEX = r"(?:(?<!\w)-)?\d+[\.,]?\d*"
+# Хвост ", x, y]" элемента ответа с позицией числа
+POSITION_TAIL = re.compile(r",\s*-?\d+(?:\.\d+)?\s*,\s*-?\d+(?:\.\d+)?\s*\]")
 
-SYSTEM_PROMPT = (
-    "Ты OCR-агент. Извлеки ВСЕ числовые значения с технического листа/чертежа (включая рукописные). "
-    "Возвращай СТРОГО JSON {\"numbers\":[\"...\"]} без лишнего текста. "
+# Правила для чисел — общие для запроса по одному тайлу и по группе тайлов
+NUMBER_RULES = (
     "Числа: целые/десятичные (разделитель точка). Диапазоны вида 65-85 верни как \"65\" и \"85\". "
+    "Число, обрезанное краем изображения, верни как видно. "
     "Игнорируй подписи/единицы/символы. Порядок слева-направо, сверху-вниз."
 )
 
+SYSTEM_PROMPT = (
+    "Ты OCR-агент. Извлеки ВСЕ числовые значения с технического листа/чертежа (включая рукописные). "
+    "Возвращай СТРОГО JSON {\"numbers\":[[\"...\",x,y]]} без лишнего текста, "
+    "где x и y — примерный центр числа в процентах ширины и высоты изображения (целые 0-100). "
+) + NUMBER_RULES
+
 USER_INSTRUCTION = (
-    "Извлеки все числа с изображения. Верни только JSON {\"numbers\":[\"...\"]}."
+    "Извлеки все числа с изображения. Верни только JSON {\"numbers\":[[\"...\",x,y]]}."
 )
 
+# Несколько тайлов одного фото в одном запросе (TILES_PER_REQUEST > 1)
+GROUP_SYSTEM_PROMPT = (
+    "Ты OCR-агент. Тебе дают несколько изображений — частей (тайлов) технического листа/чертежа, "
+    "перед каждым подпись «Тайл N». С КАЖДОГО тайла отдельно извлеки ВСЕ числовые значения (включая рукописные). "
+    "Возвращай СТРОГО JSON {\"tiles\":{\"N\":[[\"...\",x,y]]}} без лишнего текста, с ключом для каждого тайла, "
+    "где x и y — примерный центр числа в процентах ширины и высоты своего тайла (целые 0-100). "
+) + NUMBER_RULES
+
+GROUP_INSTRUCTION = (
+    "Извлеки все числа с каждого тайла. Верни только JSON {\"tiles\":{\"N\":[[\"...\",x,y]]}}."
+)
+
+
+def _models_to_try() -> List[str]:
+    """Очередность моделей: предпочтительная, затем дешёвый fallback."""
+    return [PREFERRED_MODEL, 'gpt-4o-mini'] if PREFERRED_MODEL != 'gpt-4o-mini' else ['gpt-4o-mini']
+
+
+def _tile_models() -> List[str]:
+    """Очередность моделей для одного тайла: в режиме каскада сначала дешёвая."""
+    if not MODEL_CASCADE or CASCADE_MODEL == PREFERRED_MODEL:
+        return _models_to_try()
+    return [CASCADE_MODEL, PREFERRED_MODEL]
+
+
+# Температура второго ответа дешёвой модели: при 0 он почти всегда повторяет первый
+SAMPLE_TEMPERATURE = 0.7
+
+
+# Предел ответа группового запроса (ответ на тайл — до 1200 токенов, как у одиночного)
+GROUP_MAX_TOKENS = 4096
+
+# Грубая оценка токенов текста промпта (кириллица — около 3 символов на токен) и служебных полей
+PROMPT_TEXT_TOKENS = (len(SYSTEM_PROMPT) + len(USER_INSTRUCTION)) // 3 + 10
+
+GROUP_PROMPT_TEXT_TOKENS = (len(GROUP_SYSTEM_PROMPT) + len(GROUP_INSTRUCTION)) // 3 + 10
+# Подпись «Тайл N» перед изображением
+GROUP_LABEL_TOKENS = 6
+
+# Меняется вместе с промптом или моделью — закэшированные результаты перестают совпадать
+PROMPT_VERSION = hashlib.sha256(
+    "\n".join([SYSTEM_PROMPT, USER_INSTRUCTION, *_tile_models()]).encode("utf-8")
+).hexdigest()[:16]
+
+# Глобальный кэш тайлов по перцептивному хэшу (None, если выключен)
+tile_cache = create_tile_cache(PROMPT_VERSION)
+
+
+@dataclass
+class Tile:
+    """Тайл фото, готовый к отправке в OpenAI.
+
+    Держит закодированное изображение одним ``memoryview`` без копий;
+    base64 и data URL строятся только при сериализации запроса
+    (``payload``). После распознавания буфер отпускается (``release``).
+    """
+    index: int  # номер тайла, начиная с 1
+    data: Optional[memoryview]  # закодированное изображение (не base64); None после release()
+    mime: str = "image/jpeg"
+    phash: Optional[TileSignature] = None  # сигнатура для кэша тайлов (None, если кэш выключен)
+    rect: Optional[Rect] = None  # область фото (после уменьшения до max_side), с перекрытием
+    size: Optional[Tuple[int, int]] = None  # размер отправляемого изображения, для прогноза токенов
+    encoding: Optional[Dict[str, Any]] = None  # как закодирован тайл (см. encoding.py) и ink — чернила тайла
+
+    @property
+    def data_url(self) -> str:
+        if self.data is None:
+            raise ValueError(f"Tile {self.index} data already released")
+        return f"data:{self.mime};base64," + base64.b64encode(self.data).decode('ascii')
+
+    @property
+    def payload(self) -> Dict[str, Any]:
+        # detail=high явно: от него зависит подсчёт токенов (см. sizing.py)
+        return {"type": "image_url", "image_url": {"url": self.data_url, "detail": "high"}}
+
+    def release(self):
+        """Отпустить буфер изображения — тайл уже отправлен и больше не нужен."""
+        if self.data is not None:
+            self.data.release()
+            self.data = None
+
+    @property
+    def image_info(self) -> Optional[Dict[str, Any]]:
+        """Размер и кодирование изображения — для прогноза токенов и аналитики."""
+        if self.size is None:
+            return None
+        return {"width": self.size[0], "height": self.size[1], **(self.encoding or {})}
+
 
 def normalize_num(token: str) -> str:
     """Нормализация числового токена."""
@@ -38,145 +149,914 @@ def normalize_num(token: str) -> str:
     return t
 
 
-def preprocess_and_tile(jpeg_bytes: bytes, max_side: int = 1800, cols: int = 2, rows: int = 3) -> list:
-    """Лёгкий препроцессинг без GPU и разбиение на тайлы. Возвращает список data URLs."""
-    img = Image.open(BytesIO(jpeg_bytes)).convert('RGB')
-    # Масштабирование с сохранением соотношения
+def load_image(data: bytes, max_side: int, draft: bool = True) -> Image.Image:
+    """Декодировать изображение в RGB, уменьшив длинную сторону до ``max_side``.
+
+    JPEG декодируется сразу в уменьшенном масштабе (DCT-scaling 1/2, 1/4,
+    1/8 — ближайший не меньше нужного), и LANCZOS досжимает только остаток.
+    Для больших снимков это экономит большую часть времени и памяти декодера.
+    """
+    img = Image.open(BytesIO(data))
     w, h = img.size
     k = max(w, h) / max_side if max(w, h) > max_side else 1.0
+    if draft and k > 1.0:
+        # draft() гарантирует размер не меньше запрошенного
+        img.draft('RGB', (int(w / k), int(h / k)))
+    img = img.convert('RGB')
     if k > 1.0:
-        img = img.resize((int(w / k), int(h / k)), Image.LANCZOS)
-    # Повышаем контраст/резкость
-    img = ImageEnhance.Contrast(img).enhance(1.3)
-    img = ImageEnhance.Sharpness(img).enhance(1.4)
-    img = img.filter(ImageFilter.UnsharpMask(radius=2, percent=150, threshold=3))
+        # reducing_gap: для не-JPEG сначала быстрое целочисленное reduce(), затем LANCZOS
+        img = img.resize((int(w / k), int(h / k)), Image.LANCZOS, reducing_gap=3.0)
+    return img
+
+
+class RenderedTile(NamedTuple):
+    """Тайл после препроцессинга — без объекта ``Tile``, чтобы дёшево передаваться между процессами."""
+    index: int  # номер тайла в раскладке, начиная с 1
+    rect: Rect  # область рабочего изображения
+    size: Tuple[int, int]  # размер отправляемого изображения
+    phash: Optional[TileSignature]
+    mime: str
+    encoding: Dict[str, Any]  # формат, вариант, байты (см. encoding.py) и чернила тайла — для аналитики
+    data: bytes  # закодированное изображение (base64 — только при отправке)
+
+
+def render_tiles(jpeg_bytes: bytes, max_side: int = 1800, cols: int = 2, rows: int = 3,
+                 min_ink: int = 0, **layout) -> Tuple[int, List[RenderedTile]]:
+    """Декодирование, препроцессинг и нарезка фото (см. ``render_image_tiles``)."""
+    return render_image_tiles(load_image(jpeg_bytes, max_side), cols, rows, min_ink, **layout)
+
+
+def render_image_tiles(img: Image.Image, cols: int = 2, rows: int = 3, min_ink: int = 0,
+                       layout: str = "grid", target_side: int = 800, max_tiles: int = 9,
+                       overlap: float = 0.0, min_scale: float = 1.0,
+                       min_ssim: float = 0.0, max_bytes: int = 0) -> Tuple[int, List[RenderedTile]]:
+    """Препроцессинг и нарезка декодированного изображения: ``(тайлов в раскладке, готовые тайлы)``.
+
+    ``layout="grid"`` — сетка ``cols`` x ``rows``; ``layout="adaptive"`` —
+    раскладка по содержимому (см. ``tiling.adaptive_layout``) с тайлами
+    около ``target_side`` и не больше ``max_tiles`` штук. Соседние тайлы
+    перекрываются на долю ``overlap`` своего размера. Масштаб тайла — не
+    меньше ``min_scale`` и с наименьшим числом оплачиваемых блоков OpenAI
+    (см. ``sizing.plan_tile``). С ``min_ssim > 0`` тайл кодируется самым
+    компактным читаемым вариантом (см. ``encoding.encode_tile``), иначе —
+    RGB JPEG q92.
 
-    W, H = img.size
-    tile_w = max(W // cols, 1)
-    tile_h = max(H // rows, 1)
+    Чистая CPU-работа без объектов ``Tile`` — её выполняют и процессы
+    пула препроцессинга (см. ``prepool.py``).
+    """
+    # Повышаем контраст/резкость (движок — PREPROCESS_BACKEND)
+    img = enhance(img)
+
+    if layout == "adaptive":
+        plan = adaptive_layout(img, target_side, max_tiles)
+    else:
+        plan = grid_layout(img.size, cols, rows)
+    plan = with_overlap(plan, overlap)
 
     tiles = []
-    for r in range(rows):
-        for c in range(cols):
-            left = c * tile_w
-            top = r * tile_h
-            right = W if c == cols - 1 else min((c + 1) * tile_w, W)
-            bottom = H if r == rows - 1 else min((r + 1) * tile_h, H)
-            tile = img.crop((left, top, right, bottom))
-            if tile.width == 0 or tile.height == 0:
-                logger.debug(f"Skipping empty tile {r=} {c=}")
-                continue
-            # Лёгкое увеличение каждого тайла для читаемости
-            tile = tile.resize((tile.width * 2, tile.height * 2), Image.LANCZOS)
-            buf = BytesIO()
-            tile.save(buf, format='JPEG', quality=92)
-            encoded = base64.b64encode(buf.getvalue()).decode('ascii')
-            tiles.append(f"data:image/jpeg;base64,{encoded}")
-    return tiles
-
-
-def ask_openai_for_numbers(image_payload, req_id: str, client: OpenAI):
-    """Запрос к OpenAI для извлечения чисел с изображения."""
-    models_to_try = [PREFERRED_MODEL, 'gpt-4o-mini'] if PREFERRED_MODEL != 'gpt-4o-mini' else ['gpt-4o-mini']
+    for position, rect in enumerate(plan.rects):
+        tile = img.crop(rect)
+        if tile.width == 0 or tile.height == 0:
+            logger.debug(f"Skipping empty tile {position + 1}")
+            continue
+        # Плотность чернил нужна и для отсева пустых тайлов, и каскаду моделей (ожидаемое число чисел)
+        ink = ink_pixels(tile)
+        if ink < min_ink:
+            logger.debug(f"Skipping blank tile {position + 1} ink={ink}")
+            continue
+        box = ink_box(tile)
+        if box is not None:
+            box = (rect[0] + box[0], rect[1] + box[1], rect[0] + box[2], rect[1] + box[3])
+        sizing = plan_tile(rect, box, min_scale)
+        if sizing.rect != rect:
+            tile = img.crop(sizing.rect)
+        # Сигнатуру считаем до масштабирования и только для включённого кэша тайлов
+        phash = signature(tile) if tile_cache is not None else None
+        tile = tile.resize(sizing.size, Image.LANCZOS)
+        encoded = encode_tile(tile, min_ssim, max_bytes)
+        tiles.append(RenderedTile(position + 1, sizing.rect, sizing.size, phash, encoded.mime,
+                                  {**encoded.info, "ink": ink}, encoded.data))
+    return len(plan.rects), tiles
+
+
+class TileSet(NamedTuple):
+    """Тайлы фото вместе с размером раскладки.
+
+    Раскладка хранится отдельно: если все тайлы пустые, список пуст,
+    а число отброшенных всё равно известно.
+    """
+    tiles: List[Tile]
+    planned: int  # сколько тайлов в раскладке фото, включая отброшенные пустые
+
+    @property
+    def skipped(self) -> int:
+        """Сколько тайлов раскладки отброшено как пустые."""
+        return self.planned - len(self.tiles)
+
+
+def preprocess_and_tile(jpeg_bytes: bytes, max_side: int = 1800, cols: int = 2, rows: int = 3,
+                        min_ink: int = 0, **layout) -> TileSet:
+    """Лёгкий препроцессинг без GPU и разбиение на тайлы.
+
+    Тайлы, где меньше ``min_ink`` «чернильных» пикселей (поля, пустая
+    бумага), не возвращаются; номер тайла — его позиция в раскладке.
+    Параметры раскладки, масштаба и кодирования (``layout``,
+    ``target_side``, ``max_tiles``, ``overlap``, ``min_scale``,
+    ``min_ssim``, ``max_bytes``) — как у ``render_image_tiles``.
+    """
+    return make_tiles(*render_tiles(jpeg_bytes, max_side, cols, rows, min_ink, **layout))
+
+
+def make_tiles(planned: int, tiles: List[RenderedTile]) -> TileSet:
+    """Объекты ``Tile`` из результата ``render_tiles`` без копирования данных."""
+    return TileSet([
+        Tile(index=t.index, data=memoryview(t.data), mime=t.mime, phash=t.phash,
+             rect=t.rect, size=t.size, encoding=t.encoding)
+        for t in tiles
+    ], planned)
+
+
+def _vision_request(model: str, image_payload, temperature: float = 0) -> Dict[str, Any]:
+    """Параметры chat.completions.create для распознавания изображения.
+
+    ``image_payload`` — часть сообщения с одним изображением или список
+    частей группы тайлов (``group_payload``).
+    """
+    if isinstance(image_payload, list):
+        system, content = GROUP_SYSTEM_PROMPT, [{"type": "text", "text": GROUP_INSTRUCTION}, *image_payload]
+        max_tokens = min(GROUP_MAX_TOKENS, 1200 * len(image_payload) // 2)
+    else:
+        system, content = SYSTEM_PROMPT, [{"type": "text", "text": USER_INSTRUCTION}, image_payload]
+        max_tokens = 1200
+    return dict(
+        model=model,
+        messages=[
+            {"role": "system", "content": system},
+            {"role": "user", "content": content},
+        ],
+        temperature=temperature,
+        max_tokens=max_tokens,
+        response_format={"type": "json_object"}
+    )
+
+
+def group_payload(tiles: List[Tile]) -> List[Dict[str, Any]]:
+    """Части сообщения группового запроса: подпись «Тайл N» перед изображением каждого тайла."""
+    parts = []
+    for tile in tiles:
+        parts.append({"type": "text", "text": f"Тайл {tile.index}"})
+        parts.append(tile.payload)
+    return parts
+
+
+def _chat_of(req_id: str) -> Optional[str]:
+    return req_id.split(":")[0] if ":" in req_id else None
+
+
+def _used_tokens(resp, ticket: Ticket) -> int:
+    usage = resp.usage
+    return (usage.prompt_tokens + usage.completion_tokens) if usage else int(ticket.tokens)
+
+
+def _sent(model: str, started: float, error: Optional[BaseException] = None):
+    """Учесть вызов модели выключателем; длительность успешного — в окно порога хеджирования."""
+    elapsed = time.time() - started
+    if error is None:
+        breakers.record(model, True, elapsed)
+        hedger.observe(model, elapsed)
+    elif not isinstance(error, RateLimitError):
+        # 429 — лимит аккаунта, а не деградация модели
+        breakers.record(model, False, elapsed)
+
+
+def _send(client: OpenAI, model: str, request: Dict[str, Any]):
+    """Один вызов модели; успех, ошибка и длительность учитываются выключателем модели.
+
+    Длительность успешного вызова — без ожидания лимитов и хеджа — идёт
+    в окно порога хеджирования этой модели.
+    """
+    started = time.time()
+    try:
+        resp = client.chat.completions.create(**request)
+    except Exception as e:
+        _sent(model, started, e)
+        raise
+    _sent(model, started)
+    return resp
+
+
+async def _send_async(client: AsyncOpenAI, model: str, request: Dict[str, Any]):
+    """Асинхронный вариант ``_send``; отменённый вызов не учитывается."""
+    started = time.time()
+    try:
+        resp = await client.chat.completions.create(**request)
+    except Exception as e:
+        _sent(model, started, e)
+        raise
+    _sent(model, started)
+    return resp
+
+
+def _ticket_acquired(ticket: Ticket, model: str, req_id: str):
+    if ticket.waited >= 1.0:
+        logger.info(f"[{req_id}] Waited {ticket.waited:.1f}s for {model} rate limit")
+
+
+def _throttled(scheduler, ticket: Ticket, error: RateLimitError, model: str, req_id: str, attempt: int) -> bool:
+    """429 при заданных лимитах: пауза для всех запросов модели; ``True`` — попытки кончились."""
+    pause = retry_after_seconds(error)
+    scheduler.throttled(ticket, pause)
+    logger.warning(f"[{req_id}] OpenAI 429 on {model}, pausing {pause:.1f}s (attempt {attempt + 1})")
+    return attempt >= OPENAI_RATE_LIMIT_RETRIES
+
+
+def _create_completion(client: OpenAI, model: str, image_payload, req_id: str, temperature: float = 0):
+    """chat.completions.create через планировщик лимитов RPM/TPM.
+
+    Когда лимиты заданы, 429 обрабатывает планировщик (пауза для всех
+    запросов модели и повтор в порядке очереди), а не встроенные ретраи клиента.
+    """
+    request = _vision_request(model, image_payload, temperature)
+    if not rate_limiter.enabled:
+        return _send(client, model, request)
+
+    scheduler = rate_limiter.for_model(model)
+    client = client.with_options(max_retries=0)
+    for attempt in range(OPENAI_RATE_LIMIT_RETRIES + 1):
+        ticket = scheduler.acquire(_chat_of(req_id))
+        _ticket_acquired(ticket, model, req_id)
+        try:
+            resp = _send(client, model, request)
+        except RateLimitError as e:
+            if _throttled(scheduler, ticket, e, model, req_id, attempt):
+                raise
+            continue
+        except BaseException:
+            # В том числе отмена проигравшего хеджированного запроса
+            scheduler.complete(ticket, 0)
+            raise
+        scheduler.complete(ticket, _used_tokens(resp, ticket))
+        return resp
+
+
+async def _create_completion_async(client: AsyncOpenAI, model: str, image_payload, req_id: str,
+                                  temperature: float = 0):
+    """Асинхронный вариант ``_create_completion``."""
+    request = _vision_request(model, image_payload, temperature)
+    if not rate_limiter.enabled:
+        return await _send_async(client, model, request)
+
+    scheduler = rate_limiter.for_model(model)
+    client = client.with_options(max_retries=0)
+    for attempt in range(OPENAI_RATE_LIMIT_RETRIES + 1):
+        ticket = await scheduler.acquire_async(_chat_of(req_id))
+        _ticket_acquired(ticket, model, req_id)
+        try:
+            resp = await _send_async(client, model, request)
+        except RateLimitError as e:
+            if _throttled(scheduler, ticket, e, model, req_id, attempt):
+                raise
+            continue
+        except BaseException:
+            # В том числе отмена проигравшего хеджированного запроса
+            scheduler.complete(ticket, 0)
+            raise
+        scheduler.complete(ticket, _used_tokens(resp, ticket))
+        return resp
+
+
+class _Completion(NamedTuple):
+    """Шаг сценария распознавания: вызов модели (транспорт отвечает ``(resp, answered_model, hedge)``)."""
+    model: str
+    payload: Any
+    req_id: str
+    temperature: float = 0  # только для вызова без хеджа
+    hedged: bool = True  # через хеджер; второй ответ каскада — без хеджа, с температурой
+
+
+class _Record(NamedTuple):
+    """Шаг сценария распознавания: событие аналитики."""
+    stats: RequestStats
+    extra: Optional[Dict[str, Any]] = None
+
+
+def _advance(flow, result, error: Optional[Exception]):
+    """Продвинуть сценарий до следующего шага: ``(False, шаг)`` или ``(True, результат сценария)``."""
+    try:
+        return False, (flow.throw(error) if error is not None else flow.send(result))
+    except StopIteration as stop:
+        return True, stop.value
+
+
+def _run(flow, client: OpenAI):
+    """Выполнить сценарий распознавания синхронно.
+
+    Сценарий (``_numbers_flow``, ``_tiles_flow``) — генератор: вызовы модели
+    и записи в аналитику он отдаёт через ``yield`` и получает результат
+    (или исключение) обратно. Разбор ответов, каскад и кэш тайлов общие,
+    синхронный и асинхронный варианты различаются только транспортом.
+    """
+    result, error = None, None
+    while True:
+        done, step = _advance(flow, result, error)
+        if done:
+            return step
+        result, error = None, None
+        try:
+            if isinstance(step, _Record):
+                analytics.add_request(step.stats, extra=step.extra)
+            elif step.hedged:
+                result = hedger.call(
+                    lambda m, rid: _create_completion(client, m, step.payload, rid), step.model, step.req_id)
+            else:
+                resp = _create_completion(client, step.model, step.payload, step.req_id,
+                                          temperature=step.temperature)
+                result = resp, step.model, None
+        except Exception as e:
+            error = e
+
+
+async def _run_async(flow, client: AsyncOpenAI):
+    """Асинхронный вариант ``_run``: тот же сценарий на AsyncOpenAI.
+
+    Сам сценарий продвигается в пуле потоков: кэш тайлов (SQLite, сравнение
+    масок) и разбор ответов не должны блокировать event loop.
+    """
+    loop = asyncio.get_running_loop()
+    result, error = None, None
+    while True:
+        done, step = await loop.run_in_executor(None, _advance, flow, result, error)
+        if done:
+            return step
+        result, error = None, None
+        try:
+            if isinstance(step, _Record):
+                await analytics.add_request_async(step.stats, extra=step.extra)
+            elif step.hedged:
+                result = await hedger.call_async(
+                    lambda m, rid: _create_completion_async(client, m, step.payload, rid), step.model, step.req_id)
+            else:
+                resp = await _create_completion_async(client, step.model, step.payload, step.req_id,
+                                                      temperature=step.temperature)
+                result = resp, step.model, None
+        except Exception as e:
+            error = e
+
+
+def _origin(req_id: str) -> Dict[str, Any]:
+    """Чат, сообщение и тайл из идентификатора вида ``chat:message#tN`` (``chat:message#pK#tN`` у документов)."""
+    return {
+        "chat_id": req_id.split(":")[0] if ":" in req_id else None,
+        "message_id": int(req_id.split(":")[1].split("#")[0]) if ":" in req_id else None,
+        "tile_id": req_id.split("#", 1)[1] if "#" in req_id else None,
+    }
+
+
+def _predicted_prompt_tokens(model: str, image_info) -> Optional[int]:
+    """Прогноз prompt_tokens: изображение по правилам OpenAI плюс оценка текста промпта.
+
+    У группового запроса ``image_info`` — список по тайлам.
+    """
+    if isinstance(image_info, list):
+        if not image_info or None in image_info:
+            return None
+        return (sum(image_tokens(model, info["width"], info["height"]) for info in image_info)
+                + GROUP_PROMPT_TEXT_TOKENS + GROUP_LABEL_TOKENS * len(image_info))
+    if image_info is None:
+        return None
+    return image_tokens(model, image_info["width"], image_info["height"]) + PROMPT_TEXT_TOKENS
+
+
+def _parse_response(resp, model: str, req_id: str, start_time: float,
+                    image_info=None, group: Optional[List[int]] = None) -> Tuple[RequestStats, Any]:
+    """Разобрать ответ OpenAI: статистика запроса и сырой список чисел.
+
+    Для группового запроса (``group`` — номера тайлов) вместо списка —
+    словарь ``{"номер тайла": [...]}`` как есть.
+    """
+    duration = time.time() - start_time
+    text = resp.choices[0].message.content
+
+    # Извлечение статистики использования токенов
+    usage = resp.usage
+    input_tokens = usage.prompt_tokens if usage else 0
+    output_tokens = usage.completion_tokens if usage else 0
+
+    # Расчет стоимости
+    cost = CostCalculator.calculate_cost(model, input_tokens, output_tokens)
+
+    try:
+        data = json.loads(text)
+    except (json.JSONDecodeError, TypeError):
+        data = {}
+    if group is None:
+        raw = data.get("numbers", []) if isinstance(data, dict) else []
+        prompt = {"system": SYSTEM_PROMPT, "instruction": USER_INSTRUCTION, "image": image_info, "mode": "single"}
+    else:
+        raw = data.get("tiles", {}) if isinstance(data, dict) else {}
+        prompt = {"system": GROUP_SYSTEM_PROMPT, "instruction": GROUP_INSTRUCTION, "image": image_info,
+                  "mode": "group", "tiles": group}
+
+    stats = RequestStats(
+        duration=duration,
+        input_tokens=input_tokens,
+        output_tokens=output_tokens,
+        cost_usd=cost,
+        model=model,
+        request_id=req_id,
+        **_origin(req_id),
+        raw_prompt=prompt,
+        raw_response={"content": text, "predicted_prompt_tokens": _predicted_prompt_tokens(model, image_info)},
+        status="success",
+        originated_at=start_time,
+    )
+    return stats, raw
+
+
+def _split_item(item) -> Tuple[str, Optional[Position]]:
+    """Элемент ответа: ``["число", x, y]`` или просто ``"число"``."""
+    if isinstance(item, (list, tuple)) and item:
+        try:
+            return str(item[0]), (float(item[1]), float(item[2]))
+        except (IndexError, TypeError, ValueError):
+            return str(item[0]), None
+    return str(item), None
+
+
+def _numbers_extra(raw) -> Dict[str, Any]:
+    return {"numbers": [normalize_num(_split_item(x)[0]) for x in raw] if isinstance(raw, list) else None}
+
+
+def _log_response(req_id: str, stats: RequestStats):
+    # Логирование с деталями стоимости
+    logger.info(f"[{req_id}] OpenAI response: {stats.duration:.2f}s, "
+                f"{stats.input_tokens + stats.output_tokens} tokens, "
+                f"${stats.cost_usd:.4f} ({stats.cost_usd * 100:.2f}¢)")
+    predicted = (stats.raw_response or {}).get("predicted_prompt_tokens")
+    if predicted is not None:
+        logger.info(f"[{req_id}] Prompt tokens: predicted {predicted}, actual {stats.input_tokens}")
+    logger.debug(f"[{req_id}] OpenAI raw: {(stats.raw_response or {}).get('content', '')[:500]}")
+
+
+def _note_hedge(stats: RequestStats, hedge: Optional[Dict[str, Any]]):
+    """Сведения о дубликате — в аналитику (задержки учитывает ``_send``)."""
+    if hedge is not None:
+        stats.raw_prompt["hedge"] = hedge
+
+
+def _valid_numbers(raw) -> List[Tuple[str, Optional[Position]]]:
+    """Числа из ответа вместе с позициями (``None``, если модель её не дала)."""
+    if not isinstance(raw, list) or not raw:
+        return []
+    items = [_split_item(x) for x in raw]
+    nums = [(normalize_num(value), pos) for value, pos in items]
+    return [(n, pos) for n, pos in nums if re.fullmatch(NUMBER_REGEX, n)]
+
+
+def cascade_verdict(text: Optional[str], raw, found: List[Tuple[str, Optional[Position]]],
+                    ink: Optional[int] = None, second: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Решение каскада по ответу дешёвой модели: эскалировать ли тайл и почему.
+
+    ``second`` — числа второго ответа дешёвой модели, если он запрашивался.
+    Результат целиком пишется в аналитику (``raw_response.cascade``).
+    """
+    reasons = []
+    try:
+        data = json.loads(text or "")
+    except (json.JSONDecodeError, TypeError):
+        data = None
+    if not isinstance(data, dict) or not isinstance(data.get("numbers"), list):
+        reasons.append("json")
+    invalid = len(raw) - len(found) if isinstance(raw, list) else 0
+    if invalid > CASCADE_MAX_INVALID:
+        reasons.append("invalid")
+    expected = ink / CASCADE_INK_PER_NUMBER if ink is not None and CASCADE_INK_PER_NUMBER > 0 else None
+    if not found:
+        reasons.append("empty")
+    elif expected is not None and len(found) < expected:
+        reasons.append("sparse")
+    agreement = None
+    if second is not None:
+        first, other = {n for n, _ in found}, set(second)
+        agreement = len(first & other) / len(first | other) if first | other else 1.0
+        if agreement < CASCADE_MIN_AGREEMENT:
+            reasons.append("disagreement")
+    return {
+        "escalate": bool(reasons),
+        "reasons": reasons,
+        "numbers": len(found),
+        "invalid": invalid,
+        "ink": ink,
+        "expected": round(expected, 1) if expected is not None else None,
+        "agreement": round(agreement, 3) if agreement is not None else None,
+    }
+
+
+def _cascades(model: str, models: List[str]) -> bool:
+    """Проверять ли ответ модели перед тем, как принять: дешёвая ступень каскада, есть куда эскалировать."""
+    return MODEL_CASCADE and model == CASCADE_MODEL and model != models[-1]
+
+
+def _tier_id(req_id: str, model: str, models: List[str]) -> str:
+    """Id запроса к модели: у дешёвой ступени каскада свой — её событие с решением не перезапишет ответ дорогой."""
+    return f"{req_id}~cheap" if _cascades(model, models) else req_id
+
+
+def _log_cascade(req_id: str, model: str, verdict: Dict[str, Any]):
+    if verdict["escalate"]:
+        logger.info(f"[{req_id}] Escalating from {model}: {', '.join(verdict['reasons'])} "
+                    f"({verdict['numbers']} numbers, ink {verdict['ink']})")
+    else:
+        logger.info(f"[{req_id}] Cascade accepted {model} answer ({verdict['numbers']} numbers)")
+
+
+def _sample_numbers(resp, model: str, sample_id: str, start_time: float,
+                    image_info) -> Tuple[RequestStats, Any, List[str]]:
+    stats, raw = _parse_response(resp, model, sample_id, start_time, image_info)
+    stats.raw_prompt["cascade"] = "sample"
+    return stats, raw, [n for n, _ in _valid_numbers(raw)]
+
+
+def _second_sample(model: str, image_payload, req_id: str, image_info,
+                   collected: Optional[List[RequestStats]]):
+    """Второй ответ дешёвой модели — для проверки согласия (``None``, если не получен)."""
+    if CASCADE_MIN_AGREEMENT <= 0:
+        return None
+    sample_id, start_time = f"{req_id}~s2", time.time()
+    try:
+        resp, _, _ = yield _Completion(model, image_payload, sample_id, SAMPLE_TEMPERATURE, hedged=False)
+        stats, raw, numbers = _sample_numbers(resp, model, sample_id, start_time, image_info)
+        yield _Record(stats, _numbers_extra(raw))
+    except Exception as e:
+        logger.warning(f"[{req_id}] Second {model} sample failed: {e}")
+        return None
+    if collected is not None:
+        collected.append(stats)
+    return numbers
+
+
+def _fallback_result(last_text: str, model: str, req_id: str, start_time: float) -> Tuple[List[str], Optional[RequestStats]]:
+    """Регэксп по последнему тексту (как крайняя мера)."""
+    # Координаты из ["число", x, y] числами чертежа не являются
+    text = POSITION_TAIL.sub("]", last_text)
+    fallback = [normalize_num(n) for n in re.findall(NUMBER_REGEX, text, flags=re.UNICODE)]
+    stats = None
+    if fallback:
+        stats = RequestStats(
+            duration=time.time() - start_time,
+            input_tokens=0,
+            output_tokens=0,
+            cost_usd=0.0,
+            model=model,
+            request_id=req_id,
+            status="partial",
+            raw_prompt={"system": SYSTEM_PROMPT, "instruction": USER_INSTRUCTION},
+            raw_response={"content": last_text},
+            numbers=fallback,
+            originated_at=start_time,
+        )
+    logger.info(f"[{req_id}] Fallback extracted {len(fallback)} numbers")
+    return [n for n in fallback if n], stats
+
+
+def _model_available(model: str, req_id: str) -> bool:
+    if breakers.allow(model):
+        return True
+    logger.info(f"[{req_id}] Skipping {model}: circuit breaker is open")
+    return False
+
+
+def _tile_cache_hit(phash: Optional[TileSignature], req_id: str) -> Optional[Tuple[List[str], RequestStats]]:
+    """Числа из кэша тайлов и нулевое по стоимости событие аналитики для попадания."""
+    if phash is None or tile_cache is None:
+        return None
+    start_time = time.time()
+    try:
+        hit = tile_cache.lookup(phash)
+    except Exception as e:
+        logger.warning(f"[{req_id}] Tile cache lookup failed: {e}")
+        return None
+    if hit is None:
+        return None
+    numbers, distance = hit
+    stats = RequestStats(
+        duration=time.time() - start_time,
+        input_tokens=0,
+        output_tokens=0,
+        cost_usd=0.0,
+        model="cache:phash",
+        # Отдельный id: событие не должно перезаписать прошлые запросы этого тайла
+        request_id=f"{req_id}@cache",
+        **_origin(req_id),
+        status="success",
+        numbers=numbers,
+        raw_response={"cache_distance": distance},
+        originated_at=start_time,
+    )
+    logger.info(f"[{req_id}] Tile cache hit (distance {distance}), {len(numbers)} numbers")
+    return numbers, stats
+
+
+def _remember_tile(phash: Optional[TileSignature], req_id: str, numbers: List[str]):
+    if phash is None or tile_cache is None:
+        return
+    try:
+        tile_cache.add(phash, numbers)
+    except Exception as e:
+        logger.warning(f"[{req_id}] Tile cache write failed: {e}")
+
+
+def _numbers_flow(image_payload, req_id: str, collected: Optional[List[RequestStats]],
+                  phash: Optional[TileSignature], positions: Optional[List[Optional[Position]]],
+                  image_info: Optional[Dict[str, Any]]):
+    """Сценарий ``ask_openai_for_numbers`` (выполняется ``_run`` или ``_run_async``)."""
+    cached = _tile_cache_hit(phash, req_id)
+    if cached is not None:
+        numbers, stats = cached
+        yield _Record(stats, {"numbers": numbers})
+        if collected is not None:
+            collected.append(stats)
+        if positions is not None:
+            positions.extend([None] * len(numbers))
+        return numbers
+
+    models_to_try = _tile_models()
     last_text = ""
-    
+    start_time = time.time()
+    # Числа дешёвой модели эскалированного тайла — если дорогая не ответит
+    escalated: List[Tuple[str, Optional[Position]]] = []
+
     for model in models_to_try:
+        if not _model_available(model, req_id):
+            continue
         start_time = time.time()
         try:
             logger.info(f"[{req_id}] OpenAI call model={model} payload_type={image_payload.get('type')}")
-            
-            resp = client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": SYSTEM_PROMPT},
-                    {"role": "user", "content": [
-                        {"type": "text", "text": USER_INSTRUCTION},
-                        image_payload
-                    ]},
-                ],
-                temperature=0,
-                max_tokens=800,
-                response_format={"type": "json_object"}
-            )
-            
-            duration = time.time() - start_time
-            text = resp.choices[0].message.content
-            last_text = text
-            
-            # Извлечение статистики использования токенов
-            usage = resp.usage
-            input_tokens = usage.prompt_tokens if usage else 0
-            output_tokens = usage.completion_tokens if usage else 0
-            
-            # Расчет стоимости
-            cost = CostCalculator.calculate_cost(model, input_tokens, output_tokens)
-            
-            # Сохранение статистики
-            stats = RequestStats(
-                duration=duration,
-                input_tokens=input_tokens,
-                output_tokens=output_tokens,
-                cost_usd=cost,
-                model=model,
-                request_id=req_id,
-                chat_id=req_id.split(":")[0] if ":" in req_id else None,
-                message_id=int(req_id.split(":")[1].split("#")[0]) if ":" in req_id else None,
-                tile_id=req_id.split("#")[-1] if "#" in req_id else None,
-                raw_prompt={"system": SYSTEM_PROMPT, "instruction": USER_INSTRUCTION},
-                raw_response={"content": text},
-                status="success",
-                originated_at=start_time,
-            )
-            analytics.add_request(
-                stats,
-                extra={
-                    "numbers": [normalize_num(x) for x in raw] if isinstance(raw, list) else None,
-                },
-            )
-            
-            # Логирование с деталями стоимости
-            logger.info(f"[{req_id}] OpenAI response: {duration:.2f}s, "
-                       f"{input_tokens + output_tokens} tokens, "
-                       f"${cost:.4f} ({cost * 100:.2f}¢)")
-            
-            logger.debug(f"[{req_id}] OpenAI raw: {text[:500]}")
-
-            data = json.loads(text)
-            raw = data.get("numbers", [])
-            if isinstance(raw, list) and raw:
-                nums = [normalize_num(x) for x in raw]
-                nums = [n for n in nums if re.fullmatch(NUMBER_REGEX, n)]
-                if nums:
-                    logger.info(f"[{req_id}] OpenAI extracted {len(nums)} numbers")
-                    return nums
+            call_id = _tier_id(req_id, model, models_to_try)
+            resp, answered, hedge = yield _Completion(model, image_payload, call_id)
+            stats, raw = _parse_response(resp, answered, call_id, start_time, image_info)
+            last_text = stats.raw_response["content"] or ""
+            _note_hedge(stats, hedge)
+
+            found = _valid_numbers(raw)
+            verdict = None
+            if _cascades(model, models_to_try):
+                ink = (image_info or {}).get("ink")
+                verdict = cascade_verdict(last_text, raw, found, ink)
+                if not verdict["escalate"]:
+                    second = yield from _second_sample(model, image_payload, req_id, image_info, collected)
+                    verdict = cascade_verdict(last_text, raw, found, ink, second)
+                stats.raw_response["cascade"] = verdict
+
+            yield _Record(stats, _numbers_extra(raw))
+            if collected is not None:
+                collected.append(stats)
+            _log_response(req_id, stats)
+
+            if verdict is not None:
+                _log_cascade(req_id, model, verdict)
+                if verdict["escalate"]:
+                    escalated = found
+                    continue
+            if found:
+                nums = [n for n, _ in found]
+                logger.info(f"[{req_id}] OpenAI extracted {len(nums)} numbers")
+                _remember_tile(phash, req_id, nums)
+                if positions is not None:
+                    positions.extend(pos for _, pos in found)
+                return nums
         except Exception as e:
             duration = time.time() - start_time
             logger.warning(f"[{req_id}] OpenAI error on model {model} after {duration:.2f}s: {e}")
             continue
-    
-    # Регэксп по последнему тексту (как крайняя мера)
-    fallback = [normalize_num(n) for n in re.findall(NUMBER_REGEX, last_text, flags=re.UNICODE)]
-    if fallback:
+
+    if escalated:
+        logger.info(f"[{req_id}] Keeping {len(escalated)} numbers of the cheap model")
+        nums = [n for n, _ in escalated]
+        if positions is not None:
+            positions.extend(pos for _, pos in escalated)
+        return nums
+
+    numbers, stats = _fallback_result(last_text, models_to_try[-1], req_id, start_time)
+    if stats is not None:
         try:
-            analytics.add_request(
-                RequestStats(
-                    duration=time.time() - start_time,
-                    input_tokens=0,
-                    output_tokens=0,
-                    cost_usd=0.0,
-                    model=models_to_try[-1],
-                    request_id=req_id,
-                    status="partial",
-                    raw_prompt={"system": SYSTEM_PROMPT, "instruction": USER_INSTRUCTION},
-                    raw_response={"content": last_text},
-                    numbers=fallback,
-                    originated_at=start_time,
-                )
-            )
+            yield _Record(stats)
+            if collected is not None:
+                collected.append(stats)
         except Exception as exc:  # noqa: BLE001
             logger.debug("Analytics fallback event failed: %s", exc)
-    logger.info(f"[{req_id}] Fallback extracted {len(fallback)} numbers")
-    return [n for n in fallback if n]
+    if positions is not None:
+        positions.extend([None] * len(numbers))
+    return numbers
+
+
+def ask_openai_for_numbers(image_payload, req_id: str, client: OpenAI,
+                           collected: Optional[List[RequestStats]] = None,
+                           phash: Optional[TileSignature] = None,
+                           positions: Optional[List[Optional[Position]]] = None,
+                           image_info: Optional[Dict[str, Any]] = None):
+    """Запрос к OpenAI для извлечения чисел с изображения.
+
+    Если передан ``collected``, в него добавляется статистика каждого
+    записанного в аналитику запроса — так вызывающий код считает время и
+    стоимость своего фото без оглядки на глобальный ``analytics.requests``.
+    С ``phash`` (``Tile.phash``) сначала проверяется кэш тайлов.
+    В ``positions`` добавляются примерные позиции чисел (в том же порядке;
+    ``None`` — позиция неизвестна, например для кэша тайлов и fallback).
+    По ``image_info`` (``Tile.image_info``) прогнозируются prompt_tokens —
+    прогноз пишется в лог рядом с фактическим значением; размер и
+    кодирование изображения уходят в аналитику в ``raw_prompt.image``.
+    В режиме каскада (``MODEL_CASCADE``) ответ дешёвой модели принимается,
+    только если ``cascade_verdict`` не нашёл причин эскалировать тайл.
+    """
+    return _run(_numbers_flow(image_payload, req_id, collected, phash, positions, image_info), client)
+
+
+async def ask_openai_for_numbers_async(image_payload, req_id: str, client: AsyncOpenAI,
+                                       collected: Optional[List[RequestStats]] = None,
+                                       phash: Optional[TileSignature] = None,
+                                       positions: Optional[List[Optional[Position]]] = None,
+                                       image_info: Optional[Dict[str, Any]] = None):
+    """Асинхронный вариант ``ask_openai_for_numbers`` для AsyncOpenAI."""
+    return await _run_async(_numbers_flow(image_payload, req_id, collected, phash, positions, image_info), client)
+
+
+class TileAnswer(NamedTuple):
+    """Ответ по одному тайлу группового запроса."""
+    numbers: List[str]
+    positions: List[Optional[Position]]
+    stats: List[RequestStats]  # доля группового запроса, попадание в кэш, запросы по одному
+
+
+def _group_request_id(req_id: str, tiles: List[Tile]) -> str:
+    return f"{req_id}#g" + "+".join(str(t.index) for t in tiles)
+
+
+def _group_items(raw, indices: List[int]) -> Dict[int, Any]:
+    """Списки группового ответа по номерам тайлов — как их вернула модель."""
+    if not isinstance(raw, dict):
+        return {}
+    items = {}
+    for key, value in raw.items():
+        match = re.search(r"\d+", str(key))
+        if match is not None and int(match.group()) in indices:
+            items[int(match.group())] = value
+    return items
+
+
+def _group_numbers(raw, indices: List[int]) -> Dict[int, List[Tuple[str, Optional[Position]]]]:
+    """Числа группового ответа по номерам тайлов; тайлы без разборчивого списка в результат не попадают."""
+    found = {}
+    for index, items in _group_items(raw, indices).items():
+        numbers = _valid_numbers(items)
+        if numbers:
+            found[index] = numbers
+    return found
+
+
+def _group_verdicts(raw, pending: List[Tile], group_id: str, model: str) -> Dict[int, Dict[str, Any]]:
+    """Решения каскада по каждому тайлу группового ответа дешёвой модели.
+
+    Второй ответ для проверки согласия в групповом режиме не запрашивается.
+    """
+    items = _group_items(raw, [t.index for t in pending])
+    verdicts = {}
+    for tile in pending:
+        tile_raw = items.get(tile.index)
+        text = json.dumps({"numbers": tile_raw}) if isinstance(tile_raw, list) else None
+        verdict = cascade_verdict(text, tile_raw, _valid_numbers(tile_raw), (tile.image_info or {}).get("ink"))
+        _log_cascade(f"{group_id}:t{tile.index}", model, verdict)
+        verdicts[tile.index] = verdict
+    return verdicts
+
+
+def _cached_answers(tiles: List[Tile], req_id: str) -> Tuple[Dict[int, TileAnswer], List[Tuple[RequestStats, List[str]]]]:
+    """Заготовки ответов по тайлам и попадания в кэш тайлов (событие аналитики, числа)."""
+    answers = {t.index: TileAnswer([], [], []) for t in tiles}
+    hits = []
+    for tile in tiles:
+        cached = _tile_cache_hit(tile.phash, f"{req_id}#t{tile.index}")
+        if cached is not None:
+            numbers, stats = cached
+            answers[tile.index] = TileAnswer(list(numbers), [None] * len(numbers), [stats])
+            hits.append((stats, numbers))
+    return answers, hits
+
+
+def _apply_group(stats: RequestStats, raw, pending: List[Tile], answers: Dict[int, TileAnswer],
+                 group_id: str, escalated: Dict[int, List[Tuple[str, Optional[Position]]]],
+                 verdicts: Optional[Dict[int, Dict[str, Any]]] = None) -> List[Tile]:
+    """Разложить групповой ответ по тайлам; вернуть тайлы, оставшиеся без ответа.
+
+    Стоимость и токены запроса делятся между тайлами группы поровну: так
+    считаются стоимость фото и успешные тайлы (в аналитику уходит один запрос).
+    Тайлы, которые каскад (``verdicts``) эскалировал, тоже остаются без
+    ответа, а их числа дешёвой модели запоминаются в ``escalated``.
+    """
+    found = _group_numbers(raw, [t.index for t in pending])
+    for index, verdict in (verdicts or {}).items():
+        if verdict["escalate"]:
+            escalated[index] = found.pop(index, [])
+    share = replace(stats, input_tokens=stats.input_tokens // len(pending),
+                    output_tokens=stats.output_tokens // len(pending), cost_usd=stats.cost_usd / len(pending))
+    for tile in pending:
+        answer = answers[tile.index]
+        answer.stats.append(share)
+        if tile.index in found:
+            answer.numbers.extend(n for n, _ in found[tile.index])
+            answer.positions.extend(pos for _, pos in found[tile.index])
+            escalated.pop(tile.index, None)
+            _remember_tile(tile.phash, group_id, answer.numbers)
+    logger.info(f"[{group_id}] OpenAI answered {len(found)}/{len(pending)} tiles")
+    return [t for t in pending if t.index not in found]
+
+
+def _group_answer(resp, answered: str, hedge: Optional[Dict[str, Any]], model: str, models: List[str],
+                  pending: List[Tile], answers: Dict[int, TileAnswer], group_id: str, start_time: float,
+                  escalated: Dict[int, List[Tuple[str, Optional[Position]]]]) -> Tuple[RequestStats, Dict[str, Any], List[Tile]]:
+    """Разобрать ответ группового запроса: событие аналитики, его ``extra`` и тайлы без ответа."""
+    stats, raw = _parse_response(resp, answered, group_id, start_time,
+                                 [t.image_info for t in pending], group=[t.index for t in pending])
+    _note_hedge(stats, hedge)
+    verdicts = None
+    if _cascades(model, models):
+        verdicts = _group_verdicts(raw, pending, group_id, model)
+        stats.raw_response["cascade"] = {str(index): verdict for index, verdict in verdicts.items()}
+    extra = {"numbers": [n for numbers in _group_numbers(raw, [t.index for t in pending]).values() for n, _ in numbers]}
+    _log_response(group_id, stats)
+    return stats, extra, _apply_group(stats, raw, pending, answers, group_id, escalated, verdicts)
+
+
+def _keep_escalated(tile: Tile, req_id: str, answers: Dict[int, TileAnswer],
+                    escalated: Dict[int, List[Tuple[str, Optional[Position]]]]) -> bool:
+    """Оставить тайлу числа дешёвой модели, если дорогая по нему не ответила."""
+    found = escalated.get(tile.index)
+    if not found:
+        return False
+    logger.info(f"[{req_id}#t{tile.index}] Keeping {len(found)} numbers of the cheap model")
+    answers[tile.index].numbers.extend(n for n, _ in found)
+    answers[tile.index].positions.extend(pos for _, pos in found)
+    return True
+
+
+def _tiles_flow(tiles: List[Tile], req_id: str):
+    """Сценарий ``ask_openai_for_tiles`` (выполняется ``_run`` или ``_run_async``)."""
+    answers, hits = _cached_answers(tiles, req_id)
+    for stats, numbers in hits:
+        yield _Record(stats, {"numbers": numbers})
+    pending = [t for t in tiles if not answers[t.index].stats]
+    escalated: Dict[int, List[Tuple[str, Optional[Position]]]] = {}
+
+    if len(pending) > 1:
+        models = _tile_models()
+        for model in models:
+            if not pending:
+                break
+            group_id = _group_request_id(req_id, pending)
+            if not _model_available(model, group_id):
+                continue
+            start_time = time.time()
+            try:
+                logger.info(f"[{group_id}] OpenAI call model={model} tiles={len(pending)}")
+                call_id = _tier_id(group_id, model, models)
+                resp, answered, hedge = yield _Completion(model, group_payload(pending), call_id)
+                stats, extra, left = _group_answer(resp, answered, hedge, model, models, pending, answers,
+                                                   call_id, start_time, escalated)
+            except Exception as e:
+                logger.warning(f"[{group_id}] OpenAI error on model {model} after {time.time() - start_time:.2f}s: {e}")
+                continue
+            yield _Record(stats, extra)
+            pending = left
+            if not _cascades(model, models):
+                break
+
+    for tile in pending:
+        if _keep_escalated(tile, req_id, answers, escalated):
+            continue
+        answer = answers[tile.index]
+        answer.numbers.extend((yield from _numbers_flow(
+            tile.payload, f"{req_id}#t{tile.index}", answer.stats, tile.phash, answer.positions, tile.image_info,
+        )))
+    return [answers[t.index] for t in tiles]
+
+
+def ask_openai_for_tiles(tiles: List[Tile], req_id: str, client: OpenAI) -> List[TileAnswer]:
+    """Распознать несколько тайлов одного фото одним запросом (``TILES_PER_REQUEST``).
+
+    Тайлы из кэша тайлов в запрос не попадают. Модель возвращает числа по
+    номерам тайлов; тайлы, которых нет в ответе или чей список не
+    разобрался (и все — если запрос не удался), распознаются обычными
+    запросами по одному (``ask_openai_for_numbers``). Ответы — в порядке ``tiles``.
+    Групповой запрос хеджируется так же, как одиночный; в режиме каскада
+    группу сначала распознаёт дешёвая модель, а тайлы, которые
+    ``cascade_verdict`` эскалировал, уходят к дорогой следующим групповым запросом.
+    """
+    return _run(_tiles_flow(tiles, req_id), client)
+
+
+async def ask_openai_for_tiles_async(tiles: List[Tile], req_id: str, client: AsyncOpenAI) -> List[TileAnswer]:
+    """Асинхронный вариант ``ask_openai_for_tiles`` для AsyncOpenAI."""
+    return await _run_async(_tiles_flow(tiles, req_id), client)
 
 
 def extract_numbers_fallback(text: str):
@@ -0,0 +1,145 @@
+"""Приём обновлений Telegram через webhook (минимальное ASGI-приложение).
+
+Telegram присылает каждое обновление POST-запросом с заголовком
+``X-Telegram-Bot-Api-Secret-Token``. Приложение проверяет секрет, разбирает
+Update и передаёт его в обработку, не дожидаясь распознавания: ответ
+Telegram уходит сразу. Так несколько реплик бота работают за nginx.
+"""
+
+import asyncio
+import hmac
+import inspect
+import json
+import logging
+from typing import Any, Awaitable, Callable, Optional, Set, Union
+
+from telebot import types
+
+from .config import WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, LOG_LEVEL
+
+logger = logging.getLogger(__name__)
+
+# Telegram не присылает обновления больше нескольких килобайт
+MAX_BODY_BYTES = 1_000_000
+ALLOWED_UPDATES = ["message"]
+
+ProcessUpdate = Callable[[types.Update], Union[None, Awaitable[Any]]]
+
+
+async def _respond(send, status: int, body: bytes = b""):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"text/plain; charset=utf-8"), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _read_body(receive, limit: int) -> Optional[bytes]:
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > limit:
+            return None
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+def create_webhook_app(process_update: ProcessUpdate, secret_token: str, path: str = WEBHOOK_PATH):
+    """ASGI-приложение: ``POST path`` — обновления Telegram, ``GET /healthz`` — проверка."""
+    expected = secret_token.encode()
+    # Ссылки на фоновые задачи, чтобы их не собрал GC до завершения
+    background: Set[asyncio.Task] = set()
+
+    async def app(scope, receive, send):
+        if scope["type"] != "http":
+            return
+
+        method, url_path = scope["method"], scope["path"]
+        if url_path == "/healthz" and method == "GET":
+            await _respond(send, 200, b"ok")
+            return
+        if url_path != path:
+            await _respond(send, 404, b"not found")
+            return
+        if method != "POST":
+            await _respond(send, 405, b"method not allowed")
+            return
+
+        headers = dict(scope.get("headers") or [])
+        provided = headers.get(b"x-telegram-bot-api-secret-token", b"")
+        if not hmac.compare_digest(provided, expected):
+            logger.warning(f"Webhook request with invalid secret from {scope.get('client')}")
+            await _respond(send, 403, b"forbidden")
+            return
+
+        body = await _read_body(receive, MAX_BODY_BYTES)
+        if body is None:
+            await _respond(send, 413, b"payload too large")
+            return
+        try:
+            update = types.Update.de_json(json.loads(body))
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f"Webhook got malformed update: {e}")
+            await _respond(send, 400, b"bad request")
+            return
+
+        try:
+            result = process_update(update)
+            if inspect.isawaitable(result):
+                task = asyncio.ensure_future(result)
+                background.add(task)
+                task.add_done_callback(background.discard)
+        except Exception as e:
+            # Ошибка обработки не должна заставлять Telegram повторять доставку
+            logger.exception(f"Webhook update {update.update_id} dispatch failed: {e}")
+
+        await _respond(send, 200, b"ok")
+
+    return app
+
+
+def _uvicorn_config(app):
+    import uvicorn
+
+    return uvicorn.Config(
+        app,
+        host=WEBHOOK_HOST,
+        port=WEBHOOK_PORT,
+        lifespan="off",
+        log_level=LOG_LEVEL.lower(),
+        proxy_headers=True,
+        forwarded_allow_ips="*",
+    )
+
+
+def run_webhook(bot, logger: logging.Logger):
+    """Обслуживать webhook для синхронного TeleBot (обработчики — в его пуле потоков)."""
+    import uvicorn
+
+    if WEBHOOK_URL:
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=ALLOWED_UPDATES)
+        logger.info(f"Webhook registered at {WEBHOOK_URL}")
+
+    app = create_webhook_app(lambda update: bot.process_new_updates([update]), WEBHOOK_SECRET)
+    logger.info(f"Serving webhook on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    uvicorn.Server(_uvicorn_config(app)).run()
+
+
+async def run_webhook_async(bot, logger: logging.Logger):
+    """Обслуживать webhook для AsyncTeleBot на текущем event loop."""
+    import uvicorn
+
+    if WEBHOOK_URL:
+        await bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=ALLOWED_UPDATES)
+        logger.info(f"Webhook registered at {WEBHOOK_URL}")
+
+    app = create_webhook_app(lambda update: bot.process_new_updates([update]), WEBHOOK_SECRET)
+    logger.info(f"Serving webhook on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    await uvicorn.Server(_uvicorn_config(app)).serve()
@@ -0,0 +1,216 @@
+"""Процессы-воркеры, разбирающие очередь распознавания."""
+
+import os
+import time
+import signal
+import socket
+import logging
+import threading
+import multiprocessing
+from typing import List, Optional
+
+from .config import JOB_QUEUE_PATH, QUEUE_WORKERS, QUEUE_VISIBILITY_TIMEOUT, QUEUE_MAX_ATTEMPTS
+from .jobqueue import Job, JobQueue
+from .bot import (
+    setup_logging, create_telebot, create_openai_client, process_photo, process_album, process_document,
+    process_deferred,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def open_job_queue() -> JobQueue:
+    return JobQueue(JOB_QUEUE_PATH, visibility_timeout=QUEUE_VISIBILITY_TIMEOUT, max_attempts=QUEUE_MAX_ATTEMPTS)
+
+
+class _LeaseKeeper:
+    """Продлевает аренду задания, пока оно обрабатывается."""
+
+    def __init__(self, queue: JobQueue, job: Job):
+        self.queue = queue
+        self.job = job
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        interval = max(self.queue.visibility_timeout / 3, 1.0)
+        while not self._stop.wait(interval):
+            try:
+                if not self.queue.extend(self.job):
+                    logger.warning(f"Lost lease on job {self.job.id}")
+                    return
+            except Exception as e:
+                logger.debug(f"lease extend failed: {e}")
+        self.queue.close()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join(timeout=1)
+
+
+def worker_id(name: str) -> str:
+    """Идентификатор аренды: имя воркера, хост и pid процесса, который держит задание."""
+    return f"{name}@{socket.gethostname()}:{os.getpid()}"
+
+
+def stale_worker(worker: str) -> bool:
+    """Аренда принадлежит процессу этого хоста, который уже завершился.
+
+    Про воркеры других хостов и про старый формат имени ничего не известно:
+    их задания освободятся по истечении аренды.
+    """
+    host, _, pid = worker.rpartition("@")[2].rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        return False
+    return False
+
+
+def _handle_job(bot, client, job: Job, retry: bool = False):
+    """Обработать задание; ``retry`` — у задания остались попытки, временные ошибки пробрасываются."""
+    if job.kind == "photo":
+        payload = job.payload
+        process_photo(bot, client, payload["chat_id"], payload["file_id"], payload["req_id"],
+                      payload.get("status_message_id"), retry=retry)
+    elif job.kind == "document":
+        payload = job.payload
+        process_document(bot, client, payload["chat_id"], payload["file_id"], payload["req_id"],
+                         payload.get("status_message_id"), retry=retry)
+    elif job.kind == "batch":
+        payload = job.payload
+        process_deferred(bot, client, payload["chat_id"], payload["file_id"], payload["req_id"],
+                         payload.get("message_id"), retry=retry)
+    elif job.kind == "album":
+        process_album(bot, client, job.payload["chat_id"], job.payload["photos"], retry=retry)
+    else:
+        raise ValueError(f"Unknown job kind: {job.kind}")
+
+
+def worker_main(name: str, poll_interval: float = 1.0):
+    """Цикл одного воркера: взять задание → обработать → подтвердить."""
+    log = setup_logging()
+    queue = open_job_queue()
+    bot = create_telebot()
+    client = create_openai_client()
+
+    stopping = threading.Event()
+    busy = threading.Event()
+
+    def _on_signal(signum, frame):
+        stopping.set()
+        if busy.is_set():
+            # Прерываем текущее задание: оно вернётся в очередь ниже
+            raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, _on_signal)
+    signal.signal(signal.SIGINT, _on_signal)
+    log.info(f"Worker {name} started (pid={os.getpid()})")
+    lease_owner = worker_id(name)
+
+    while not stopping.is_set():
+        job = queue.claim(lease_owner)
+        if job is None:
+            stopping.wait(poll_interval)
+            continue
+
+        req_id = job.payload.get("req_id") or job.payload.get("photos", [{}])[0].get("req_id", job.id)
+        waited = time.time() - job.created_at
+        log.info(f"[{req_id}] Job {job.id} claimed by {name} (attempt {job.attempts}, queued {waited:.1f}s)")
+        busy.set()
+        try:
+            with _LeaseKeeper(queue, job):
+                _handle_job(bot, client, job, retry=job.attempts < queue.max_attempts)
+        except SystemExit:
+            queue.release(job)
+            log.info(f"[{req_id}] Job {job.id} released on shutdown")
+            raise
+        except Exception as e:
+            log.exception(f"[{req_id}] Job {job.id} failed: {e}")
+            queue.fail(job, str(e))
+        else:
+            queue.ack(job)
+        finally:
+            busy.clear()
+
+    log.info(f"Worker {name} stopped")
+
+
+class WorkerPool:
+    """Набор процессов-воркеров с перезапуском упавших."""
+
+    def __init__(self, size: int = QUEUE_WORKERS, check_interval: float = 5.0):
+        self.size = max(1, size)
+        self.check_interval = check_interval
+        self._ctx = multiprocessing.get_context("spawn")
+        self._processes: List[Optional[multiprocessing.Process]] = [None] * self.size
+        self._stop = threading.Event()
+        self._watcher: Optional[threading.Thread] = None
+
+    def _spawn(self, slot: int):
+        name = f"worker-{os.getpid()}-{slot}"
+        proc = self._ctx.Process(target=worker_main, args=(name,), name=name, daemon=True)
+        proc.start()
+        self._processes[slot] = proc
+
+    def _watch(self):
+        while not self._stop.wait(self.check_interval):
+            for slot, proc in enumerate(self._processes):
+                if proc is not None and not proc.is_alive():
+                    logger.warning(f"Worker {proc.name} exited with code {proc.exitcode}, restarting")
+                    self._spawn(slot)
+
+    def start(self):
+        for slot in range(self.size):
+            self._spawn(slot)
+        self._watcher = threading.Thread(target=self._watch, daemon=True)
+        self._watcher.start()
+
+    def stop(self, timeout: float = 3.0):
+        self._stop.set()
+        for proc in self._processes:
+            if proc is not None and proc.is_alive():
+                proc.terminate()
+        deadline = time.time() + timeout
+        for proc in self._processes:
+            if proc is not None:
+                proc.join(max(deadline - time.time(), 0))
+                if proc.is_alive():
+                    proc.kill()
+
+
+def raise_system_exit(signum, frame):
+    """SIGTERM → SystemExit, чтобы сработали finally-блоки и воркеры остановились."""
+    raise SystemExit(0)
+
+
+def run_workers():
+    """Запуск только воркеров (без приёма сообщений из Telegram)."""
+    log = setup_logging()
+    queue = open_job_queue()
+    queue.recover(stale_worker)
+    queue.close()
+
+    pool = WorkerPool(QUEUE_WORKERS)
+    signal.signal(signal.SIGTERM, raise_system_exit)
+    pool.start()
+    log.info(f"Started {pool.size} queue workers")
+    try:
+        while True:
+            time.sleep(3600)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        pool.stop()
+
+
+if __name__ == "__main__":
+    run_workers()
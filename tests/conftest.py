@@ -0,0 +1,15 @@
+import os
+
+# config.py требует токены при импорте. Подставляем заглушки только на время
+# импорта, чтобы интеграционные тесты по-прежнему видели реальное окружение.
+_placeholders = {
+    key: value
+    for key, value in {"BOT_TOKEN": "test-bot-token", "OPENAI_API_KEY": "test-openai-key"}.items()
+    if not os.environ.get(key)
+}
+os.environ.update(_placeholders)
+try:
+    from src.mrdoors import config  # noqa: E402,F401
+finally:
+    for key in _placeholders:
+        os.environ.pop(key, None)
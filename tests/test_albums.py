@@ -0,0 +1,55 @@
+import threading
+import time
+from types import SimpleNamespace
+
+from src.mrdoors.albums import MediaGroupCollector
+from src.mrdoors.bot import format_album_message
+
+
+def _msg(message_id, group="g1"):
+    return SimpleNamespace(message_id=message_id, media_group_id=group)
+
+
+def test_collects_album_within_window():
+    flushed = []
+    done = threading.Event()
+
+    def on_flush(messages):
+        flushed.append([m.message_id for m in messages])
+        if len(flushed) == 2:
+            done.set()
+
+    collector = MediaGroupCollector(0.1, on_flush)
+    for message_id in (12, 10, 11):
+        collector.add(_msg(message_id))
+        time.sleep(0.02)
+    collector.add(_msg(20, group="g2"))
+
+    assert done.wait(2)
+    assert sorted(flushed) == [[10, 11, 12], [20]]
+
+
+def test_full_album_flushes_immediately():
+    flushed = threading.Event()
+    collector = MediaGroupCollector(60, lambda messages: flushed.set(), max_items=2)
+    collector.add(_msg(1))
+    collector.add(_msg(2))
+    assert flushed.wait(2)
+
+
+def test_flush_all_delivers_pending_albums_on_shutdown():
+    flushed = []
+    collector = MediaGroupCollector(60, lambda messages: flushed.append([m.message_id for m in messages]))
+    collector.add(_msg(2))
+    collector.add(_msg(1))
+    collector.flush_all()
+    assert flushed == [[1, 2]]
+
+
+def test_album_message_sections():
+    text = format_album_message([(1, ["56", "300"]), (2, []), (3, None)], 12.34, 3)
+    assert text.startswith("Альбом: 3 фото.")
+    assert "Фото 1:\n2-значные:\n  56" in text
+    assert "Фото 2:\nчисла не найдены" in text
+    assert "Фото 3:\nне удалось обработать изображение" in text
+    assert text.endswith("Затрачено времени: 12.3 сек, затрата: 3 центов")
@@ -0,0 +1,199 @@
+import json
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from src.mrdoors import batches, recognition, utils
+from src.mrdoors.batches import BatchPoller, BatchStore, defer_photo
+
+SAMPLE = Path(__file__).parent / "assets" / "schema_sample.jpg"
+
+
+class FakeBatchAPI:
+    """Локальная замена эндпоинтов Files и Batches OpenAI.
+
+    Пакет выполняется по ``finish``: на каждую строку входного JSONL
+    ``answer(custom_id)`` даёт содержимое ответа модели или ``None`` (ошибка запроса).
+    """
+
+    def __init__(self):
+        self.uploads = {}
+        self.outputs = {}
+        self.jobs = {}
+        self.fail_uploads = 0
+        self.files = SimpleNamespace(create=self._upload, content=self._content)
+        self.batches = SimpleNamespace(create=self._create, retrieve=self._retrieve)
+
+    def _upload(self, file, purpose):
+        assert purpose == "batch"
+        if self.fail_uploads:
+            self.fail_uploads -= 1
+            raise ConnectionError("upload failed")
+        file_id = f"file-{len(self.uploads) + 1}"
+        self.uploads[file_id] = file.read().decode("utf-8")
+        return SimpleNamespace(id=file_id)
+
+    def _content(self, file_id):
+        return SimpleNamespace(text=self.outputs[file_id])
+
+    def _create(self, input_file_id, endpoint, completion_window, metadata=None):
+        batch = SimpleNamespace(id=f"batch-{len(self.jobs) + 1}", status="in_progress",
+                                input_file_id=input_file_id, output_file_id=None, error_file_id=None)
+        self.jobs[batch.id] = batch
+        return batch
+
+    def _retrieve(self, batch_id):
+        return self.jobs[batch_id]
+
+    def requests(self, batch_id):
+        return [json.loads(line) for line in self.uploads[self.jobs[batch_id].input_file_id].splitlines()]
+
+    def finish(self, batch_id, answer):
+        out, errors = [], []
+        for request in self.requests(batch_id):
+            content = answer(request["custom_id"])
+            if content is None:
+                errors.append({"custom_id": request["custom_id"], "response": None,
+                               "error": {"code": "server_error", "message": "boom"}})
+                continue
+            body = {"id": "chatcmpl", "object": "chat.completion", "created": 0, "model": request["body"]["model"],
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": content}}],
+                    "usage": {"prompt_tokens": 1000, "completion_tokens": 20, "total_tokens": 1020}}
+            out.append({"custom_id": request["custom_id"], "response": {"status_code": 200, "body": body},
+                        "error": None})
+        batch = self.jobs[batch_id]
+        batch.status = "completed"
+        self.outputs[f"{batch_id}-out"] = "\n".join(json.dumps(line) for line in out)
+        self.outputs[f"{batch_id}-err"] = "\n".join(json.dumps(line) for line in errors)
+        batch.output_file_id, batch.error_file_id = f"{batch_id}-out", f"{batch_id}-err"
+
+
+@pytest.fixture
+def env(monkeypatch, tmp_path):
+    events = []
+    monkeypatch.setattr(batches, "BATCH_DIR", str(tmp_path / "jsonl"))
+    monkeypatch.setattr(batches.analytics, "add_request", lambda stats, extra=None: events.append(stats))
+    monkeypatch.setattr(utils, "tile_cache", None)
+    monkeypatch.setattr(recognition, "recognition_cache", None)
+    return SimpleNamespace(api=FakeBatchAPI(), events=events, path=str(tmp_path / "batches.sqlite3"))
+
+
+def test_deferred_photo_survives_restart_and_is_delivered(env):
+    store = BatchStore(env.path)
+    count = defer_photo(SAMPLE.read_bytes(), "5:7", 5, 7, env.api, store)
+    assert count and defer_photo(SAMPLE.read_bytes(), "5:7", 5, 7, env.api, store) is None
+
+    (record,) = store.pending()
+    requests = env.api.requests(record.batch_id)
+    assert [r["custom_id"] for r in requests] == [f"5:7#t{t['index']}" for t in record.tiles]
+    assert requests[0]["url"] == "/v1/chat/completions"
+    assert requests[0]["body"]["messages"][1]["content"][1]["image_url"]["url"].startswith("data:")
+
+    delivered = []
+    poller = BatchPoller(env.api, lambda r, outcome: delivered.append(outcome), store, interval=0)
+    assert poller.poll_once() == 0 and not delivered
+
+    # Перезапуск: новое хранилище на том же файле видит пакет
+    store.close()
+    store = BatchStore(env.path)
+    failing = record.tiles[-1]["index"] if count > 1 else None
+    env.api.finish(record.batch_id, lambda cid: None if cid.endswith(f"#t{failing}") else
+                   json.dumps({"numbers": [["1250", 10, 10]] if cid.endswith("#t1") else []}))
+    poller = BatchPoller(env.api, lambda r, outcome: delivered.append(outcome), store, interval=0)
+    assert poller.poll_once() == 1
+
+    (outcome,) = delivered
+    assert outcome.numbers == ["1250"]
+    assert outcome.successful_tiles == count - (failing is not None)
+    ok = [s for s in env.events if s.status == "success"]
+    assert ok[0].raw_prompt["mode"] == "batch"
+    # Batch API — половина цены синхронного запроса
+    sync_cost = utils.CostCalculator.calculate_cost(record.model, 1000, 20)
+    assert outcome.cost_usd == pytest.approx(sync_cost * batches.BATCH_DISCOUNT * len(ok))
+    assert not store.pending() and not Path(record.input_path).exists()
+
+
+def test_batch_not_created_is_resubmitted_by_poller(env):
+    store = BatchStore(env.path)
+    env.api.fail_uploads = 1
+    assert defer_photo(SAMPLE.read_bytes(), "5:8", 5, 8, env.api, store)
+    (record,) = store.pending()
+    assert record.batch_id is None
+
+    BatchPoller(env.api, lambda r, outcome: None, store, interval=0).poll_once()
+    (record,) = store.pending()
+    assert record.status == batches.SUBMITTED and record.batch_id in env.api.jobs
+
+
+def test_poller_does_not_resubmit_a_batch_being_uploaded(env):
+    store = BatchStore(env.path)
+    poller = BatchPoller(env.api, lambda r, outcome: None, store, interval=0)
+    upload = env.api.files.create
+
+    def slow_upload(file, purpose):
+        # Опрос приходит, пока обработчик фото ещё загружает JSONL
+        (record,) = store.pending()
+        assert record.status == batches.SUBMITTING
+        poller.poll_once()
+        return upload(file, purpose)
+
+    env.api.files.create = slow_upload
+    assert defer_photo(SAMPLE.read_bytes(), "5:9", 5, 9, env.api, store)
+    (record,) = store.pending()
+    assert record.status == batches.SUBMITTED and list(env.api.jobs) == [record.batch_id]
+
+    # Зависшую отправку (процесс упал посреди загрузки) опрос берёт заново
+    assert not store.claim(record.id, stale_before=record.created_at + 3600)
+    store._update(record.id, status=batches.SUBMITTING)
+    assert not store.claim(record.id, stale_before=0)
+    assert store.claim(record.id, stale_before=record.created_at + 3600)
+
+
+def test_caption_flag():
+    assert batches.is_deferred("архив #batch")
+    assert batches.is_deferred("/batch")
+    assert not batches.is_deferred("batch")
+    assert not batches.is_deferred(None)
+
+
+def test_failed_delivery_is_retried_without_recounting(env):
+    store = BatchStore(env.path)
+    assert defer_photo(SAMPLE.read_bytes(), "5:9", 5, 9, env.api, store)
+    (record,) = store.pending()
+    env.api.finish(record.batch_id, lambda cid: json.dumps({"numbers": ["42"]}))
+
+    delivered, failures = [], [ConnectionError("telegram is down")]
+
+    def deliver(r, outcome):
+        if failures:
+            raise failures.pop()
+        delivered.append(outcome)
+
+    poller = BatchPoller(env.api, deliver, store, interval=0)
+    assert poller.poll_once() == 0
+    (record,) = store.pending()
+    assert record.status == batches.COLLECTED and record.attempts == 1
+    recorded = len(env.events)
+    assert recorded == len(record.tiles)
+
+    # Повтор — только доставка: аналитика и стоимость не пишутся второй раз
+    assert poller.poll_once() == 1
+    assert len(env.events) == recorded
+    assert delivered[0].numbers == ["42"] and not store.pending()
+
+
+def test_permanent_delivery_error_closes_record(env):
+    store = BatchStore(env.path)
+    assert defer_photo(SAMPLE.read_bytes(), "5:10", 5, 10, env.api, store)
+    (record,) = store.pending()
+    env.api.finish(record.batch_id, lambda cid: json.dumps({"numbers": []}))
+
+    def deliver(r, outcome):
+        error = RuntimeError("Forbidden: bot was blocked by the user")
+        error.error_code = 403
+        raise error
+
+    assert BatchPoller(env.api, deliver, store, interval=0).poll_once() == 0
+    assert not store.pending()
@@ -0,0 +1,45 @@
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image, ImageChops, ImageDraw
+
+from src.mrdoors.utils import ink_pixels, preprocess_and_tile
+
+SAMPLE = Path(__file__).parent / "assets" / "schema_sample.jpg"
+
+
+def _jpeg(img: Image.Image) -> bytes:
+    buf = BytesIO()
+    img.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+def test_sparse_numbers_are_not_skipped():
+    tiles, _ = preprocess_and_tile(SAMPLE.read_bytes(), max_side=2000, cols=2, rows=3, min_ink=8)
+    assert [t.index for t in tiles] == [1, 2, 3, 4, 5, 6]
+
+
+def test_blank_margin_tiles_are_skipped():
+    page = Image.new("RGB", (1000, 1400), "white")
+    page.paste(Image.open(SAMPLE), (0, 0))
+    prepared = preprocess_and_tile(_jpeg(page), max_side=2000, cols=2, rows=3, min_ink=8)
+    # Нижний ряд — пустая бумага; номера остальных тайлов — позиции в сетке
+    assert [t.index for t in prepared.tiles] == [1, 2, 3, 4]
+    assert prepared.skipped == 2
+    assert len(preprocess_and_tile(_jpeg(page), max_side=2000, cols=2, rows=3).tiles) == 6
+
+
+def test_all_blank_photo_still_counts_skipped_tiles():
+    prepared = preprocess_and_tile(_jpeg(Image.new("RGB", (1000, 1400), "white")),
+                                   max_side=2000, cols=2, rows=3, min_ink=8)
+    assert prepared.tiles == [] and prepared.skipped == 6
+
+
+def test_ink_ignores_noise_and_shading_but_sees_a_number():
+    shading = Image.linear_gradient("L").resize((500, 300)).point(lambda v: 150 + v * 70 // 255)
+    paper = ImageChops.add(shading, Image.effect_noise((500, 300), 8), 1, -128)
+    assert ink_pixels(paper) == 0
+
+    draw = ImageDraw.Draw(paper)
+    draw.text((240, 140), "15", fill=0)
+    assert ink_pixels(paper) >= 8
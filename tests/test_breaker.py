@@ -0,0 +1,76 @@
+import time
+from types import SimpleNamespace
+
+from src.mrdoors import breaker, utils
+from src.mrdoors.breaker import CLOSED, HALF_OPEN, OPEN, BreakerRegistry, CircuitBreaker
+
+
+def _events(monkeypatch):
+    events = []
+    monkeypatch.setattr(breaker.analytics, "add_event", lambda stats, extra=None: events.append(stats))
+    return events
+
+
+def _wait_for(events, count):
+    # События отправляются из отдельного потока
+    deadline = time.time() + 2
+    while len(events) < count and time.time() < deadline:
+        time.sleep(0.01)
+    return events
+
+
+def test_opens_on_errors_probes_and_closes(monkeypatch):
+    events = _events(monkeypatch)
+    now = [0.0]
+    b = CircuitBreaker("gpt-4o", window=10, min_calls=4, error_rate=0.5, slow_seconds=30, slow_rate=0.5,
+                       open_seconds=10, clock=lambda: now[0])
+    for ok in (True, False, True, False):
+        assert b.allow()
+        b.record(ok, 1.0)
+    assert b.state == OPEN and not b.allow()
+
+    now[0] = 11
+    assert b.allow() and b.state == HALF_OPEN
+    # Пока пробный запрос не вернулся, остальные модель пропускают
+    assert not b.allow()
+    b.record(True, 1.0)
+    assert b.state == CLOSED and b.allow()
+
+    statuses = [(e.raw_response["breaker"]["to"], e.status) for e in _wait_for(events, 3)]
+    assert statuses == [(OPEN, "error"), (HALF_OPEN, "partial"), (CLOSED, "success")]
+
+
+def test_slow_answers_open_breaker_and_failed_probe_reopens(monkeypatch):
+    _events(monkeypatch)
+    now = [0.0]
+    b = CircuitBreaker("gpt-4o", window=4, min_calls=2, error_rate=0.5, slow_seconds=5, slow_rate=0.5,
+                       open_seconds=10, clock=lambda: now[0])
+    b.record(True, 40.0)
+    b.record(True, 40.0)
+    assert b.state == OPEN
+    now[0] = 10
+    assert b.allow()
+    b.record(False, 45.0)
+    assert b.state == OPEN and not b.allow()
+
+
+def test_degraded_model_is_skipped_for_following_tiles(monkeypatch):
+    _events(monkeypatch)
+    monkeypatch.setattr(utils, "breakers", BreakerRegistry(window=10, min_calls=2, error_rate=0.5,
+                                                           slow_seconds=30, slow_rate=0.5, open_seconds=60))
+    monkeypatch.setattr(utils.analytics, "add_request", lambda stats, extra=None: None)
+    monkeypatch.setattr(utils, "_models_to_try", lambda: ["gpt-4o", "gpt-4o-mini"])
+    calls = []
+
+    def create(model, **request):
+        calls.append(model)
+        if model == "gpt-4o":
+            raise TimeoutError("gpt-4o is degraded")
+        message = SimpleNamespace(content='{"numbers": ["42"]}')
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)],
+                               usage=SimpleNamespace(prompt_tokens=100, completion_tokens=5))
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    for i in range(1, 5):
+        assert utils.ask_openai_for_numbers({"type": "image_url"}, f"1:2#t{i}", client) == ["42"]
+    assert calls == ["gpt-4o", "gpt-4o-mini", "gpt-4o", "gpt-4o-mini", "gpt-4o-mini", "gpt-4o-mini"]
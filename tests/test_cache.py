@@ -0,0 +1,164 @@
+import asyncio
+import threading
+import time
+
+from src.mrdoors import recognition
+from src.mrdoors.utils import Tile, TileSet
+from src.mrdoors.cache import AsyncSingleFlight, RecognitionCache, SingleFlight, cache_key
+from src.mrdoors.analytics import RequestStats
+
+
+def test_key_depends_on_bytes_and_params():
+    key = cache_key(b"photo", max_side=2000, cols=2, rows=3)
+    assert key == cache_key(b"photo", rows=3, cols=2, max_side=2000)
+    assert key != cache_key(b"photo", max_side=1800, cols=2, rows=3)
+    assert key != cache_key(b"other", max_side=2000, cols=2, rows=3)
+
+
+def test_ttl_and_lru_eviction(tmp_path):
+    cache = RecognitionCache(str(tmp_path / "cache.sqlite3"), max_bytes=100, ttl=60)
+    cache.put("a", {"numbers": ["1" * 30]})
+    cache.put("b", {"numbers": ["2" * 30]})
+    # "a" использовали недавно — вытеснится "b"
+    time.sleep(0.01)
+    assert cache.get("a") is not None
+    cache.put("c", {"numbers": ["3" * 30]})
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.stats()["bytes"] <= 100
+
+    cache.ttl = 0
+    time.sleep(0.01)
+    assert cache.get("a") is None
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    flight = SingleFlight()
+    calls = 0
+    started = threading.Event()
+    release = threading.Event()
+
+    def work():
+        nonlocal calls
+        calls += 1
+        started.set()
+        release.wait(1)
+        return 42
+
+    out = []
+    leader = threading.Thread(target=lambda: out.append(flight.do("k", work)))
+    leader.start()
+    started.wait(1)
+    follower = threading.Thread(target=lambda: out.append(flight.do("k", work)))
+    follower.start()
+    time.sleep(0.05)
+    release.set()
+    leader.join()
+    follower.join()
+
+    assert calls == 1
+    assert sorted(out, key=lambda r: r[1]) == [(42, False), (42, True)]
+
+
+def test_async_single_flight_coalesces_and_shares_errors():
+    flight = AsyncSingleFlight()
+    calls = 0
+
+    async def work():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return 42
+
+    async def boom():
+        await asyncio.sleep(0.05)
+        raise ValueError("boom")
+
+    async def main():
+        assert sorted(await asyncio.gather(flight.do("k", work), flight.do("k", work)),
+                      key=lambda r: r[1]) == [(42, False), (42, True)]
+        errors = await asyncio.gather(flight.do("e", boom), flight.do("e", boom), return_exceptions=True)
+        assert [type(e) for e in errors] == [ValueError, ValueError]
+        # Ключ освобождается: следующий вызов выполняется заново
+        assert await flight.do("k", work) == (42, False)
+
+    asyncio.run(main())
+    assert calls == 2
+
+
+def test_recognize_photo_uses_cache(monkeypatch, tmp_path):
+    cache = RecognitionCache(str(tmp_path / "cache.sqlite3"), max_bytes=1_000_000, ttl=60)
+    monkeypatch.setattr(recognition, "recognition_cache", cache)
+    monkeypatch.setattr(recognition, "prepare_tiles", lambda data, req_id: TileSet([Tile(i, memoryview(b"")) for i in (1, 2)], 2))
+    calls = []
+
+    def fake_recognize(tiles, req_id, client, on_result=None):
+        calls.append(req_id)
+        stats = RequestStats(duration=0.1, input_tokens=10, output_tokens=5, cost_usd=0.025,
+                             model="gpt-4o", request_id=req_id)
+        return [recognition.TileResult(index=i, req_id=req_id, numbers=["56"], stats=[stats])
+                for i in (1, 2)]
+
+    monkeypatch.setattr(recognition.tile_executor, "recognize", fake_recognize)
+
+    first = recognition.recognize_photo(b"jpeg", "1:1", None)
+    second = recognition.recognize_photo(b"jpeg", "2:1", None)
+
+    assert calls == ["1:1"]
+    assert not first.cached and first.cost_usd == 0.05
+    assert second.cached and second.cost_usd == 0 and second.numbers == ["56"]
+
+
+def test_album_coalesces_photos_in_flight(monkeypatch, tmp_path):
+    cache = RecognitionCache(str(tmp_path / "cache.sqlite3"), max_bytes=1_000_000, ttl=60)
+    monkeypatch.setattr(recognition, "recognition_cache", cache)
+    monkeypatch.setattr(recognition, "prepare_tiles", lambda data, req_id: TileSet([Tile(1, memoryview(data))], 1))
+    sent = []
+
+    def fake_recognize_many(jobs, client, limit):
+        sent.extend(req_id for req_id, _ in jobs)
+        stats = RequestStats(duration=0.1, input_tokens=10, output_tokens=5, cost_usd=0.01,
+                             model="gpt-4o", request_id="x")
+        return [recognition.TileResult(index=1, req_id=req_id, numbers=[bytes(tile.data).decode()], stats=[stats])
+                for req_id, tile in jobs]
+
+    monkeypatch.setattr(recognition.tile_executor, "recognize_many", fake_recognize_many)
+
+    # Фото "b" уже распознаёт другой запрос (одиночное фото)
+    key = cache_key(b"b", **recognition.TILING)
+    call, leader = recognition.single_flight.begin(key)
+    assert leader
+    other = recognition.PhotoOutcome(numbers=["b"], tile_count=1, successful_tiles=1, cost_usd=0.01)
+    threading.Timer(0.1, lambda: recognition.single_flight.finish(key, call, other)).start()
+
+    loads = [("1:1", lambda: b"a"), ("1:2", lambda: b"a"), ("1:3", lambda: b"b")]
+    outcomes = recognition.recognize_album(loads, None, limit=4)
+
+    assert sent == ["1:1"]
+    assert outcomes["1:1"].numbers == ["a"] and not outcomes["1:1"].cached
+    assert outcomes["1:2"].numbers == ["a"] and outcomes["1:2"].cached and outcomes["1:2"].cost_usd == 0
+    assert outcomes["1:3"].numbers == ["b"] and outcomes["1:3"].cached
+
+
+def test_album_downloads_and_prepares_in_parallel(monkeypatch):
+    monkeypatch.setattr(recognition, "recognition_cache", None)
+    monkeypatch.setattr(recognition, "tile_executor", recognition.TileExecutor(max_workers=8))
+
+    def prepare(data, req_id):
+        time.sleep(0.2)
+        return TileSet([], 6)
+
+    def download(data):
+        time.sleep(0.2)
+        if data == b"bad":
+            raise recognition.PhotoError("не скачалось", retryable=True)
+        return data
+
+    monkeypatch.setattr(recognition, "prepare_tiles", prepare)
+    loads = [(f"1:{n}", lambda n=n: download(b"bad" if n == 4 else bytes([n]))) for n in range(1, 5)]
+    started = time.perf_counter()
+    outcomes = recognition.recognize_album(loads, None, limit=4)
+
+    assert time.perf_counter() - started < 0.6
+    assert [outcomes[f"1:{n}"].skipped_tiles for n in (1, 2, 3)] == [6, 6, 6]
+    assert outcomes["1:4"].retryable
@@ -0,0 +1,182 @@
+import asyncio
+import json
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from src.mrdoors import utils
+from src.mrdoors.hedging import Hedger
+
+
+def _reply(numbers):
+    content = numbers if isinstance(numbers, str) else json.dumps({"numbers": numbers})
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+                           usage=SimpleNamespace(prompt_tokens=1000, completion_tokens=20))
+
+
+@pytest.fixture
+def cascade(monkeypatch):
+    """Каскад gpt-4o-mini → gpt-4o; ``answers[(model, req_id)]`` — ответ или исключение."""
+    events, calls, answers = [], [], {}
+    monkeypatch.setattr(utils, "MODEL_CASCADE", True)
+    monkeypatch.setattr(utils, "CASCADE_MODEL", "gpt-4o-mini")
+    monkeypatch.setattr(utils, "PREFERRED_MODEL", "gpt-4o")
+    monkeypatch.setattr(utils, "tile_cache", None)
+    monkeypatch.setattr(utils, "hedger", Hedger(max_extra=0))
+    monkeypatch.setattr(utils.analytics, "add_request", lambda stats, extra=None: events.append(stats))
+
+    def create(client, model, payload, req_id, temperature=0):
+        calls.append((model, req_id, temperature))
+        answer = answers[(model, req_id)]
+        if isinstance(answer, Exception):
+            raise answer
+        return _reply(answer)
+
+    async def create_async(client, model, payload, req_id, temperature=0):
+        return create(client, model, payload, req_id, temperature)
+
+    monkeypatch.setattr(utils, "_create_completion", create)
+    monkeypatch.setattr(utils, "_create_completion_async", create_async)
+    return SimpleNamespace(events=events, calls=calls, answers=answers)
+
+
+def _ask(ink=3000, positions=None):
+    return utils.ask_openai_for_numbers({"type": "image_url"}, "1:2#t1", None, positions=positions,
+                                        image_info={"width": 768, "height": 768, "ink": ink})
+
+
+def test_cheap_answer_is_accepted(cascade):
+    cascade.answers[("gpt-4o-mini", "1:2#t1~cheap")] = [[str(n), 10, 10] for n in range(1, 7)]
+    assert _ask() == ["1", "2", "3", "4", "5", "6"]
+    assert [c[0] for c in cascade.calls] == ["gpt-4o-mini"]
+    (event,) = cascade.events
+    assert event.raw_response["cascade"]["escalate"] is False
+    assert event.raw_response["cascade"]["expected"] == 5.0
+
+
+def test_sparse_answer_is_escalated(cascade):
+    cascade.answers[("gpt-4o-mini", "1:2#t1~cheap")] = ["12", "x"]
+    cascade.answers[("gpt-4o", "1:2#t1")] = [str(n) for n in range(10, 16)]
+    assert _ask() == ["10", "11", "12", "13", "14", "15"]
+    assert [c[0] for c in cascade.calls] == ["gpt-4o-mini", "gpt-4o"]
+    cheap, expensive = cascade.events
+    assert cheap.raw_response["cascade"]["reasons"] == ["invalid", "sparse"]
+    assert "cascade" not in expensive.raw_response
+
+
+def test_disagreement_escalates_and_cheap_numbers_survive_expensive_failure(cascade, monkeypatch):
+    monkeypatch.setattr(utils, "CASCADE_MIN_AGREEMENT", 0.8)
+    cascade.answers[("gpt-4o-mini", "1:2#t1~cheap")] = ["1", "2", "3"]
+    cascade.answers[("gpt-4o-mini", "1:2#t1~s2")] = ["1", "2", "9"]
+    cascade.answers[("gpt-4o", "1:2#t1")] = TimeoutError("gpt-4o is down")
+    positions = []
+    assert _ask(ink=100, positions=positions) == ["1", "2", "3"]
+    assert positions == [None, None, None]
+    assert cascade.calls[1] == ("gpt-4o-mini", "1:2#t1~s2", utils.SAMPLE_TEMPERATURE)
+    sample, cheap = cascade.events
+    assert sample.raw_prompt["cascade"] == "sample"
+    assert cheap.raw_response["cascade"]["reasons"] == ["disagreement"]
+    assert cheap.raw_response["cascade"]["agreement"] == 0.5
+
+
+def test_verdict_on_unparsed_json():
+    verdict = utils.cascade_verdict("числа: 12, 15", [], [], ink=None)
+    assert verdict["escalate"] and verdict["reasons"] == ["json", "empty"]
+
+
+class _TileCache:
+    def __init__(self):
+        self.added = {}
+
+    def lookup(self, phash):
+        return None
+
+    def add(self, phash, numbers):
+        self.added[phash] = numbers
+
+
+def test_group_request_is_hedged_cascaded_and_cached(cascade, monkeypatch):
+    tile_cache, hedged = _TileCache(), []
+    monkeypatch.setattr(utils, "tile_cache", tile_cache)
+    call = utils.hedger.call
+    monkeypatch.setattr(utils.hedger, "call", lambda fn, model, req_id: hedged.append(req_id) or call(fn, model, req_id))
+    tiles = [utils.Tile(index=i, data=memoryview(b"jpeg"), phash=f"p{i}", size=(768, 768), encoding={"ink": 3000})
+             for i in (1, 2, 3)]
+    six = [[str(n), 10, 10] for n in range(1, 7)]
+    cascade.answers[("gpt-4o-mini", "1:2#g1+2+3~cheap")] = json.dumps({"tiles": {"1": six, "2": ["12"]}})
+    cascade.answers[("gpt-4o", "1:2#g2+3")] = TimeoutError("gpt-4o is down")
+    cascade.answers[("gpt-4o-mini", "1:2#t3~cheap")] = [str(n) for n in range(30, 36)]
+
+    answers = utils.ask_openai_for_tiles(tiles, "1:2", None)
+
+    assert [a.numbers for a in answers] == [["1", "2", "3", "4", "5", "6"], ["12"],
+                                            ["30", "31", "32", "33", "34", "35"]]
+    assert [c[:2] for c in cascade.calls] == [("gpt-4o-mini", "1:2#g1+2+3~cheap"), ("gpt-4o", "1:2#g2+3"),
+                                              ("gpt-4o-mini", "1:2#t3~cheap")]
+    assert hedged == ["1:2#g1+2+3~cheap", "1:2#g2+3", "1:2#t3~cheap"]
+    group = cascade.events[0]
+    assert group.raw_response["cascade"]["1"]["escalate"] is False
+    assert group.raw_response["cascade"]["2"]["reasons"] == ["sparse"]
+    assert group.raw_response["cascade"]["3"]["reasons"] == ["json", "empty"]
+    # В кэш тайлов попадают только принятые ответы, не числа эскалированного тайла
+    assert tile_cache.added == {"p1": ["1", "2", "3", "4", "5", "6"], "p3": ["30", "31", "32", "33", "34", "35"]}
+
+
+def test_async_runs_the_same_flow(cascade, monkeypatch):
+    monkeypatch.setattr(utils, "CASCADE_MIN_AGREEMENT", 0.8)
+    cascade.answers[("gpt-4o-mini", "1:2#t1~cheap")] = ["1", "2", "3"]
+    cascade.answers[("gpt-4o-mini", "1:2#t1~s2")] = ["1", "2", "9"]
+    cascade.answers[("gpt-4o", "1:2#t1")] = ["1", "2", "3", "4"]
+    monkeypatch.setattr(utils.analytics, "add_request_async",
+                        lambda stats, extra=None: asyncio.sleep(0, cascade.events.append(stats)))
+
+    numbers = _ask(ink=100)
+    sync_calls, sync_events = list(cascade.calls), [e.request_id for e in cascade.events]
+    cascade.calls.clear()
+    cascade.events.clear()
+    async_numbers = asyncio.run(utils.ask_openai_for_numbers_async(
+        {"type": "image_url"}, "1:2#t1", None, image_info={"width": 768, "height": 768, "ink": 100}))
+
+    assert numbers == async_numbers == ["1", "2", "3", "4"]
+    assert cascade.calls == sync_calls
+    # У дешёвой ступени свой id: событие дорогой модели не перезапишет решение каскада
+    assert [e.request_id for e in cascade.events] == sync_events == ["1:2#t1~s2", "1:2#t1~cheap", "1:2#t1"]
+    assert cascade.events[1].raw_response["cascade"]["reasons"] == ["disagreement"]
+    assert "cascade" not in cascade.events[2].raw_response
+
+
+def test_escalated_group_keeps_its_verdict_event(cascade):
+    tiles = [utils.Tile(index=i, data=memoryview(b"jpeg"), size=(768, 768), encoding={"ink": 3000}) for i in (1, 2)]
+    cascade.answers[("gpt-4o-mini", "1:2#g1+2~cheap")] = json.dumps({"tiles": {"1": ["12"], "2": ["13"]}})
+    cascade.answers[("gpt-4o", "1:2#g1+2")] = json.dumps({"tiles": {"1": [str(n) for n in range(1, 7)],
+                                                                    "2": [str(n) for n in range(7, 13)]}})
+
+    answers = utils.ask_openai_for_tiles(tiles, "1:2", None)
+
+    assert [len(a.numbers) for a in answers] == [6, 6]
+    cheap, expensive = cascade.events
+    assert (cheap.request_id, expensive.request_id) == ("1:2#g1+2~cheap", "1:2#g1+2")
+    assert cheap.raw_response["cascade"]["1"]["escalate"] and cheap.raw_response["cascade"]["2"]["escalate"]
+
+
+def test_async_flow_keeps_tile_cache_off_the_event_loop(cascade, monkeypatch):
+    threads = []
+
+    class _Cache(_TileCache):
+        def lookup(self, phash):
+            threads.append(threading.current_thread())
+            return None
+
+    monkeypatch.setattr(utils, "tile_cache", _Cache())
+    monkeypatch.setattr(utils.analytics, "add_request_async", lambda stats, extra=None: asyncio.sleep(0))
+    cascade.answers[("gpt-4o-mini", "1:2#t1~cheap")] = [str(n) for n in range(1, 7)]
+
+    async def main():
+        numbers = await utils.ask_openai_for_numbers_async(
+            {"type": "image_url"}, "1:2#t1", None, phash="p1", image_info={"width": 768, "height": 768, "ink": 3000})
+        return numbers, threading.current_thread()
+
+    numbers, loop_thread = asyncio.run(main())
+    assert numbers == ["1", "2", "3", "4", "5", "6"]
+    assert threads and loop_thread not in threads
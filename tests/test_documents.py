@@ -0,0 +1,91 @@
+import hashlib
+from pathlib import Path
+
+import pytest
+import requests
+from PIL import Image, ImageChops, ImageStat
+
+from src.mrdoors import documents
+from src.mrdoors.recognition import PhotoError
+
+SAMPLE = Path(__file__).parent / "assets" / "schema_sample.jpg"
+
+
+def _scan(size=(3000, 2000)) -> Image.Image:
+    return Image.open(SAMPLE).convert("RGB").resize(size)
+
+
+@pytest.mark.parametrize("mode", ["RGB", "L", "1", "P"])
+def test_uncompressed_tiff_over_ceiling_is_decoded_in_bands(tmp_path, mode):
+    path = tmp_path / "scan.tif"
+    _scan().convert(mode).save(path, compression=None)
+
+    full = documents.decode_page(str(path), 0, 1500)
+    banded = documents.decode_page(str(path), 0, 1500, max_bytes=2 << 20)
+
+    assert full.size == banded.size == (1500, 1000)
+    assert max(ImageStat.Stat(ImageChops.difference(full, banded)).mean) < 0.5
+
+
+def test_compressed_page_over_ceiling_is_rejected(tmp_path):
+    path = tmp_path / "scan.png"
+    _scan().save(path)
+
+    with pytest.raises(PhotoError):
+        documents.decode_page(str(path), 0, 1500, max_bytes=1 << 20)
+
+
+def test_multipage_tiff_pages_feed_tiling(tmp_path):
+    path = tmp_path / "pages.tif"
+    scan = _scan((1200, 800))
+    scan.save(path, save_all=True, append_images=[scan.rotate(90, expand=True)], compression="tiff_lzw")
+
+    assert documents.page_count(str(path)) == 2
+    planned, tiles = documents.render_page(str(path), 1, max_side=1000, min_ink=8, layout="adaptive")
+    assert planned >= 1 and tiles
+    assert documents.decode_page(str(path), 1, 1000).size == (666, 1000)
+
+
+def test_supported_documents():
+    assert documents.is_supported("image/tiff", "scan.tif")
+    assert documents.is_supported(None, "SCAN.PDF")
+    assert not documents.is_supported("application/zip", "scan.zip")
+
+
+class _Response:
+    def __init__(self, status: int, body: bytes):
+        self.status_code, self.body = status, body
+
+    def raise_for_status(self):
+        if self.status_code != 200:
+            raise requests.HTTPError(f"{self.status_code} Not Found")
+
+    def iter_content(self, size):
+        return (self.body[i:i + size] for i in range(0, len(self.body), size))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+def test_spool_streams_public_file_url(monkeypatch):
+    body = SAMPLE.read_bytes()
+    urls = []
+
+    def get(url, **kwargs):
+        urls.append(url)
+        return _Response(200 if url.endswith("scan.jpg") else 404, body)
+
+    monkeypatch.setattr(documents.requests, "get", get)
+    monkeypatch.setattr(documents, "CHUNK_SIZE", 4096)
+    with documents.spool_document("TOKEN", "documents/scan.jpg") as document:
+        assert urls == ["https://api.telegram.org/file/botTOKEN/documents/scan.jpg"]
+        assert Path(document.path).read_bytes() == body
+        assert document.digest == hashlib.sha256(body).hexdigest() and document.size == len(body)
+
+    with pytest.raises(requests.HTTPError):
+        documents.spool_document("TOKEN", "documents/missing.jpg")
+    with pytest.raises(PhotoError):
+        documents.spool_document("TOKEN", "documents/scan.jpg", max_bytes=10_000)
@@ -0,0 +1,39 @@
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image, ImageChops, ImageDraw
+
+from src.mrdoors.encoding import edge_ssim, encode_tile
+
+SAMPLE = Path(__file__).parent / "assets" / "schema_sample.jpg"
+
+
+def _sample() -> Image.Image:
+    return Image.open(SAMPLE).convert("RGB")
+
+
+def test_schematic_gets_a_smaller_readable_encoding():
+    img = _sample()
+    encoded = encode_tile(img, min_ssim=0.98)
+    assert encoded.variant in ("binary", "gray")
+    assert len(encoded.data) < encoded.baseline_bytes / 3
+    assert encoded.ssim >= 0.98
+    decoded = Image.open(BytesIO(encoded.data))
+    assert decoded.size == img.size and edge_ssim(img, decoded) >= 0.98
+    assert encoded.info["bytes"] == len(encoded.data)
+
+
+def test_colour_marks_keep_rgb():
+    img = _sample()
+    ImageDraw.Draw(img).rectangle((100, 100, 400, 300), outline=(220, 20, 20), width=12)
+    assert encode_tile(img, min_ssim=0.98).variant == "rgb"
+
+
+def test_noisy_photo_is_not_binarized():
+    img = ImageChops.add(_sample(), Image.effect_noise((1000, 700), 40).convert("RGB"), 1, -128)
+    assert encode_tile(img, min_ssim=0.98).variant != "binary"
+
+
+def test_disabled_encoder_sends_baseline_jpeg():
+    encoded = encode_tile(_sample(), min_ssim=0)
+    assert (encoded.format, encoded.variant, encoded.quality) == ("JPEG", "rgb", 92)
@@ -0,0 +1,116 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from src.mrdoors import hedging
+from src.mrdoors.hedging import Hedger
+
+
+def _reply(tokens=100):
+    return SimpleNamespace(usage=SimpleNamespace(prompt_tokens=tokens, completion_tokens=10))
+
+
+def _hedger(**kwargs) -> Hedger:
+    params = dict(q=50, min_samples=3, min_delay=0.05, max_extra=1.0, model="")
+    params.update(kwargs)
+    h = Hedger(**params)
+    for _ in range(3):
+        h.observe("gpt-4o", 0.05)
+    return h
+
+
+def test_straggler_is_hedged_and_loser_spend_recorded(monkeypatch):
+    lost = []
+    recorded = threading.Event()
+    monkeypatch.setattr(hedging.analytics, "add_request", lambda stats, extra=None: (lost.append(stats), recorded.set()))
+    calls = []
+
+    def fn(model, req_id):
+        calls.append(req_id)
+        if not req_id.endswith("~hedge"):
+            time.sleep(0.4)
+        return _reply()
+
+    started = time.perf_counter()
+    resp, model, info = _hedger(model="gpt-4o-mini").call(fn, "gpt-4o", "1:2#t1")
+    assert time.perf_counter() - started < 0.3
+    assert calls == ["1:2#t1", "1:2#t1~hedge"]
+    assert model == "gpt-4o-mini" and info["won"] == "hedge"
+
+    # Синхронный проигравший не прерывается, но его стоимость видна в аналитике
+    assert recorded.wait(2)
+    assert lost[0].request_id == "1:2#t1@lost" and lost[0].cost_usd > 0
+
+
+def test_fast_calls_and_budget_are_not_hedged(monkeypatch):
+    lost = threading.Event()
+    monkeypatch.setattr(hedging.analytics, "add_request", lambda stats, extra=None: lost.set())
+    calls = []
+
+    def fn(model, req_id):
+        calls.append(req_id)
+        time.sleep(0.15)
+        return _reply()
+
+    # Пока задержек меньше min_samples — без хеджирования
+    assert Hedger(q=50, min_samples=3, min_delay=0.05, max_extra=1.0).call(fn, "gpt-4o", "a")[2] is None
+    # Бюджет 0.5: первый медленный запрос дубликата не получает, второй — получает
+    h = _hedger(max_extra=0.5)
+    assert h.call(fn, "gpt-4o", "b")[2] is None
+    assert h.call(fn, "gpt-4o", "c")[2] is not None
+    assert calls == ["a", "b", "c", "c~hedge"]
+    assert lost.wait(2)
+
+
+def test_async_loser_is_cancelled():
+    cancelled = []
+
+    async def fn(model, req_id):
+        try:
+            await asyncio.sleep(0.01 if req_id.endswith("~hedge") else 1.0)
+        except asyncio.CancelledError:
+            cancelled.append(req_id)
+            raise
+        return _reply()
+
+    async def main():
+        return await _hedger().call_async(fn, "gpt-4o", "1:2#t1")
+
+    _, _, info = asyncio.run(main())
+    assert info["won"] == "hedge" and cancelled == ["1:2#t1"]
+
+
+def test_both_failures_raise():
+    def fn(model, req_id):
+        time.sleep(0.1)
+        raise RuntimeError(req_id)
+
+    with pytest.raises(RuntimeError):
+        _hedger().call(fn, "gpt-4o", "x")
+
+
+def test_latency_is_the_model_call_alone(monkeypatch):
+    from src.mrdoors import utils
+    from src.mrdoors.breaker import BreakerRegistry
+
+    h = Hedger(q=50, min_samples=1, min_delay=0.0, max_extra=1.0)
+    monkeypatch.setattr(utils, "hedger", h)
+    monkeypatch.setattr(utils, "breakers", BreakerRegistry())
+
+    def create(**request):
+        time.sleep(0.05)
+        if request["model"] == "gpt-4o":
+            raise TimeoutError("gpt-4o is down")
+        return _reply()
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    time.sleep(0.2)  # ожидание в очереди лимитов не входит в задержку модели
+    utils._send(client, "gpt-4o-mini", {"model": "gpt-4o-mini"})
+    with pytest.raises(TimeoutError):
+        utils._send(client, "gpt-4o", {"model": "gpt-4o"})
+
+    assert 0.05 <= h.delay("gpt-4o-mini") < 0.15
+    assert h.delay("gpt-4o") is None
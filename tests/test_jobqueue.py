@@ -0,0 +1,65 @@
+import time
+
+from src.mrdoors.jobqueue import JobQueue
+
+
+def _queue(tmp_path, **kwargs) -> JobQueue:
+    return JobQueue(str(tmp_path / "jobs.sqlite3"), **kwargs)
+
+
+def test_fifo_claim_and_ack(tmp_path):
+    q = _queue(tmp_path)
+    first = q.enqueue("photo", {"n": 1})
+    q.enqueue("photo", {"n": 2})
+
+    job = q.claim("w1")
+    assert job.id == first and job.payload == {"n": 1} and job.attempts == 1
+    assert q.claim("w2").payload == {"n": 2}
+    assert q.claim("w3") is None
+
+    assert q.ack(job)
+    assert q.stats() == {"pending": 0, "running": 1, "dead": 0}
+
+
+def test_expired_lease_is_redelivered(tmp_path):
+    q = _queue(tmp_path, visibility_timeout=0.05)
+    q.enqueue("photo", {"n": 1})
+    lost = q.claim("w1")
+    time.sleep(0.1)
+
+    again = q.claim("w2")
+    assert again.id == lost.id and again.attempts == 2
+    # Старый воркер уже не владеет заданием
+    assert not q.ack(lost)
+    assert q.ack(again)
+
+
+def test_fail_retries_then_dead(tmp_path):
+    q = _queue(tmp_path, max_attempts=2)
+    q.enqueue("photo", {})
+    q.fail(q.claim("w"), "boom", retry_delay=0)
+    job = q.claim("w")
+    assert job.attempts == 2
+    q.fail(job, "boom again", retry_delay=0)
+    assert q.claim("w") is None
+    assert q.stats()["dead"] == 1
+
+
+def test_recover_and_release_after_restart(tmp_path):
+    q = _queue(tmp_path, visibility_timeout=600)
+    q.enqueue("photo", {"n": 1})
+    q.enqueue("photo", {"n": 2})
+    q.enqueue("photo", {"n": 3})
+    crashed = q.claim("dead-worker")
+    stopping = q.claim("dead-worker")
+    live = q.claim("live-worker")
+    assert q.release(stopping)
+
+    # Новый процесс открывает тот же файл: аренду живого воркера не трогает
+    q2 = _queue(tmp_path, visibility_timeout=600)
+    assert q2.recover(lambda worker: worker == "dead-worker") == 1
+    resumed = [q2.claim("new"), q2.claim("new")]
+    assert sorted(j.id for j in resumed) == sorted([crashed.id, stopping.id])
+    assert {j.id: j.attempts for j in resumed} == {crashed.id: 2, stopping.id: 1}
+    assert q2.claim("new") is None
+    assert q.ack(live)
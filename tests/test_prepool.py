@@ -0,0 +1,53 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from src.mrdoors.prepool import PreprocessBusy, PreprocessPool
+from src.mrdoors.utils import preprocess_and_tile
+
+SAMPLE = Path(__file__).parent / "assets" / "schema_sample.jpg"
+PARAMS = {"max_side": 2000, "cols": 2, "rows": 3, "min_ink": 8}
+
+
+def _segments():
+    return set(os.listdir("/dev/shm")) if os.path.isdir("/dev/shm") else set()
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    # Процессы пула импортируют config заново — им нужны переменные окружения
+    monkeypatch.setenv("BOT_TOKEN", "test-bot-token")
+    monkeypatch.setenv("OPENAI_API_KEY", "test-openai-key")
+    pool = PreprocessPool(workers=2, max_pending=1, timeout=0.2)
+    pool.start()
+    yield pool
+    pool.shutdown()
+
+
+def test_pool_matches_inline_and_cleans_shared_memory(pool):
+    data = SAMPLE.read_bytes()
+    before = _segments()
+    tiles = pool.render(data, **PARAMS)
+    assert tiles == preprocess_and_tile(data, **PARAMS)
+    assert _segments() == before
+
+
+def test_saturated_pool_pushes_back(pool):
+    assert pool._slots.acquire(blocking=False)
+    try:
+        with pytest.raises(PreprocessBusy):
+            pool.render(SAMPLE.read_bytes(), **PARAMS)
+    finally:
+        pool._slots.release()
+
+
+def test_pool_renders_document_pages_from_file(pool, tmp_path):
+    from src.mrdoors.documents import render_page
+    from src.mrdoors.utils import make_tiles
+
+    path = tmp_path / "scan.png"
+    path.write_bytes(SAMPLE.read_bytes())
+    before = _segments()
+    assert pool.render_page(str(path), 0, **PARAMS) == make_tiles(*render_page(str(path), 0, **PARAMS))
+    assert _segments() == before
@@ -0,0 +1,49 @@
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+from PIL import Image, ImageChops, ImageDraw, ImageStat
+
+from src.mrdoors.utils import load_image
+
+SAMPLE = Path(__file__).parent / "assets" / "schema_sample.jpg"
+
+
+def _photo(size) -> bytes:
+    img = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(img)
+    for i in range(0, size[0], 97):
+        draw.line((i, 0, size[0] - i, size[1]), fill=(30, 30, 30), width=4)
+    buf = BytesIO()
+    img.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+def test_draft_decode_matches_full_decode():
+    data = _photo((4000, 3000))
+    full = load_image(data, 1800, draft=False)
+    scaled = load_image(data, 1800)
+    assert full.size == scaled.size == (1800, 1350)
+    assert max(ImageStat.Stat(ImageChops.difference(full, scaled)).mean) < 4
+
+
+def test_small_images_are_not_resized():
+    assert load_image(_photo((1000, 700)), 2000).size == (1000, 700)
+
+
+def test_numpy_backend_matches_pillow():
+    np = pytest.importorskip("numpy")
+    from src.mrdoors.enhance import enhance_numpy, enhance_pillow
+
+    img = Image.open(SAMPLE).convert("RGB")
+    # Шум «матрицы», чтобы фильтры работали не только на идеальных линиях
+    img = ImageChops.add(img, Image.merge("RGB", [Image.effect_noise(img.size, 10)] * 3), 1, -128)
+    diff = np.abs(np.asarray(enhance_pillow(img), dtype=int) - np.asarray(enhance_numpy(img), dtype=int))
+    assert diff.mean() < 1.5
+    assert np.percentile(diff, 99) <= 6
+
+    # Полоски у границы применимости box-фильтра (меньше 2 * (радиус + 1) — через Pillow)
+    for size in [(3, 40), (40, 3), (4, 40), (5, 5)]:
+        strip = img.crop((100, 100, 100 + size[0], 100 + size[1]))
+        diff = np.abs(np.asarray(enhance_pillow(strip), dtype=int) - np.asarray(enhance_numpy(strip), dtype=int))
+        assert diff.max() <= 8
@@ -0,0 +1,45 @@
+from src.mrdoors.progress import EditThrottle, ProgressiveReply
+
+
+class FakeBot:
+    def __init__(self, fail_edits=False):
+        self.fail_edits = fail_edits
+        self.edits = []
+        self.sent = []
+
+    def edit_message_text(self, text, chat_id, message_id):
+        if self.fail_edits:
+            raise RuntimeError("Bad Request: message to edit not found")
+        self.edits.append(text)
+
+    def send_message(self, chat_id, text):
+        self.sent.append(text)
+
+
+def test_updates_are_throttled_and_final_edit_is_forced():
+    bot = FakeBot()
+    reply = ProgressiveReply(bot, 1, 100, EditThrottle(0.2))
+
+    reply.update("1/6")
+    reply.update("2/6")  # слишком рано — пропускается
+    reply.finish("done")
+
+    assert bot.edits == ["1/6", "done"]
+    assert bot.sent == []
+
+
+def test_long_final_text_is_split():
+    bot = FakeBot()
+    reply = ProgressiveReply(bot, 1, 100, EditThrottle(0))
+    text = "\n".join(["1234567890"] * 800)
+
+    reply.finish(text)
+
+    assert len(bot.edits) == 1 and len(bot.edits[0]) <= 4096
+    assert bot.sent and all(len(part) <= 4096 for part in bot.sent)
+
+
+def test_falls_back_to_new_message_when_edit_fails():
+    bot = FakeBot(fail_edits=True)
+    ProgressiveReply(bot, 1, 100, EditThrottle(0)).finish("result")
+    assert bot.sent == ["result"]
@@ -0,0 +1,90 @@
+import asyncio
+
+from src.mrdoors.ratelimit import OpenAIScheduler, TokenBucket, parse_rate_limits
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket_refill():
+    clock = FakeClock()
+    bucket = TokenBucket(60, clock)  # 1 в секунду, ёмкость 60
+    bucket.consume(60)
+    assert bucket.wait_time(1) == 1.0
+    clock.now = 2.5
+    assert bucket.wait_time(2) == 0.0
+    bucket.pause(10)
+    assert bucket.wait_time(1) == 11.0
+
+
+def test_round_robin_between_chats():
+    clock = FakeClock()
+    scheduler = OpenAIScheduler(rpm=60, clock=clock)
+    scheduler.requests.consume(60)  # корзина пуста, все ждут
+
+    flood = [scheduler._enqueue("A", 1) for _ in range(4)]
+    other = scheduler._enqueue("B", 1)
+    granted = []
+    for _ in range(5):
+        clock.now += 1.0
+        with scheduler._cond:
+            scheduler._dispatch()
+        granted.extend(t for t in flood + [other] if t.granted_at == clock.now)
+
+    # Фото второго пользователя не ждёт, пока разберут все фото первого
+    assert granted.index(other) == 1
+    assert scheduler.metrics()["queue_depth"] == 0
+
+
+def test_tpm_uses_real_usage():
+    clock = FakeClock()
+    scheduler = OpenAIScheduler(tpm=6000, clock=clock)
+    ticket = scheduler.acquire("A", tokens=1000)
+    # Реальный запрос оказался дороже оценки — недостающее списывается
+    scheduler.complete(ticket, 5000)
+    assert scheduler.tokens.wait_time(2000) == 10.0
+    assert scheduler.estimate_tokens() > 1500
+
+    waiting = scheduler._enqueue("B", 2000)
+    with scheduler._cond:
+        assert scheduler._dispatch() == 10.0
+    assert waiting.granted_at is None
+    assert scheduler.metrics()["queue_depth"] == 1
+
+
+def test_cancelled_async_wait_leaves_the_queue():
+    clock = FakeClock()
+    scheduler = OpenAIScheduler(rpm=60, tpm=6000, clock=clock)
+    scheduler.requests.consume(60)  # корзина пуста, заявка ждёт
+
+    async def main():
+        task = asyncio.ensure_future(scheduler.acquire_async("A", tokens=1000))
+        await asyncio.sleep(0.05)
+        assert scheduler.metrics()["queue_depth"] == 1
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(main())
+    assert scheduler.metrics()["queue_depth"] == 0
+    clock.now = 60.0
+    with scheduler._cond:
+        scheduler._dispatch()
+    # Отменённая заявка не выдаётся и не тратит TPM
+    assert scheduler.metrics()["granted"] == 0
+    assert scheduler.tokens.wait_time(6000) == 0.0
+
+    granted = scheduler.acquire("B", tokens=1000)
+    scheduler.cancel(granted)
+    assert scheduler.tokens.wait_time(6000) == 0.0
+
+
+def test_parse_rate_limits():
+    assert parse_rate_limits("gpt-4o=500:30000, gpt-4o-mini=500:") == {
+        "gpt-4o": (500, 30000),
+        "gpt-4o-mini": (500, 0),
+    }
@@ -0,0 +1,165 @@
+import threading
+import time
+
+from src.mrdoors import recognition
+from src.mrdoors.analytics import RequestStats
+from src.mrdoors.recognition import TileExecutor
+from src.mrdoors.utils import Tile
+
+
+def _tiles(count: int):
+    return [Tile(index=i, data=memoryview(f"tile{i}".encode())) for i in range(1, count + 1)]
+
+
+def _stats(req_id: str, cost: float = 0.01) -> RequestStats:
+    return RequestStats(duration=0.1, input_tokens=10, output_tokens=5, cost_usd=cost,
+                        model="gpt-4o", request_id=req_id)
+
+
+def test_results_in_tile_order_and_per_photo_cap(monkeypatch):
+    lock = threading.Lock()
+    active = 0
+    peak = 0
+
+    def fake_ask(payload, req_id, client, collected=None, phash=None, positions=None, image_info=None):
+        nonlocal active, peak
+        with lock:
+            active += 1
+            peak = max(peak, active)
+        idx = int(req_id.split("#t")[-1])
+        # Первые тайлы отвечают медленнее последних
+        time.sleep(0.05 * (6 - idx))
+        with lock:
+            active -= 1
+        collected.append(_stats(req_id))
+        return [str(idx * 100)]
+
+    monkeypatch.setattr(recognition.utils, "ask_openai_for_numbers", fake_ask)
+    executor = TileExecutor(max_workers=8, per_photo=3)
+    try:
+        finished = []
+        results = executor.recognize(_tiles(6), "1:2", None,
+                                     on_result=lambda r: finished.append(r.index))
+    finally:
+        executor.shutdown()
+
+    assert [r.index for r in results] == [1, 2, 3, 4, 5, 6]
+    assert [r.numbers for r in results] == [[str(i * 100)] for i in range(1, 7)]
+    assert sorted(finished) == [1, 2, 3, 4, 5, 6]
+    assert peak <= 3
+
+
+def test_accounting_is_per_photo(monkeypatch):
+    def fake_ask(payload, req_id, client, collected=None, phash=None, positions=None, image_info=None):
+        if req_id.endswith("#t2"):
+            raise RuntimeError("boom")
+        if not req_id.endswith("#t3"):
+            collected.append(_stats(req_id))
+        return ["1"]
+
+    monkeypatch.setattr(recognition.utils, "ask_openai_for_numbers", fake_ask)
+    executor = TileExecutor(max_workers=4, per_photo=4)
+    try:
+        # Два фото одновременно не должны видеть статистику друг друга
+        out = {}
+        threads = [
+            threading.Thread(target=lambda rid=rid: out.__setitem__(rid, executor.recognize(_tiles(3), rid, None)))
+            for rid in ("10:1", "10:2")
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        executor.shutdown()
+
+    for rid, results in out.items():
+        assert sum(1 for r in results if r.succeeded) == 1
+        assert results[1].error == "boom"
+        assert all(s.request_id.startswith(rid) for r in results for s in r.stats)
+
+
+def test_async_executor_keeps_order_and_cap(monkeypatch):
+    import asyncio
+    from src.mrdoors import async_bot
+
+    active = 0
+    peak = 0
+
+    async def fake_ask(payload, req_id, client, collected=None, phash=None, positions=None, image_info=None):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        idx = int(req_id.split("#t")[-1])
+        await asyncio.sleep(0.01 * (6 - idx))
+        active -= 1
+        collected.append(_stats(req_id))
+        return [str(idx)]
+
+    monkeypatch.setattr(async_bot, "ask_openai_for_numbers_async", fake_ask)
+
+    async def scenario():
+        executor = async_bot.AsyncTileExecutor(max_concurrency=4, per_photo=2)
+        return await executor.recognize(_tiles(6), "1:2", None)
+
+    results = asyncio.run(scenario())
+    assert [r.numbers for r in results] == [[str(i)] for i in range(1, 7)]
+    assert all(r.succeeded for r in results)
+    assert peak <= 2
+
+
+def test_tile_builds_data_url_lazily_and_is_released(monkeypatch):
+    seen = []
+
+    def fake_ask(payload, req_id, client, collected=None, phash=None, positions=None, image_info=None):
+        seen.append(payload["image_url"]["url"])
+        collected.append(_stats(req_id))
+        return ["1"]
+
+    monkeypatch.setattr(recognition.utils, "ask_openai_for_numbers", fake_ask)
+    tiles = [Tile(index=1, data=memoryview(b"\xff\xd8abc"))]
+    executor = TileExecutor(max_workers=1, per_photo=1)
+    try:
+        executor.recognize(tiles, "1:3", None)
+    finally:
+        executor.shutdown()
+
+    assert seen == ["data:image/jpeg;base64,/9hhYmM="]
+    assert tiles[0].data is None
+
+
+def test_tiles_share_one_request_and_missing_tile_is_asked_alone(monkeypatch):
+    from types import SimpleNamespace
+
+    def reply(content):
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+                               usage=SimpleNamespace(prompt_tokens=900, completion_tokens=30))
+
+    calls = []
+
+    def fake_completion(client, model, payload, req_id):
+        calls.append(req_id)
+        if isinstance(payload, list):
+            # Тайл 2 модель пропустила
+            return reply('{"tiles": {"1": [["100", 10, 20]], "Тайл 3": ["300"]}}')
+        return reply('{"numbers": ["200"]}')
+
+    events = []
+    monkeypatch.setattr(recognition.utils, "_create_completion", fake_completion)
+    monkeypatch.setattr(recognition.utils.analytics, "add_request", lambda stats, extra=None: events.append(stats))
+    executor = TileExecutor(max_workers=4, per_photo=2, tiles_per_request=0)
+    tiles = _tiles(3)
+    try:
+        results = executor.recognize(tiles, "1:2", None)
+    finally:
+        executor.shutdown()
+
+    assert calls[0] == "1:2#g1+2+3" and calls[1:] == ["1:2#t2"]
+    assert [r.numbers for r in results] == [["100"], ["200"], ["300"]]
+    assert results[0].positions == [(10, 20)] and results[2].positions == [None]
+    assert all(r.succeeded for r in results)
+    assert events[0].raw_prompt["mode"] == "group" and events[0].raw_prompt["tiles"] == [1, 2, 3]
+    # Стоимость группового запроса делится между тайлами, а не умножается
+    group_cost = sum(s.cost_usd for r in results for s in r.stats if s.request_id == "1:2#g1+2+3")
+    assert abs(group_cost - events[0].cost_usd) < 1e-9
+    assert all(t.data is None for t in tiles)
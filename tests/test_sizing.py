@@ -0,0 +1,43 @@
+from src.mrdoors.sizing import billed_blocks, image_tokens, plan_scale, plan_tile
+
+
+def test_token_formula_matches_openai_examples():
+    # Примеры из документации OpenAI для detail=high
+    assert image_tokens("gpt-4o", 1024, 1024) == 765
+    assert image_tokens("gpt-4o", 2048, 4096) == 1105
+    assert image_tokens("unknown-model", 1024, 1024) == 765
+
+
+def test_scale_avoids_padding_blocks():
+    # 2x-увеличение тайла 1000x667 оплачивалось бы шестью блоками
+    assert billed_blocks(2000, 1334) == 6
+    scale = plan_scale(1000, 667, min_scale=1.0)
+    assert scale >= 1.0
+    assert billed_blocks(int(1000 * scale), int(667 * scale)) == 4
+
+
+def test_blank_edges_are_trimmed_only_when_it_saves_blocks():
+    plan = plan_tile((0, 0, 530, 1000), (20, 10, 500, 990), min_scale=1.0)
+    assert plan.blocks == 2 and plan.rect == (12, 2, 508, 998)
+    plan = plan_tile((0, 0, 400, 400), (20, 20, 380, 380), min_scale=1.0)
+    assert plan.rect == (0, 0, 400, 400)
+
+
+def test_prediction_is_recorded_next_to_actual(monkeypatch):
+    from types import SimpleNamespace
+
+    from src.mrdoors import utils
+
+    resp = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content='{"numbers": ["5"]}'))],
+                           usage=SimpleNamespace(prompt_tokens=950, completion_tokens=10))
+    monkeypatch.setattr(utils, "_create_completion", lambda client, model, payload, req_id: resp)
+    monkeypatch.setattr(utils.analytics, "add_request", lambda stats, extra=None: None)
+
+    collected = []
+    utils.ask_openai_for_numbers({"type": "image_url"}, "1:2#t1", None, collected=collected,
+                                 image_info={"width": 1024, "height": 1024, "bytes": 5000})
+    stats = collected[0]
+    expected = image_tokens(stats.model, 1024, 1024) + utils.PROMPT_TEXT_TOKENS
+    assert stats.raw_response["predicted_prompt_tokens"] == expected
+    assert stats.input_tokens == 950
+    assert stats.raw_prompt["image"]["bytes"] == 5000
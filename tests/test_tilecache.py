@@ -0,0 +1,113 @@
+import json
+import random
+from io import BytesIO
+
+from PIL import Image, ImageDraw, ImageFont
+
+from src.mrdoors import utils
+from src.mrdoors.tilecache import BKTree, TileCache, TileSignature, dhash, hamming, signature
+
+
+def _drawing(seed: int) -> Image.Image:
+    rnd = random.Random(seed)
+    img = Image.new("L", (400, 300), 255)
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        x, y = rnd.randrange(380), rnd.randrange(280)
+        draw.rectangle((x, y, x + rnd.randrange(20, 120), y + rnd.randrange(10, 60)), outline=0, width=3)
+    return img
+
+
+def test_bktree_matches_brute_force():
+    rnd = random.Random(1)
+    keys = [rnd.getrandbits(32) for _ in range(500)]
+    tree = BKTree()
+    for key in keys:
+        tree.add(key, key)
+
+    for _ in range(20):
+        probe = rnd.choice(keys) ^ (1 << rnd.randrange(32))
+        expected = sorted(k for k in keys if hamming(k, probe) <= 3)
+        assert sorted(value for _, value in tree.search(probe, 3)) == expected
+
+
+def test_dhash_tolerates_recompression_but_not_other_drawings():
+    original = _drawing(1)
+    # Пересжатие и лёгкое изменение яркости, как при повторной съёмке
+    reshot = original.point(lambda p: min(255, p + 6)).resize((396, 297)).resize((400, 300))
+    assert hamming(dhash(original), dhash(reshot)) <= 10
+    assert hamming(dhash(original), dhash(_drawing(2))) > 30
+
+
+def _sheet(numbers) -> Image.Image:
+    """Один шаблон — рамка и линия, меняются только числа."""
+    img = Image.new("L", (800, 700), 255)
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((20, 20, 780, 680), outline=0, width=4)
+    draw.line((20, 350, 780, 350), fill=0, width=3)
+    font = ImageFont.load_default(size=32)
+    for (x, y), n in zip([(80, 100), (450, 120), (100, 250), (500, 260), (120, 480), (480, 520)], numbers):
+        draw.text((x, y), n, fill=0, font=font)
+    return img
+
+
+def _jpeg(img: Image.Image, quality: int) -> Image.Image:
+    buf = BytesIO()
+    img.save(buf, format="JPEG", quality=quality)
+    return Image.open(BytesIO(buf.getvalue()))
+
+
+def test_same_template_with_other_digits_does_not_collide(tmp_path):
+    first = ["1250", "300", "45", "870", "1600", "95"]
+    cache = TileCache(str(tmp_path / "tiles.sqlite3"), max_distance=10, max_entries=100, version="v1")
+    cache.add(signature(_sheet(first)), first)
+    other = ["3875", "615", "72", "240", "9100", "38"]
+    cache.add(signature(_sheet(other)), other)
+
+    # Хэши шаблона совпадают — отличить тайлы должна проверка по маске
+    assert hamming(signature(_sheet(first)).hash, signature(_sheet(other)).hash) <= 10
+    assert cache.lookup(signature(_sheet(first)))[0] == first
+    assert cache.lookup(signature(_sheet(other)))[0] == other
+    # Одна изменённая цифра — тоже промах
+    assert cache.lookup(signature(_sheet(["1250", "300", "45", "870", "1800", "95"]))) is None
+
+    # Пересжатие и сдвиг кадра того же листа — попадание
+    shifted = Image.new("L", (800, 700), 255)
+    shifted.paste(_sheet(first).crop((0, 0, 790, 690)), (10, 10))
+    assert cache.lookup(signature(_jpeg(_sheet(first), 60)))[0] == first
+    assert cache.lookup(signature(shifted))[0] == first
+
+
+def test_cache_persists_and_drops_other_versions(tmp_path):
+    path = str(tmp_path / "tiles.sqlite3")
+    sig = signature(_drawing(1))
+    cache = TileCache(path, max_distance=2, max_entries=100, version="v1")
+    cache.add(sig, ["56", "300"])
+    assert cache.lookup(sig) == (["56", "300"], 0)
+    assert cache.lookup(signature(_drawing(2))) is None
+
+    assert TileCache(path, max_distance=4, max_entries=100, version="v1").lookup(sig) == (["56", "300"], 0)
+    assert TileCache(path, max_distance=4, max_entries=100, version="v2").lookup(sig) is None
+
+
+def test_signature_survives_json():
+    sig = signature(_drawing(3))
+    assert TileSignature.from_json(json.loads(json.dumps(sig.to_json()))) == sig
+
+
+def test_hit_is_recorded_as_zero_cost_event(monkeypatch, tmp_path):
+    cache = TileCache(str(tmp_path / "tiles.sqlite3"), max_distance=4, max_entries=100, version="v1")
+    cache.add(signature(_drawing(4)), ["120"])
+    monkeypatch.setattr(utils, "tile_cache", cache)
+    recorded = []
+    monkeypatch.setattr(utils.analytics, "add_request", lambda stats, extra=None: recorded.append(stats))
+
+    collected = []
+    numbers = utils.ask_openai_for_numbers({"type": "image_url"}, "7:9#t2", None, collected=collected,
+                                           phash=signature(_jpeg(_drawing(4), 70)))
+
+    assert numbers == ["120"]
+    assert collected == recorded
+    stats = recorded[0]
+    assert stats.cost_usd == 0 and stats.model == "cache:phash" and stats.status == "success"
+    assert stats.request_id == "7:9#t2@cache" and stats.tile_id == "t2"
@@ -0,0 +1,87 @@
+import random
+from pathlib import Path
+
+from PIL import Image, ImageDraw, ImageFont
+
+from src.mrdoors.tiling import adaptive_layout, grid_layout, merge_numbers, with_overlap
+from src.mrdoors.utils import preprocess_and_tile
+
+SAMPLE = Path(__file__).parent / "assets" / "schema_sample.jpg"
+FONT = ImageFont.load_default(size=40)
+
+
+def _page(numbers: int, seed: int = 0, size=(2000, 1400)) -> Image.Image:
+    rnd = random.Random(seed)
+    page = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(page)
+    for _ in range(numbers):
+        draw.text((rnd.randrange(40, size[0] - 160), rnd.randrange(40, size[1] - 80)),
+                  str(rnd.randrange(10, 9999)), fill=0, font=FONT)
+    return page
+
+
+def test_small_sparse_schematic_is_one_tile():
+    prepared = preprocess_and_tile(SAMPLE.read_bytes(), max_side=2000, min_ink=8, layout="adaptive")
+    assert len(prepared.tiles) == 1 and prepared.planned == 1
+
+
+def test_dense_page_gets_more_tiles_than_sparse():
+    sparse = adaptive_layout(_page(40), target_side=800, max_tiles=9)
+    dense = adaptive_layout(_page(900), target_side=800, max_tiles=9)
+    assert len(sparse.rects) < len(dense.rects) <= 9
+
+
+def test_cuts_fall_between_numbers():
+    page = Image.new("RGB", (2000, 600), "white")
+    draw = ImageDraw.Draw(page)
+    boxes = []
+    # Число прямо на середине листа и просвет правее
+    for x, y in ((60, 100), (880, 120), (1150, 300), (1700, 450), (400, 420)):
+        draw.text((x, y), "123456", fill=0, font=FONT)
+        boxes.append(draw.textbbox((x, y), "123456", font=FONT))
+
+    plan = adaptive_layout(page, target_side=700, max_tiles=9)
+    assert plan.cols >= 2
+    cuts = sorted({rect[0] for rect in plan.rects} - {min(rect[0] for rect in plan.rects)})
+    for cut in cuts:
+        assert all(not (left <= cut <= right) for left, _, right, _ in boxes)
+
+
+def test_blank_photo_is_sent_whole():
+    plan = adaptive_layout(Image.new("RGB", (1200, 900), "white"), target_side=800, max_tiles=9)
+    assert plan.rects == [(0, 0, 1200, 900)]
+
+
+def test_overlap_extends_only_inner_edges():
+    plan = with_overlap(grid_layout((1000, 600), 2, 1), 0.1)
+    assert plan.rects == [(0, 0, 550, 600), (450, 0, 1000, 600)]
+
+
+def test_fragment_at_seam_is_dropped_but_distant_number_is_kept():
+    left, right = (0, 0, 550, 600), (450, 0, 1000, 600)
+    merged = merge_numbers([
+        # «12» — обрывок «1250» у правого края левого тайла; «12» справа внизу — настоящее число
+        (left, ["12", "7"], [(96, 50), (10, 10)]),
+        (right, ["1250", "12"], [(10, 50), (80, 90)]),
+    ])
+    assert merged == ["7", "12", "1250"]
+    assert merge_numbers([(left, ["12"], [(96, 50)]), (right, ["1250"], [(10, 50)])]) == ["1250"]
+    # Без позиций — простое объединение, как раньше
+    assert merge_numbers([(left, ["12"], []), (right, ["1250"], [])]) == ["12", "1250"]
+
+
+def test_positions_are_parsed_from_response(monkeypatch):
+    from types import SimpleNamespace
+
+    from src.mrdoors import utils
+
+    content = '{"numbers": [["1 250", 42, 13], "85", ["3,5", "x", 1]]}'
+    resp = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+                           usage=SimpleNamespace(prompt_tokens=100, completion_tokens=20))
+    monkeypatch.setattr(utils, "_create_completion", lambda client, model, payload, req_id: resp)
+    monkeypatch.setattr(utils.analytics, "add_request", lambda stats, extra=None: None)
+
+    positions = []
+    numbers = utils.ask_openai_for_numbers({"type": "image_url"}, "1:2#t1", None, positions=positions)
+    assert numbers == ["1250", "85", "3.5"]
+    assert positions == [(42.0, 13.0), None, None]
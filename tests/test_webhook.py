@@ -0,0 +1,66 @@
+import asyncio
+
+import httpx
+
+from src.mrdoors.webhook import create_webhook_app
+
+UPDATE = {
+    "update_id": 1001,
+    "message": {
+        "message_id": 7,
+        "date": 1700000000,
+        "chat": {"id": 42, "type": "private"},
+        "text": "/start",
+    },
+}
+
+
+def _post(app, json=None, secret="s3cret", path="/telegram/webhook", **kwargs):
+    async def go():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bot") as client:
+            headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret is not None else {}
+            return await client.post(path, json=json, headers=headers, **kwargs)
+
+    return asyncio.run(go())
+
+
+def test_valid_update_is_dispatched():
+    received = []
+    app = create_webhook_app(received.append, "s3cret")
+
+    response = _post(app, json=UPDATE)
+    assert response.status_code == 200
+    assert [u.update_id for u in received] == [1001]
+    assert received[0].message.chat.id == 42
+
+
+def test_secret_is_required():
+    received = []
+    app = create_webhook_app(received.append, "s3cret")
+
+    assert _post(app, json=UPDATE, secret="wrong").status_code == 403
+    assert _post(app, json=UPDATE, secret=None).status_code == 403
+    assert _post(app, json=UPDATE, path="/other").status_code == 404
+    assert received == []
+
+
+def test_malformed_update_and_async_dispatch():
+    done = []
+
+    async def process(update):
+        done.append(update.update_id)
+
+    app = create_webhook_app(process, "s3cret")
+    assert _post(app, content=b"{not json").status_code == 400
+
+    async def go():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bot") as client:
+            response = await client.post("/telegram/webhook", json=UPDATE,
+                                         headers={"X-Telegram-Bot-Api-Secret-Token": "s3cret"})
+            await asyncio.sleep(0)
+            return response
+
+    assert asyncio.run(go()).status_code == 200
+    assert done == [1001]
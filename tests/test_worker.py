@@ -0,0 +1,59 @@
+import os
+import socket
+import subprocess
+import sys
+
+import pytest
+
+from src.mrdoors import worker
+from src.mrdoors.jobqueue import Job
+from src.mrdoors.recognition import RetryableError
+
+
+def test_only_dead_local_workers_are_stale():
+    proc = subprocess.Popen([sys.executable, "-c", "pass"])
+    proc.wait()
+    host = socket.gethostname()
+
+    assert worker.stale_worker(f"worker-1-0@{host}:{proc.pid}")
+    assert not worker.stale_worker(worker.worker_id("worker-1-0"))
+    assert not worker.stale_worker(f"worker-1-0@{host}-other:{proc.pid}")
+    assert not worker.stale_worker("worker-1-0")
+    assert worker.worker_id("w").endswith(f":{os.getpid()}")
+
+
+class _OfflineBot:
+    """Telegram недоступен для скачивания, сообщения копятся в ``sent``."""
+
+    def __init__(self):
+        self.sent = []
+
+    def get_file(self, file_id):
+        raise ConnectionError("telegram is down")
+
+    def send_chat_action(self, chat_id, action):
+        pass
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(text)
+
+
+def _job(kind, payload):
+    return Job(id=1, kind=kind, payload=payload, attempts=1, lease_token="t", created_at=0.0)
+
+
+@pytest.mark.parametrize("kind, payload", [
+    ("photo", {"chat_id": 1, "file_id": "f", "req_id": "1:1"}),
+    ("document", {"chat_id": 1, "file_id": "f", "req_id": "1:1"}),
+    ("batch", {"chat_id": 1, "file_id": "f", "req_id": "1:1"}),
+    ("album", {"chat_id": 1, "photos": [{"file_id": "f", "req_id": "1:1"}]}),
+])
+def test_transient_error_is_retried_until_last_attempt(kind, payload):
+    bot = _OfflineBot()
+    with pytest.raises(RetryableError):
+        worker._handle_job(bot, None, _job(kind, payload), retry=True)
+    assert bot.sent == []
+
+    # Последняя попытка: пользователь получает ответ, задание подтверждается
+    worker._handle_job(bot, None, _job(kind, payload), retry=False)
+    assert len(bot.sent) == 1